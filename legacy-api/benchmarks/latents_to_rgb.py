@@ -0,0 +1,101 @@
+"""
+Compares the preview projection as it ships against the original latents_to_rgb.
+
+Previews are copied to the host through the pinned ring, then projected on the cpu in float32
+by the encoder threads, so that is the path measured. The original projected on the device.
+
+Usage: poetry run python -m benchmarks.latents_to_rgb [--device cuda] [--dtype float16]
+"""
+
+import time
+import argparse
+
+import numpy as np
+import torch
+import PIL.Image as PILImage
+
+from utils.latents import WEIGHTS, latents_to_rgb
+from utils.transfer import PinnedRing
+
+
+# the implementation this module replaced, kept as the baseline
+def legacy_latents_to_rgb(latents):
+    weights_tensor = torch.t(
+        torch.tensor(WEIGHTS, dtype=latents.dtype).to(latents.device)
+    )
+    biases_tensor = torch.tensor((150, 140, 130), dtype=latents.dtype).to(
+        latents.device
+    )
+    weights_s = torch.einsum("...lxy,lr -> ...rxy", latents, weights_tensor)
+    biases_s = biases_tensor.unsqueeze(-1).unsqueeze(-1)
+    rgb_tensor = weights_s + biases_s
+    image_array = rgb_tensor.clamp(0, 255)[0].byte().cpu().numpy()
+    image_array = image_array.transpose(1, 2, 0)
+
+    return PILImage.fromarray(image_array)
+
+
+ring = PinnedRing()
+
+
+# what submit_preview and encode_host_copy do, without the encoder pool
+def host_latents_to_rgb(latents):
+    copy = ring.copy(latents[:1])
+
+    try:
+        return latents_to_rgb(copy.wait().float())
+    finally:
+        copy.release()
+
+
+def measure(name: str, fn, latents, iterations: int):
+    # warm up the allocator and the projection cache
+    for _ in range(3):
+        fn(latents)
+
+    start = time.perf_counter()
+
+    for _ in range(iterations):
+        fn(latents)
+
+    elapsed_ms = (time.perf_counter() - start) * 1000 / iterations
+    print(f"{name:<28} {elapsed_ms:8.3f} ms/call")
+
+    return elapsed_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+
+    # 1360x768 program 0 and program 4 latents
+    latents = torch.randn(1, 4, 768 // 8, 1360 // 8, dtype=dtype)
+    latents = latents.to(args.device)
+
+    print(f"device={args.device} dtype={args.dtype}")
+
+    ring.reserve(latents[:1])
+
+    legacy_ms = measure(
+        "legacy (on the device)", legacy_latents_to_rgb, latents, args.iterations
+    )
+    host_ms = measure(
+        "host copy + cpu float32", host_latents_to_rgb, latents, args.iterations
+    )
+
+    print(f"speedup: {legacy_ms / host_ms:.2f}x")
+
+    expected = np.asarray(legacy_latents_to_rgb(latents), dtype=np.int16)
+    actual = np.asarray(host_latents_to_rgb(latents), dtype=np.int16)
+    print(f"max pixel difference: {np.abs(expected - actual).max()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""
+Drives concurrent websocket clients against the server running on stub pipelines.
+
+Reports throughput, latency percentiles and time to first preview per program,
+preview drop rates, preview and final image sizes, and the memory use of the server and its worker processes. Runs on a cpu-only machine without model downloads.
+
+Usage: poetry run python -m benchmarks.load [--clients 8] [--duration 30] [--mix P0=1,P2=1,P3=1,P4=1] [--preview delta]
+       [--workers text2img,img2img]
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+
+from typing import Dict, List, NamedTuple, Optional
+
+import websockets
+
+from utils.protocol import (
+    FRAME_DONE,
+    FRAME_IMAGE,
+    FRAME_PREVIEW,
+    FRAME_PROGRESS,
+    FRAME_STATUS,
+    V2_HEADER,
+)
+
+
+class RequestResult(NamedTuple):
+    program: str
+    latency: float
+    first_preview: Optional[float]
+    steps: int
+    previews: int
+    preview_bytes: int
+    final_bytes: int
+
+    # q:full, jobs:full or cancelled, if the request did not run to the end
+    status: Optional[str] = None
+
+
+def create_command(program: str) -> str:
+    # fresh prompts, so the result cache cannot short-circuit a request
+    nonce = random.getrandbits(32)
+
+    if program == "P0":
+        return f"P0:load test {nonce}"
+
+    if program == "P2":
+        return f"P2:{random.uniform(0.3, 0.9):.3f}"
+
+    if program == "P3":
+        return f"P3B:load test {nonce}"
+
+    return f"P4:load test {nonce}"
+
+
+def get_program(command: str) -> str:
+    program = command.split(":")[0]
+
+    return "P3" if program == "P3B" else program
+
+
+async def run_command_v1(sock, command: str) -> RequestResult:
+    start = time.perf_counter()
+    first_preview = None
+    steps = previews = preview_bytes = final_bytes = 0
+    status = None
+
+    # a preview image directly follows the progress marker of its step,
+    # but so does the final image when the last step has no preview, e.g. on program 0
+    follows_progress = False
+    pending_preview: Optional[bytes] = None
+
+    await sock.send(command)
+
+    while True:
+        message = await sock.recv()
+
+        # the final image is the binary message right before done
+        if pending_preview is not None and message == "done":
+            final_bytes += len(pending_preview)
+        elif pending_preview is not None:
+            previews += 1
+            preview_bytes += len(pending_preview)
+
+        pending_preview = None
+
+        if isinstance(message, bytes):
+            if follows_progress:
+                pending_preview = message
+            else:
+                final_bytes += len(message)
+
+            follows_progress = False
+            continue
+
+        follows_progress = message.startswith("p:")
+
+        if follows_progress:
+            steps += 1
+            first_preview = first_preview or time.perf_counter() - start
+
+        elif message in ("q:full", "jobs:full", "cancelled"):
+            status = message
+
+        elif message == "done":
+            break
+
+    latency = time.perf_counter() - start
+
+    return RequestResult(
+        get_program(command),
+        latency,
+        first_preview,
+        steps,
+        previews,
+        preview_bytes,
+        final_bytes,
+        status,
+    )
+
+
+async def run_command_v2(sock, command: str) -> RequestResult:
+    start = time.perf_counter()
+    first_preview = None
+    steps = previews = preview_bytes = final_bytes = 0
+    status = None
+
+    await sock.send(command)
+
+    while True:
+        message = await sock.recv()
+        _, frame_type, _, _, _, _ = V2_HEADER.unpack_from(message)
+
+        if frame_type in (FRAME_PROGRESS, FRAME_PREVIEW):
+            steps += 1
+            previews += frame_type == FRAME_PREVIEW
+
+            if frame_type == FRAME_PREVIEW:
+                preview_bytes += len(message) - V2_HEADER.size
+            first_preview = first_preview or time.perf_counter() - start
+
+        elif frame_type == FRAME_IMAGE:
+            final_bytes += len(message) - V2_HEADER.size
+
+        elif frame_type == FRAME_STATUS:
+            text = message[V2_HEADER.size :].decode()
+
+            if text in ("q:full", "jobs:full", "cancelled"):
+                status = text
+
+        elif frame_type == FRAME_DONE:
+            break
+
+    latency = time.perf_counter() - start
+
+    return RequestResult(
+        get_program(command),
+        latency,
+        first_preview,
+        steps,
+        previews,
+        preview_bytes,
+        final_bytes,
+        status,
+    )
+
+
+async def run_client(
+    url: str,
+    programs: List[str],
+    weights: List[float],
+    deadline: float,
+    protocol: int,
+    preview: Optional[str],
+    results: List[RequestResult],
+):
+    async with websockets.connect(url, max_size=None) as sock:
+        if protocol == 2:
+            await sock.send("PROTOCOL:2")
+            await sock.recv()
+
+        if preview is not None:
+            await sock.send(f"PREVIEW:{preview}")
+            await sock.recv()
+
+        run_command = run_command_v2 if protocol == 2 else run_command_v1
+
+        while time.perf_counter() < deadline:
+            program = random.choices(programs, weights)[0]
+            results.append(await run_command(sock, create_command(program)))
+
+
+def read_memory_mb(pid: int) -> Optional[float]:
+    """
+    The proportional set size of a process, falling back to its rss.
+
+    Unlike rss, it splits shared pages such as the worker frame rings between the processes,
+    so the sizes of a process tree add up.
+    """
+
+    for path, field in (
+        (f"/proc/{pid}/smaps_rollup", "Pss:"),
+        (f"/proc/{pid}/status", "VmRSS:"),
+    ):
+        try:
+            with open(path) as file:
+                for line in file:
+                    if line.startswith(field):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            continue
+
+    return None
+
+
+def get_process_tree(pid: int) -> List[int]:
+    """The process and all of its descendants, such as the inference workers."""
+
+    children: Dict[int, List[int]] = {}
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                # the command name in parentheses may contain spaces
+                parent = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+        children.setdefault(parent, []).append(int(entry))
+
+    tree = [pid]
+
+    for process in tree:
+        tree += children.get(process, [])
+
+    return tree
+
+
+async def sample_memory(pid: int, samples: List[float], interval=0.5):
+    while True:
+        sizes = [read_memory_mb(process) for process in get_process_tree(pid)]
+        sizes = [size for size in sizes if size is not None]
+
+        if sizes:
+            samples.append(sum(sizes))
+
+        await asyncio.sleep(interval)
+
+
+def start_server(port: int, step_ms: float, workers: Optional[str]) -> subprocess.Popen:
+    env = {**os.environ, "STUB_STEP_MS": str(step_ms), "DELTA_PREVIEWS": "1"}
+
+    if workers:
+        env["INFERENCE_WORKERS"] = workers
+
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "benchmarks.stub_server:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def wait_until_ready(base_url: str, timeout: float = 120):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/health") as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+
+        time.sleep(0.25)
+
+    raise TimeoutError("server did not become ready")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile."""
+
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+
+    return ordered[index]
+
+
+def format_ms(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}"
+
+
+def report(results: List[RequestResult], elapsed: float, memory_samples: List[float]):
+    completed = [result for result in results if result.status is None]
+    refused = len(results) - len(completed)
+
+    print(
+        f"\ncompleted {len(completed)} requests in {elapsed:.1f}s, "
+        f"{len(completed) / elapsed:.2f} req/s, {refused} refused or cancelled"
+    )
+
+    print(
+        f"\n{'program':<8}{'count':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'ttfp p50':>10}{'ttfp p95':>10}{'dropped':>9}{'kB/req':>9}{'final kB':>10}"
+    )
+
+    by_program: Dict[str, List[RequestResult]] = {}
+
+    for result in completed:
+        by_program.setdefault(result.program, []).append(result)
+
+    for program, items in sorted(by_program.items()):
+        latencies = [item.latency for item in items]
+        first_previews = [item.first_preview for item in items if item.first_preview]
+
+        # program 0 only sends progress markers, so it cannot drop previews
+        steps = sum(item.steps for item in items if program != "P0")
+        previews = sum(item.previews for item in items)
+        drop_rate = f"{(steps - previews) / steps:.1%}" if steps else "-"
+
+        # preview bandwidth per request, to compare preview formats
+        preview_kb = sum(item.preview_bytes for item in items) / len(items) / 1000
+        final_kb = sum(item.final_bytes for item in items) / len(items) / 1000
+
+        print(
+            f"{program:<8}{len(items):>6}"
+            f"{format_ms(percentile(latencies, 50)):>9}"
+            f"{format_ms(percentile(latencies, 95)):>9}"
+            f"{format_ms(percentile(latencies, 99)):>9}"
+            f"{format_ms(percentile(first_previews, 50) if first_previews else None):>10}"
+            f"{format_ms(percentile(first_previews, 95) if first_previews else None):>10}"
+            f"{drop_rate:>9}"
+            f"{preview_kb:>9.1f}"
+            f"{final_kb:>10.1f}"
+        )
+
+    if memory_samples:
+        print(
+            f"\nserver and worker memory (pss): start {memory_samples[0]:.0f} MB, "
+            f"peak {max(memory_samples):.0f} MB, end {memory_samples[-1]:.0f} MB"
+        )
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+
+    for entry in mix.split(","):
+        program, _, weight = entry.partition("=")
+        weights[program.strip()] = float(weight or 1)
+
+    return weights
+
+
+async def run(args):
+    server = None
+
+    if args.url is None:
+        server = start_server(args.port, args.step_ms, args.workers)
+        base_url = f"http://127.0.0.1:{args.port}"
+    else:
+        base_url = args.url.rstrip("/")
+
+    memory_samples: List[float] = []
+    sampler = None
+
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, wait_until_ready, base_url)
+
+        if server is not None:
+            sampler = asyncio.create_task(sample_memory(server.pid, memory_samples))
+
+        mix = parse_mix(args.mix)
+        url = base_url.replace("http", "ws", 1) + "/ws"
+        results: List[RequestResult] = []
+
+        print(
+            f"clients={args.clients} duration={args.duration}s step={args.step_ms}ms "
+            f"protocol={args.protocol} mix={args.mix} preview={args.preview or 'jpeg'} "
+            f"workers={args.workers or 'none'}"
+        )
+
+        start = time.perf_counter()
+        deadline = start + args.duration
+
+        await asyncio.gather(
+            *(
+                run_client(
+                    url,
+                    list(mix),
+                    list(mix.values()),
+                    deadline,
+                    args.protocol,
+                    args.preview,
+                    results,
+                )
+                for _ in range(args.clients)
+            )
+        )
+
+        report(results, time.perf_counter() - start, memory_samples)
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", default="P0=1,P2=1,P3=1,P4=1")
+    parser.add_argument("--step-ms", type=float, default=20)
+    parser.add_argument("--protocol", type=int, default=1, choices=[1, 2])
+    parser.add_argument("--port", type=int, default=8765)
+
+    # a preview format to ask for, e.g. delta or webp,quality=60
+    parser.add_argument("--preview")
+
+    # run the stub pipelines in inference worker processes, e.g. text2img,img2img
+    parser.add_argument("--workers")
+
+    # benchmark a server that is already running instead, e.g. one on a real gpu
+    parser.add_argument("--url")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+CPU stand-ins for the diffusers pipelines, to exercise the serving layer without a GPU or model downloads.
+
+Each call sleeps STUB_STEP_MS per step and hands latents of the real shape to the step callback,
+so the scheduler, preview encoder, frame buffers and websocket writes do their usual work.
+The latents move from noise to a smooth image over the steps, so preview sizes resemble a real run.
+"""
+
+import os
+import math
+import time
+import types
+
+import torch
+import PIL.Image as PILImage
+
+from utils import pipelines
+
+STUB_STEP_MS = float(os.environ.get("STUB_STEP_MS", "20"))
+STUB_LOAD_SECONDS = float(os.environ.get("STUB_LOAD_SECONDS", "0"))
+
+# noise levels of the first and last step, as in the karras schedule of sdxl
+SIGMA_MAX, SIGMA_MIN = 14.6, 0.03
+
+# sdxl and sd 1.5 text encoder widths
+EMBEDDING_SIZES = {"text2img": 2048, "img2img": 768}
+
+
+class StubOutput:
+    def __init__(self, images):
+        self.images = images
+
+
+class StubPipeline:
+    """Implements the parts of the diffusers pipeline api that the programs, warmup and caches use."""
+
+    def __init__(self, name: str, step_ms: float = STUB_STEP_MS):
+        self.name = name
+        self.step_ms = step_ms
+        self.device = torch.device("cpu")
+        self._interrupt = False
+
+        self.unet = types.SimpleNamespace(device=self.device)
+        self.text_encoder = torch.nn.Identity()
+        self.text_encoder_2 = torch.nn.Identity()
+
+        self.vae = types.SimpleNamespace(
+            dtype=torch.float32,
+            config=types.SimpleNamespace(scaling_factor=0.18215),
+            encode=self._vae_encode,
+        )
+
+        self.image_processor = types.SimpleNamespace(preprocess=self._preprocess)
+
+    def __call__(
+        self,
+        prompt=None,
+        prompt_embeds=None,
+        image=None,
+        strength=1.0,
+        num_inference_steps=50,
+        width=None,
+        height=None,
+        callback_on_step_end=None,
+        **kwargs,
+    ):
+        self._interrupt = False
+
+        if prompt_embeds is not None:
+            batch = prompt_embeds.shape[0]
+        elif isinstance(prompt, list):
+            batch = len(prompt)
+        else:
+            batch = 1
+
+        width, height = width or 1024, height or 1024
+
+        # img2img skips the first (1 - strength) of its schedule, like diffusers does
+        steps = num_inference_steps
+
+        if self.name == "img2img":
+            steps = max(1, int(num_inference_steps * strength))
+
+        shape = (batch, 4, height // 8, width // 8)
+        image = create_smooth_latents(shape)
+        noise = torch.randn(shape)
+        sigmas = torch.logspace(
+            math.log10(SIGMA_MAX), math.log10(SIGMA_MIN), max(steps, 2)
+        )
+
+        for step in range(steps):
+            if self._interrupt:
+                break
+
+            time.sleep(self.step_ms / 1000)
+            progress = min(1.0, 1.5 * step / max(steps - 1, 1))
+            latents = image * progress + noise * sigmas[step].item()
+
+            if callback_on_step_end is not None:
+                timestep = 999 - step * 1000 // steps
+                callback_on_step_end(self, step, timestep, {"latents": latents})
+
+        images = [PILImage.new("RGB", (width, height)) for _ in range(batch)]
+
+        return StubOutput(images)
+
+    def encode_prompt(self, prompt, device=None, num_images_per_prompt=1, **kwargs):
+        size = EMBEDDING_SIZES[self.name]
+        embeds = torch.zeros(1, 77, size)
+
+        if self.name == "img2img":
+            return embeds, embeds.clone()
+
+        pooled = torch.zeros(1, 1280)
+
+        return embeds, embeds.clone(), pooled, pooled.clone()
+
+    def _preprocess(self, image, **kwargs):
+        return torch.zeros(1, 3, image.size[1], image.size[0])
+
+    def _vae_encode(self, image):
+        latents = torch.zeros(1, 4, image.shape[2] // 8, image.shape[3] // 8)
+        distribution = types.SimpleNamespace(mode=lambda: latents)
+
+        return types.SimpleNamespace(latent_dist=distribution)
+
+    def load_lora_weights(self, *args, **kwargs):
+        pass
+
+    def enable_lora(self):
+        pass
+
+    def disable_lora(self):
+        pass
+
+    def enable_xformers_memory_efficient_attention(self):
+        pass
+
+
+def create_smooth_latents(shape):
+    """Low frequency noise, standing in for the latents of a finished image."""
+
+    batch, channels, height, width = shape
+    coarse = torch.randn(batch, channels, max(1, height // 10), max(1, width // 10))
+
+    return torch.nn.functional.interpolate(
+        coarse, size=(height, width), mode="bicubic", align_corners=False
+    )
+
+
+def create_loader(name: str):
+    def load():
+        time.sleep(STUB_LOAD_SECONDS)
+
+        return StubPipeline(name)
+
+    return load
+
+
+# for PIPELINE_LOADERS, e.g. "text2img=benchmarks.stub_pipelines:load_text2img"
+load_text2img = create_loader("text2img")
+load_img2img = create_loader("img2img")
+
+
+def install_stub_pipelines():
+    """Replaces the real loaders. Must run before the server module starts loading pipelines."""
+
+    for name in list(pipelines.LOADERS):
+        pipelines.register_pipeline(name, create_loader(name))
@@ -0,0 +1,20 @@
+"""
+The websocket server, running on stub pipelines.
+
+Usage: poetry run uvicorn benchmarks.stub_server:app
+"""
+
+import os
+
+# inference workers are new processes, which pick their loaders from the environment
+os.environ["PIPELINE_LOADERS"] = (
+    "text2img=benchmarks.stub_pipelines:load_text2img,"
+    "img2img=benchmarks.stub_pipelines:load_img2img"
+)
+
+from benchmarks.stub_pipelines import install_stub_pipelines  # noqa: E402
+
+# before the server module starts loading the real pipelines
+install_stub_pipelines()
+
+from server import app  # noqa: E402, F401
@@ -0,0 +1,55 @@
+import json
+
+from typing import List
+
+from programs.p0 import get_program_0_prompt, get_program_4_prompt
+from programs.p3 import PROGRAM_3_PROMPT, get_program_3b_prompt
+from utils.lora import init_chuamiatee
+from utils.prompt_cache import prompt_cache
+
+
+def get_cue_prompts(path: str) -> dict[bool, List[str]]:
+    """
+    Text2img prompts that a cue sheet (requester/data/cues.json) will send,
+    grouped by whether they run with the chua mia tee LoRA.
+    """
+
+    with open(path) as file:
+        cues = json.load(file)
+
+    prompts: dict[bool, List[str]] = {False: [], True: []}
+
+    for cue in cues:
+        action = cue.get("action")
+
+        # transcripts are generated with program 0
+        if action == "transcript" and cue.get("generate"):
+            prompts[False].append(get_program_0_prompt(cue["transcript"]))
+
+        if action != "prompt":
+            continue
+
+        # the ui sends the override to the backend when there is one
+        prompt = cue.get("override") or cue.get("prompt", "")
+        program = cue.get("program")
+
+        if program == "P4":
+            prompts[False].append(get_program_4_prompt(prompt))
+        elif program == "P3B" and prompt:
+            prompts[True].append(get_program_3b_prompt(prompt))
+
+    prompts[True].append(PROGRAM_3_PROMPT)
+
+    return prompts
+
+
+def warm_prompt_cache(path: str):
+    prompts = get_cue_prompts(path)
+    count = 0
+
+    for is_chuamiatee, group in prompts.items():
+        init_chuamiatee(is_chuamiatee)
+        count += prompt_cache.warm(group)
+
+    print(f"prompt cache warmed with {count} cue prompts")
+    prompt_cache.offload_if_covered(count)
@@ -1,37 +1,106 @@
+import random
+
+from functools import partial
+
 import torch
-from utils.pipeline_manager import denoise
-from utils.pipelines import text2img
+from utils.pipeline_manager import Batchable, denoise
+from utils.pipelines import get_pipeline
+from utils.prompt_cache import prompt_cache
+from utils.result_cache import create_key, with_result_cache
 
 WIDTH, HEIGHT = 1360, 768
 PROGRAM_0_STEPS = 30
 PROGRAM_4_STEPS = 30
+PROGRAM_4_PERSONAS = ["data researcher", "crowdworker", "big tech ceo"]
+
+
+def create_batch_pipeline(steps: int, **kwargs):
+    """Runs one text2img call for many prompts, each with its own generator."""
+
+    def pipeline_batch(prompts, on_step_end):
+        text2img = get_pipeline("text2img")
+
+        generators = [
+            torch.Generator(text2img.device).manual_seed(random.getrandbits(32))
+            for _ in prompts
+        ]
+
+        with torch.inference_mode():
+            return text2img(
+                **prompt_cache.get_batch(prompts).as_kwargs(),
+                generator=generators,
+                num_inference_steps=steps,
+                callback_on_step_end=on_step_end,
+                width=WIDTH,
+                height=HEIGHT,
+                **kwargs,
+            )
+
+    return pipeline_batch
+
+
+program_0_batch = create_batch_pipeline(PROGRAM_0_STEPS)
+
+program_4_batch = create_batch_pipeline(
+    PROGRAM_4_STEPS, callback_on_step_end_tensor_inputs=["latents"]
+)
+
+
+def get_program_0_prompt(prompt: str) -> str:
+    return f"{prompt}, photorealistic"
+
+
+def get_program_4_prompt(prompt: str) -> str:
+    if prompt in PROGRAM_4_PERSONAS:
+        return f"{prompt}, photorealistic"
+
+    return prompt
 
 
 async def infer_program_0(prompt: str, conn_id=None):
+    p0_prompt = get_program_0_prompt(prompt)
+
     def pipeline(on_step_end):
+        text2img = get_pipeline("text2img")
+
         with torch.inference_mode():
             return text2img(
-                prompt=f"{prompt}, photorealistic",
+                **prompt_cache.get(p0_prompt).as_kwargs(),
                 num_inference_steps=PROGRAM_0_STEPS,
                 callback_on_step_end=on_step_end,
                 width=WIDTH,
                 height=HEIGHT,
             )
 
-    async for out in denoise(pipeline, final_only=True, conn_id=conn_id):
+    batchable = Batchable(
+        key=("P0", WIDTH, HEIGHT, PROGRAM_0_STEPS),
+        input=p0_prompt,
+        run=program_0_batch,
+    )
+
+    key = create_key("P0", p0_prompt, width=WIDTH, height=HEIGHT)
+    generate = partial(
+        denoise,
+        pipeline,
+        final_only=True,
+        conn_id=conn_id,
+        batchable=batchable,
+        program="P0",
+    )
+
+    async for out in with_result_cache(key, generate, conn_id=conn_id):
         yield out
 
 
 async def infer_program_4(prompt: str, conn_id=None):
-    def pipeline(on_step_end):
-        p4_prompt = prompt
+    p4_prompt = get_program_4_prompt(prompt)
 
-        if prompt in ["data researcher", "crowdworker", "big tech ceo"]:
-            p4_prompt = f"{prompt}, photorealistic"
+    def pipeline(on_step_end):
+        text2img = get_pipeline("text2img")
 
         with torch.inference_mode():
             return text2img(
-                prompt=p4_prompt,
+                **prompt_cache.get(p4_prompt).as_kwargs(),
                 num_inference_steps=PROGRAM_4_STEPS,
                 callback_on_step_end=on_step_end,
                 callback_on_step_end_tensor_inputs=["latents"],
@@ -39,5 +108,16 @@ async def infer_program_4(prompt: str, conn_id=None):
                 height=HEIGHT,
             )
 
-    async for out in denoise(pipeline, conn_id=conn_id):
+    batchable = Batchable(
+        key=("P4", WIDTH, HEIGHT, PROGRAM_4_STEPS),
+        input=p4_prompt,
+        run=program_4_batch,
+    )
+
+    key = create_key("P4", p4_prompt, width=WIDTH, height=HEIGHT)
+    generate = partial(
+        denoise, pipeline, conn_id=conn_id, batchable=batchable, program="P4"
+    )
+
+    async for out in with_result_cache(key, generate, conn_id=conn_id):
         yield out
@@ -1,8 +1,11 @@
 import PIL.Image as PILImage
 
+from functools import partial
+
 import torch
-from utils.pipelines import img2img
+from utils.pipelines import get_pipeline, on_ready
 from utils.pipeline_manager import denoise
+from utils.result_cache import create_key, with_result_cache
 
 STEPS = 50
 PROMPT_2 = "painting like an epic poem of malaya"
@@ -14,14 +17,61 @@ POEM_OF_MALAYA_SIZE = (960, 800)
 MALAYA = PILImage.open("./malaya.png").resize(POEM_OF_MALAYA_SIZE).convert("RGB")
 
 
+# set by precompute() once img2img has loaded
+MALAYA_LATENTS = None
+PROMPT_2_EMBEDS, PROMPT_2_NEGATIVE_EMBEDS = None, None
+PROMPT_2B_EMBEDS, PROMPT_2B_NEGATIVE_EMBEDS = None, None
+
+
+def encode_malaya(img2img):
+    """VAE latents of MALAYA, already scaled so img2img uses them as its init latents."""
+
+    image = img2img.image_processor.preprocess(MALAYA)
+    image = image.to(device=img2img.device, dtype=img2img.vae.dtype)
+
+    # the posterior mode rather than a fresh sample per request, the difference is not visible
+    latents = img2img.vae.encode(image).latent_dist.mode()
+
+    return latents * img2img.vae.config.scaling_factor
+
+
+def encode_prompt(img2img, prompt: str):
+    """Returns (prompt_embeds, negative_prompt_embeds) for classifier-free guidance."""
+
+    return img2img.encode_prompt(
+        prompt,
+        img2img.device,
+        num_images_per_prompt=1,
+        do_classifier_free_guidance=True,
+    )
+
+
+# the image and prompts never change, so only noising and denoising run per request
+def precompute(img2img):
+    global MALAYA_LATENTS
+    global PROMPT_2_EMBEDS, PROMPT_2_NEGATIVE_EMBEDS
+    global PROMPT_2B_EMBEDS, PROMPT_2B_NEGATIVE_EMBEDS
+
+    with torch.inference_mode():
+        MALAYA_LATENTS = encode_malaya(img2img)
+        PROMPT_2_EMBEDS, PROMPT_2_NEGATIVE_EMBEDS = encode_prompt(img2img, PROMPT_2)
+        PROMPT_2B_EMBEDS, PROMPT_2B_NEGATIVE_EMBEDS = encode_prompt(img2img, PROMPT_2B)
+
+
+on_ready("img2img", precompute)
+
+
 async def infer_program_2(strength: float, conn_id=None):
     width, height = POEM_OF_MALAYA_SIZE
 
     def pipeline(on_step_end):
+        img2img = get_pipeline("img2img")
+
         with torch.inference_mode():
             return img2img(
-                image=MALAYA,
-                prompt=PROMPT_2,
+                image=MALAYA_LATENTS,
+                prompt_embeds=PROMPT_2_EMBEDS,
+                negative_prompt_embeds=PROMPT_2_NEGATIVE_EMBEDS,
                 strength=strength,
                 num_inference_steps=STEPS,
                 callback_on_step_end=on_step_end,
@@ -30,7 +80,12 @@ async def infer_program_2(strength: float, conn_id=None):
                 height=height,
             )
 
-    async for out in denoise(pipeline, conn_id=conn_id):
+    key = create_key("P2", PROMPT_2, strength=strength, width=width, height=height)
+    generate = partial(
+        denoise, pipeline, pipeline_name="img2img", conn_id=conn_id, program="P2"
+    )
+
+    async for out in with_result_cache(key, generate, conn_id=conn_id):
         yield out
 
 
@@ -38,10 +93,13 @@ async def infer_program_2_b(strength: float, conn_id=None):
     width, height = POEM_OF_MALAYA_SIZE
 
     def pipeline(on_step_end):
+        img2img = get_pipeline("img2img")
+
         with torch.inference_mode():
             return img2img(
-                prompt=PROMPT_2B,
-                image=MALAYA,
+                image=MALAYA_LATENTS,
+                prompt_embeds=PROMPT_2B_EMBEDS,
+                negative_prompt_embeds=PROMPT_2B_NEGATIVE_EMBEDS,
                 strength=strength,
                 guidance_scale=GUIDANCE_SCALE_2B,
                 num_inference_steps=STEPS,
@@ -51,5 +109,10 @@ async def infer_program_2_b(strength: float, conn_id=None):
                 height=height,
             )
 
-    async for out in denoise(pipeline, conn_id=conn_id):
+    key = create_key("P2B", PROMPT_2B, strength=strength, width=width, height=height)
+    generate = partial(
+        denoise, pipeline, pipeline_name="img2img", conn_id=conn_id, program="P2B"
+    )
+
+    async for out in with_result_cache(key, generate, conn_id=conn_id):
         yield out
@@ -1,24 +1,41 @@
+from functools import partial
+
 import torch
 from utils.chuamiatee_size import get_chuamiatee_size
 from utils.pipeline_manager import denoise
-from utils.pipelines import text2img
+from utils.pipelines import get_pipeline
+from utils.prompt_cache import prompt_cache
+from utils.result_cache import create_key, with_result_cache
+
+PROGRAM_3_PROMPT = " "
+PROGRAM_3_STEPS = 40
+
+
+def get_program_3b_prompt(prompt: str) -> str:
+    return f"{prompt}, photorealistic"
 
 
 # Program 3 pipeline: chua mia tee painting
-async def infer_program_3(prompt: str, strength: float, conn_id=None):
+async def infer_program_3(prompt: str, conn_id=None):
     width, height = get_chuamiatee_size()
 
     def pipeline(on_step_end):
+        text2img = get_pipeline("text2img")
+
         with torch.inference_mode():
             return text2img(
-                prompt=prompt,
-                strength=strength,
-                num_inference_steps=40,
+                **prompt_cache.get(prompt).as_kwargs(),
+                num_inference_steps=PROGRAM_3_STEPS,
                 callback_on_step_end=on_step_end,
                 callback_on_step_end_tensor_inputs=["latents"],
                 width=width,
                 height=height,
             )
 
-    async for out in denoise(pipeline, is_chuamiatee=True, conn_id=conn_id):
+    key = create_key("P3", prompt, width=width, height=height)
+    generate = partial(
+        denoise, pipeline, is_chuamiatee=True, conn_id=conn_id, program="P3"
+    )
+
+    async for out in with_result_cache(key, generate, conn_id=conn_id):
         yield out
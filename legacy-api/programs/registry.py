@@ -0,0 +1,113 @@
+import os
+
+from typing import Any, AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from programs.p0 import infer_program_0, infer_program_4
+from programs.p2 import infer_program_2, infer_program_2_b
+from programs.p3 import PROGRAM_3_PROMPT, get_program_3b_prompt, infer_program_3
+from utils.protocol import Frame
+
+
+class Program(NamedTuple):
+    # the pipeline the program runs on, only loaded when an enabled program needs it
+    pipeline: str
+
+    # start(argument, conn_id) returns the output stream of one request
+    start: Callable[[Any, Optional[str]], AsyncIterator[Frame]]
+
+    # turns the command's text into the argument of start, raises ValueError if it is invalid
+    parse: Callable[[str], Any] = str
+
+    # P3 is sent bare, the others as "P0:<argument>"
+    has_argument: bool = True
+
+
+def parse_strength(argument: str) -> float:
+    """The img2img strength of P2 and P2B, between 0 and 1."""
+
+    strength = float(argument)
+
+    # nan fails the comparison too
+    if not 0 <= strength <= 1:
+        raise ValueError(f"strength must be between 0 and 1: {argument}")
+
+    return strength
+
+
+PROGRAMS: Dict[str, Program] = {
+    "P0": Program(
+        "text2img",
+        lambda prompt, conn_id: infer_program_0(prompt, conn_id=conn_id),
+    ),
+    "P2": Program(
+        "img2img",
+        lambda strength, conn_id: infer_program_2(strength, conn_id=conn_id),
+        parse=parse_strength,
+    ),
+    "P2B": Program(
+        "img2img",
+        lambda strength, conn_id: infer_program_2_b(strength, conn_id=conn_id),
+        parse=parse_strength,
+    ),
+    "P3": Program(
+        "text2img",
+        lambda _, conn_id: infer_program_3(PROGRAM_3_PROMPT, conn_id=conn_id),
+        has_argument=False,
+    ),
+    "P3B": Program(
+        "text2img",
+        lambda prompt, conn_id: infer_program_3(
+            get_program_3b_prompt(prompt), conn_id=conn_id
+        ),
+    ),
+    "P4": Program(
+        "text2img",
+        lambda prompt, conn_id: infer_program_4(prompt, conn_id=conn_id),
+    ),
+}
+
+# comma separated programs this venue runs, the others are refused
+ENABLED_PROGRAMS = [
+    name.strip()
+    for name in os.environ.get("ENABLED_PROGRAMS", ",".join(PROGRAMS)).split(",")
+    if name.strip()
+]
+
+for name in ENABLED_PROGRAMS:
+    if name not in PROGRAMS:
+        raise ValueError(f"unknown program in ENABLED_PROGRAMS: {name}")
+
+
+def get_program_name(command: str) -> str:
+    return command.partition(":")[0]
+
+
+def parse_command(command: str) -> Tuple[str, str]:
+    """Splits "P0:some prompt" into the program name and its argument.
+
+    Raises ValueError if a program is sent without its argument, or P3 with one.
+    """
+
+    name, colon, argument = command.partition(":")
+    argument = argument.strip()
+    program = PROGRAMS.get(name)
+
+    if program is not None and program.has_argument and not argument:
+        raise ValueError(f"{name} needs an argument, as {name}:<argument>")
+
+    if program is not None and not program.has_argument and colon:
+        raise ValueError(f"{name} takes no argument")
+
+    return name, argument
+
+
+def get_required_pipelines() -> List[str]:
+    return list(dict.fromkeys(PROGRAMS[name].pipeline for name in ENABLED_PROGRAMS))
+
+
+def start_program(name: str, argument: str, conn_id: Optional[str]):
+    """The output stream of a program command. Raises ValueError if the argument is invalid."""
+
+    program = PROGRAMS[name]
+
+    return program.start(program.parse(argument), conn_id)
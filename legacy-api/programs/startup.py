@@ -0,0 +1,35 @@
+from typing import List
+
+from programs.cues import warm_prompt_cache
+from programs.registry import get_required_pipelines
+from programs.warmup import warm_pipeline
+from utils.lora import LORA_PRELOAD, load_chuamiatee_lora
+from utils.pipelines import get_preload_pipelines, on_ready, pipelines, start_loading
+from utils.prompt_cache import PROMPT_CACHE_WARMUP_CUES
+
+
+def start_pipelines() -> List[str]:
+    """
+    Installs the warmup hooks and starts loading the pipelines needed at startup.
+
+    Returns the names of the preloaded pipelines. Runs in the server, or in each inference worker.
+    """
+
+    if LORA_PRELOAD:
+        on_ready("text2img", lambda pipe: load_chuamiatee_lora())
+
+    # after the lora hook, so that the lora is warm too
+    for name in pipelines:
+        on_ready(name, lambda pipe, name=name: warm_pipeline(name, pipe))
+
+    # after warmup, whose passes encode their prompt with the text encoders it may offload
+    if PROMPT_CACHE_WARMUP_CUES:
+        on_ready("text2img", lambda pipe: warm_prompt_cache(PROMPT_CACHE_WARMUP_CUES))
+
+    # only the pipelines of enabled programs, the others load on first use if ever
+    preload_pipelines = get_preload_pipelines(get_required_pipelines())
+
+    # connections are accepted right away, jobs wait for the pipeline they need
+    start_loading(preload_pipelines)
+
+    return preload_pipelines
@@ -0,0 +1,134 @@
+import os
+import time
+
+from typing import Dict, List, NamedTuple, Tuple
+
+import PIL.Image as PILImage
+import torch
+
+from programs.p0 import HEIGHT, PROGRAM_0_STEPS, WIDTH
+from programs.p2 import POEM_OF_MALAYA_SIZE, STEPS as PROGRAM_2_STEPS
+from programs.p3 import PROGRAM_3_STEPS
+from programs.registry import ENABLED_PROGRAMS
+from utils.chuamiatee_size import CHUAMIATEE_SIZES
+from utils.encoder import preview_ring, submit_preview
+from utils.lora import LORA_PRELOAD, init_chuamiatee
+
+# "fast" runs a few steps per resolution, "full" runs each program's real step count, "off" skips it
+WARMUP = os.environ.get("WARMUP", "fast")
+WARMUP_FAST_STEPS = int(os.environ.get("WARMUP_FAST_STEPS", "2"))
+
+
+class WarmupBucket(NamedTuple):
+    width: int
+    height: int
+    steps: int
+
+    # the programs that run at this resolution, it is only warmed if one of them is enabled
+    programs: Tuple[str, ...]
+
+    is_chuamiatee: bool = False
+
+
+# every resolution the programs can ask each pipeline for
+WARMUP_BUCKETS: Dict[str, List[WarmupBucket]] = {
+    "text2img": [
+        WarmupBucket(WIDTH, HEIGHT, PROGRAM_0_STEPS, ("P0", "P4")),
+        *(
+            WarmupBucket(
+                width, height, PROGRAM_3_STEPS, ("P3", "P3B"), is_chuamiatee=True
+            )
+            for width, height in CHUAMIATEE_SIZES
+        ),
+    ],
+    "img2img": [WarmupBucket(*POEM_OF_MALAYA_SIZE, PROGRAM_2_STEPS, ("P2", "P2B"))],
+}
+
+# pipeline name -> cold and warm timings of each bucket
+warmup_timings: Dict[str, List[dict]] = {}
+
+
+def run_pass(pipeline_name: str, pipe, bucket: WarmupBucket, steps: int):
+    # exercise the preview transfer and encoder at this resolution too
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        latents = callback_kwargs["latents"]
+
+        # pin the host buffers now rather than during the first requests
+        preview_ring.reserve(latents[:1])
+        preview = submit_preview(latents)
+
+        if preview is not None:
+            preview.result()
+
+        return callback_kwargs
+
+    kwargs = dict(
+        prompt="warmup",
+        num_inference_steps=steps,
+        callback_on_step_end=on_step_end,
+        callback_on_step_end_tensor_inputs=["latents"],
+        width=bucket.width,
+        height=bucket.height,
+    )
+
+    if pipeline_name == "img2img":
+        kwargs["image"] = PILImage.new("RGB", (bucket.width, bucket.height))
+        kwargs["strength"] = 1.0
+
+    with torch.inference_mode():
+        pipe(**kwargs)
+
+
+def timed_pass(pipeline_name: str, pipe, bucket: WarmupBucket, steps: int) -> float:
+    start_time = time.perf_counter()
+    run_pass(pipeline_name, pipe, bucket, steps)
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return time.perf_counter() - start_time
+
+
+def get_warmup_buckets(pipeline_name: str) -> List[WarmupBucket]:
+    """The buckets of enabled programs. The lora ones only if the lora is preloaded anyway."""
+
+    return [
+        bucket
+        for bucket in WARMUP_BUCKETS[pipeline_name]
+        if any(program in ENABLED_PROGRAMS for program in bucket.programs)
+        and (LORA_PRELOAD or not bucket.is_chuamiatee)
+    ]
+
+
+def warm_pipeline(pipeline_name: str, pipe):
+    """Runs a dummy pass per resolution twice, reporting the cold and the warm time."""
+
+    if WARMUP == "off":
+        return
+
+    timings = warmup_timings.setdefault(pipeline_name, [])
+
+    for bucket in get_warmup_buckets(pipeline_name):
+        steps = bucket.steps if WARMUP == "full" else WARMUP_FAST_STEPS
+
+        if pipeline_name == "text2img":
+            init_chuamiatee(bucket.is_chuamiatee)
+
+        cold_seconds = timed_pass(pipeline_name, pipe, bucket, steps)
+        warm_seconds = timed_pass(pipeline_name, pipe, bucket, steps)
+
+        timings.append(
+            {
+                "width": bucket.width,
+                "height": bucket.height,
+                "steps": steps,
+                "lora": bucket.is_chuamiatee,
+                "coldSeconds": cold_seconds,
+                "warmSeconds": warm_seconds,
+            }
+        )
+
+        print(
+            f"warmed {pipeline_name} at {bucket.width}x{bucket.height} ({steps} steps): "
+            f"cold {cold_seconds:.2f}s, warm {warm_seconds:.2f}s"
+        )
@@ -1,19 +1,70 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
 import starlette.websockets
 
+from typing import Optional
+
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 print("starting server")
 
-from programs.p0 import infer_program_0, infer_program_4
-from programs.p2 import infer_program_2, infer_program_2_b
-from programs.p3 import infer_program_3
-from utils.ws import create_send, strip
-from utils.connection_state import handle_socket_connect, handle_socket_disconnect
+from programs.registry import (
+    ENABLED_PROGRAMS,
+    PROGRAMS,
+    get_program_name,
+    get_required_pipelines,
+    parse_command,
+    start_program,
+)
+from programs.startup import start_pipelines
+from programs.warmup import warmup_timings
+from utils.pipeline_manager import cancel_denoise
+from utils.pipelines import get_preload_pipelines, is_ready, pipelines
+from utils.protocol import MAX_JOB_ID, PROTOCOL_V2
+from utils.ws import CommandQueue, create_send, run_writer, send_status, strip
+from utils.connection_state import (
+    MAX_JOBS_PER_CONNECTION,
+    add_job,
+    cancel_job,
+    get_jobs,
+    get_supersede,
+    handle_socket_connect,
+    handle_socket_disconnect,
+    is_role_allowed,
+    set_final_format,
+    set_preview_format,
+    set_protocol,
+    set_role,
+    set_supersede,
+)
+from utils.worker_pool import INFERENCE_WORKERS, create_worker_pool
+
+if INFERENCE_WORKERS:
+    # the pipelines load in the worker processes, this one only serves the websockets
+    preload_pipelines = get_preload_pipelines(get_required_pipelines())
+    worker_pool = create_worker_pool(get_required_pipelines(), preload_pipelines)
+else:
+    preload_pipelines = start_pipelines()
+    worker_pool = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    if worker_pool is not None:
+        worker_pool.start()
 
-app = FastAPI()
+    yield
+
+    if worker_pool is not None:
+        worker_pool.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,50 +75,277 @@ app.add_middleware(
 )
 
 
-@app.websocket("/ws")
-async def websocket_endpoint(sock: WebSocket):
-    await sock.accept()
+def describe_pipelines() -> dict:
+    if worker_pool is not None:
+        return worker_pool.describe_pipelines()
 
-    conn_id = handle_socket_connect(sock)
+    return {
+        name: {**state.describe(), "warmup": warmup_timings.get(name, [])}
+        for name, state in pipelines.items()
+    }
 
-    # this is blocking!
-    # pipelines cannot be interrupted at the moment, aside from disconnection
-    send = create_send(sock)
 
-    while True:
-        try:
-            command = await sock.receive_text()
-            command = command.strip()
+@app.get("/health")
+async def health():
+    if worker_pool is not None:
+        is_healthy = all(worker_pool.is_ready(name) for name in preload_pipelines)
+    else:
+        is_healthy = all(is_ready(name) for name in preload_pipelines)
+
+    body = {
+        "ready": is_healthy,
+        "programs": ENABLED_PROGRAMS,
+        "pipelines": describe_pipelines(),
+    }
+
+    if worker_pool is not None:
+        body["workers"] = [worker.describe() for worker in worker_pool.workers]
+
+    return JSONResponse(body, status_code=200 if is_healthy else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    if worker_pool is not None:
+        await worker_pool.update_metrics()
+
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# program commands that can interrupt the previous generation in supersede mode
+SUPERSEDING_COMMANDS = ("P0:", "P4:")
+
+
+def is_superseding(command: str) -> bool:
+    return command.startswith(SUPERSEDING_COMMANDS)
+
+
+def create_generation(command: str, conn_id: str):
+    """Returns the output stream of an enabled program command, or None if it is not one."""
+
+    name = get_program_name(command)
+
+    if name not in ENABLED_PROGRAMS:
+        return None
+
+    try:
+        _, argument = parse_command(command)
+        PROGRAMS[name].parse(argument)
+    except ValueError as error:
+        print(f"invalid {name} command: {error}")
+        return None
+
+    if worker_pool is not None:
+        return worker_pool.run(command, conn_id, PROGRAMS[name].pipeline)
+
+    return start_program(name, argument, conn_id)
+
+
+def refuse_command(sock: WebSocket, command: str, job_id: int = 0):
+    name = get_program_name(command)
+
+    if name in ENABLED_PROGRAMS:
+        send_status(sock, f"invalid command: {command}", job_id)
+    elif name in PROGRAMS:
+        send_status(sock, f"program disabled: {name}", job_id)
+    else:
+        send_status(sock, f"unknown command: {command}", job_id)
+
+
+async def run_job(coroutine):
+    try:
+        await coroutine
+    except starlette.websockets.WebSocketDisconnect:
+        # the handler finds out on its next receive
+        pass
+    except Exception as error:
+        print(f"job failed: {error}")
+
+
+def parse_job_id(job_id: str) -> Optional[int]:
+    # isdigit() alone also accepts digits such as "²", which int() refuses
+    if not (job_id.isascii() and job_id.isdigit()) or not 0 < int(job_id) <= MAX_JOB_ID:
+        return None
+
+    return int(job_id)
+
+
+def start_job(sock: WebSocket, send, conn_id: str, job: str):
+    """Runs J:<id>:<command> alongside the connection's other jobs."""
+
+    raw_id, _, command = job.partition(":")
+    job_id = parse_job_id(raw_id)
+
+    # protocol 1 frames carry no job id, so their streams could not be told apart
+    if sock.state.protocol != PROTOCOL_V2:
+        send_status(sock, "jobs need protocol 2")
+        return
 
-            if command.startswith("P0:"):
-                prompt = strip(command, "P0")
-                await send(infer_program_0(prompt, conn_id=conn_id))
+    if job_id is None:
+        send_status(sock, f"unknown job: {raw_id}")
+        return
 
-            elif command.startswith("P2:"):
-                strength = float(strip(command, "P2"))
-                await send(infer_program_2(strength, conn_id=conn_id))
+    jobs = get_jobs(conn_id)
 
-            elif command.startswith("P2B:"):
-                strength = float(strip(command, "P2B"))
-                await send(infer_program_2_b(strength, conn_id=conn_id))
+    if job_id in jobs:
+        send_status(sock, f"job in use: {job_id}", job_id)
+        return
 
-            elif command == "P3":
-                await send(infer_program_3(" ", 5.5, conn_id=conn_id))
+    generator = create_generation(command, conn_id)
 
-            elif command.startswith("P3B:"):
-                prompt = strip(command, "P3B")
-                await send(
-                    infer_program_3(f"{prompt}, photorealistic", 5.5, conn_id=conn_id)
-                )
+    if generator is None:
+        refuse_command(sock, command, job_id)
+        return
 
-            elif command.startswith("P4:"):
-                prompt = strip(command, "P4")
-                await send(infer_program_4(prompt, conn_id=conn_id))
+    if get_supersede(conn_id) and is_superseding(command):
+        for other_id, other in list(jobs.items()):
+            if is_superseding(other.command):
+                cancel_job(conn_id, other_id)
+
+    if len(jobs) >= MAX_JOBS_PER_CONNECTION:
+        send_status(sock, "jobs:full", job_id)
+        return
+
+    add_job(
+        conn_id, job_id, command, asyncio.create_task(run_job(send(generator, job_id)))
+    )
+
+
+def handle_command(
+    sock: WebSocket, send, conn_id: str, commands: CommandQueue, command: str
+):
+    """Dispatches one command of the connection, without waiting for its generation."""
+
+    # the ui's keepalive sends a lowercase ping, like the serverless apps answer
+    if command in ("PING", "ping"):
+        send_status(sock, "pong")
+        return
+
+    if command == "CANCEL":
+        cancel_denoise(conn_id)
+
+        # streams without a denoiser, such as cached replays, only stop with their task
+        commands.cancel_running()
+        commands.cancel_pending()
+
+        for job_id in list(get_jobs(conn_id)):
+            cancel_job(conn_id, job_id)
+
+        return
+
+    # CANCEL:<id> stops a single job started with J:<id>:
+    if command.startswith("CANCEL:"):
+        job_id = parse_job_id(strip(command, "CANCEL"))
+
+        if job_id is None or cancel_job(conn_id, job_id) is None:
+            send_status(sock, f"unknown job: {strip(command, 'CANCEL')}")
+
+        return
+
+    if command.startswith("J:"):
+        start_job(sock, send, conn_id, command[len("J:") :])
+        return
+
+    # ROLE:presenter:<token> or ROLE:kiosk, presenters are scheduled ahead of kiosks
+    if command.startswith("ROLE:"):
+        role, _, token = strip(command, "ROLE").partition(":")
+
+        if not is_role_allowed(role, token):
+            send_status(sock, f"forbidden role: {role}")
+        elif not set_role(conn_id, role):
+            send_status(sock, f"unknown role: {role}")
+
+        return
+
+    # PROTOCOL:2 switches to binary frames, PROTOCOL:1 is the default
+    if command.startswith("PROTOCOL:"):
+        protocol = strip(command, "PROTOCOL")
+
+        is_number = protocol.isascii() and protocol.isdigit()
+
+        if is_number and set_protocol(conn_id, int(protocol)):
+            send_status(sock, f"protocol:{protocol}")
+        else:
+            send_status(sock, f"unknown protocol: {protocol}")
+
+        return
+
+    # PREVIEW:webp,quality=60,size=512 picks the preview encoding,
+    # and PREVIEW:rgb or PREVIEW:latent sends raw previews for the client to render
+    if command.startswith("PREVIEW:"):
+        preview_format = strip(command, "PREVIEW")
+
+        if set_preview_format(conn_id, preview_format):
+            send_status(sock, f"preview:{preview_format}")
+        else:
+            send_status(sock, f"unknown preview format: {preview_format}")
+
+        return
+
+    # FINAL:png or FINAL:jpeg,quality=90 picks the final image encoding
+    if command.startswith("FINAL:"):
+        final_format = strip(command, "FINAL")
+
+        if set_final_format(conn_id, final_format):
+            send_status(sock, f"final:{final_format}")
+        else:
+            send_status(sock, f"unknown final format: {final_format}")
+
+        return
+
+    # SUPERSEDE:on makes a new P0 or P4 prompt cancel the one in progress
+    if command.startswith("SUPERSEDE:"):
+        mode = strip(command, "SUPERSEDE")
+
+        if set_supersede(conn_id, mode):
+            send_status(sock, f"supersede:{mode}")
+        else:
+            send_status(sock, f"unknown supersede mode: {mode}")
+
+        return
+
+    generator = create_generation(command, conn_id)
+
+    if generator is None:
+        refuse_command(sock, command)
+        return
+
+    # only the connection's other P0 and P4 commands, not its J: jobs or other programs
+    if commands.is_busy and get_supersede(conn_id):
+        if is_superseding(command):
+            commands.cancel_running(is_superseding)
+            commands.cancel_pending(is_superseding)
+
+    if not commands.put(command, generator):
+        send_status(sock, "jobs:full")
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(sock: WebSocket):
+    await sock.accept()
+
+    conn_id = handle_socket_connect(sock)
+    send = create_send(sock)
+
+    # this loop only reads and dispatches commands, generations and writes run on their own tasks
+    writer = asyncio.create_task(run_writer(sock))
+    commands = CommandQueue(send, max_size=MAX_JOBS_PER_CONNECTION)
+
+    try:
+        while True:
+            command = await sock.receive_text()
+            command = command.strip()
 
-            else:
-                await sock.send_text(f"unknown command: {command}")
-        except starlette.websockets.WebSocketDisconnect:
-            handle_socket_disconnect(sock)
+            try:
+                handle_command(sock, send, conn_id, commands, command)
+            except Exception as error:
+                # a malformed command must not take the connection down with it
+                print(f"failed to handle {command!r}: {error}")
+                send_status(sock, f"invalid command: {command}")
+    except starlette.websockets.WebSocketDisconnect:
+        print("client disconnected.")
+    finally:
+        commands.close()
+        writer.cancel()
 
-            print("client disconnected.")
-            break
+        handle_socket_disconnect(sock)
@@ -0,0 +1,117 @@
+import math
+import unittest
+
+import numpy as np
+
+from utils.delta import DeltaDecoder, DeltaEncoder, dequantize, get_top, quantize
+from utils.protocol import (
+    DELTA_HEADER,
+    DELTA_KEYFRAME,
+    DELTA_PREVIOUS,
+    DELTA_TREND,
+    RGB_HEADER,
+)
+
+
+def to_rgb_bytes(frame: np.ndarray) -> bytes:
+    height, width, _ = frame.shape
+
+    return RGB_HEADER.pack(width, height) + frame.tobytes()
+
+
+def create_frames(count: int, width: int = 40, height: int = 24, seed: int = 0):
+    """Noise that fades into a gradient, like the previews of a denoising run."""
+
+    random = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width * height * 3).reshape(height, width, 3)
+    noise = random.uniform(0, 255, (height, width, 3))
+
+    for index in range(count):
+        progress = index / max(count - 1, 1)
+        yield (gradient * progress + noise * (1 - progress)).astype(np.uint8)
+
+
+class DeltaTest(unittest.TestCase):
+    def round_trip(self, frames, encoder: DeltaEncoder):
+        decoder = DeltaDecoder()
+        kinds = []
+
+        for frame in frames:
+            payload = encoder.encode(to_rgb_bytes(frame))
+            kinds.append(DELTA_HEADER.unpack_from(payload)[0])
+
+            width, height, rgb = decoder.decode(payload)
+            values = quantize(frame, encoder.quantization)
+
+            self.assertEqual((width, height), (frame.shape[1], frame.shape[0]))
+            self.assertEqual(rgb, dequantize(values, encoder.quantization))
+
+        return kinds
+
+    def test_lossless(self):
+        encoder = DeltaEncoder(quantization=1)
+        frames = list(create_frames(10))
+        decoder = DeltaDecoder()
+
+        for frame in frames:
+            _, _, rgb = decoder.decode(encoder.encode(to_rgb_bytes(frame)))
+            self.assertEqual(rgb, frame.tobytes())
+
+    def test_quantized(self):
+        for quantization in (2, 4, 6, 7, 16):
+            with self.subTest(quantization=quantization):
+                kinds = self.round_trip(
+                    create_frames(8), DeltaEncoder(quantization=quantization)
+                )
+
+                self.assertEqual(kinds[0], DELTA_KEYFRAME)
+                self.assertIn(DELTA_TREND, kinds)
+
+    def test_keyframe_interval(self):
+        kinds = self.round_trip(
+            create_frames(12), DeltaEncoder(keyframe_interval=5, quantization=4)
+        )
+
+        self.assertEqual(kinds[0], DELTA_KEYFRAME)
+        self.assertEqual(kinds[5], DELTA_KEYFRAME)
+        self.assertEqual(kinds[10], DELTA_KEYFRAME)
+
+    def test_static_frames(self):
+        frame = next(create_frames(1))
+        kinds = self.round_trip([frame] * 4, DeltaEncoder(quantization=4))
+
+        self.assertEqual(kinds[:2], [DELTA_KEYFRAME, DELTA_PREVIOUS])
+
+    def test_size_change_sends_a_keyframe(self):
+        frames = [*create_frames(3), *create_frames(3, width=32, height=32)]
+        kinds = self.round_trip(frames, DeltaEncoder(quantization=4))
+
+        self.assertEqual(kinds[3], DELTA_KEYFRAME)
+
+    def test_top_matches_the_browser(self):
+        for quantization in range(1, 256):
+            with self.subTest(quantization=quantization):
+                # Math.round(255 / q) in ui/src/utils/delta-preview.ts
+                top = math.floor(255 / quantization + 0.5)
+
+                self.assertEqual(get_top(quantization), top)
+                self.assertEqual(quantize(np.uint8(255), quantization), top)
+
+    def test_trend_clamped_at_white(self):
+        # 255 / 6 is 42.5, where rounding half to even and half up disagree
+        frames = [np.full((8, 8, 3), value, np.uint8) for value in (243, 249, 255, 255)]
+        kinds = self.round_trip(frames, DeltaEncoder(quantization=6))
+
+        self.assertEqual(kinds[2:], [DELTA_TREND, DELTA_TREND])
+
+    def test_delta_without_keyframe(self):
+        frames = create_frames(10)
+        encoder = DeltaEncoder(quantization=4)
+        encoder.encode(to_rgb_bytes(next(frames)))
+
+        with self.assertRaises(ValueError):
+            DeltaDecoder().decode(encoder.encode(to_rgb_bytes(next(frames))))
+
+
+if __name__ == "__main__":
+    unittest.main()
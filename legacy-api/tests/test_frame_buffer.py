@@ -0,0 +1,88 @@
+import asyncio
+import unittest
+import concurrent.futures
+
+from utils.frame_buffer import FrameBuffer
+from utils.protocol import (
+    DONE,
+    image_frame,
+    preview_frame,
+    progress_frame,
+    status_frame,
+)
+
+
+def drain(buffer: FrameBuffer) -> list:
+    async def get_all():
+        return [await buffer.get() for _ in range(len(buffer.frames))]
+
+    return asyncio.run(get_all())
+
+
+class FrameBufferTest(unittest.TestCase):
+    def test_only_previews_are_dropped(self):
+        drops = []
+        buffer = FrameBuffer(max_previews=1, on_drop=lambda: drops.append(1))
+
+        frames = [
+            status_frame("q:pos=1"),
+            preview_frame(0, 999, b"0"),
+            progress_frame(1, 900),
+            preview_frame(2, 800, b"2"),
+            preview_frame(3, 700, b"3"),
+            image_frame(b"image"),
+            DONE,
+            None,
+        ]
+
+        for frame in frames:
+            buffer.put(frame)
+
+        # the superseded previews leave their progress markers behind
+        self.assertEqual(
+            drain(buffer),
+            [
+                status_frame("q:pos=1"),
+                progress_frame(0, 999),
+                progress_frame(1, 900),
+                progress_frame(2, 800),
+                preview_frame(3, 700, b"3"),
+                image_frame(b"image"),
+                DONE,
+                None,
+            ],
+        )
+        self.assertEqual(len(drops), 2)
+
+    def test_sent_previews_free_their_slot(self):
+        buffer = FrameBuffer(max_previews=1)
+
+        buffer.put(preview_frame(0, 999, b"0"))
+        self.assertEqual(drain(buffer), [preview_frame(0, 999, b"0")])
+
+        buffer.put(preview_frame(1, 900, b"1"))
+        self.assertEqual(drain(buffer), [preview_frame(1, 900, b"1")])
+
+    def test_dropped_encodes_are_cancelled(self):
+        buffer = FrameBuffer(max_previews=1)
+        pending = concurrent.futures.Future()
+
+        buffer.put(preview_frame(0, 999, pending))
+        buffer.put(preview_frame(1, 900, b"1"))
+
+        self.assertTrue(pending.cancelled())
+
+    def test_recorded_encodes_are_kept(self):
+        # a recording still needs the encode of a preview the client never gets
+        buffer = FrameBuffer(max_previews=1, cancel_dropped=False)
+        pending = concurrent.futures.Future()
+
+        buffer.put(preview_frame(0, 999, pending))
+        buffer.put(preview_frame(1, 900, b"1"))
+
+        self.assertFalse(pending.cancelled())
+        self.assertEqual(drain(buffer)[0], progress_frame(0, 999))
+
+
+if __name__ == "__main__":
+    unittest.main()
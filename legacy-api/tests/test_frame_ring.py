@@ -0,0 +1,85 @@
+import unittest
+
+from utils.frame_ring import FrameRing
+
+
+class FrameRingTest(unittest.TestCase):
+    def setUp(self):
+        # the server owns the shared memory, the worker attaches to it by name
+        self.reader = FrameRing(size=16)
+        self.writer = FrameRing(self.reader.name, self.reader.size)
+
+        self.addCleanup(self.reader.close)
+        self.addCleanup(self.writer.close)
+
+    def test_round_trip(self):
+        first = self.writer.write(b"hello")
+        second = self.writer.write(b"world")
+
+        self.assertEqual(first, (0, 5))
+        self.assertEqual(second, (5, 5))
+        self.assertEqual(self.reader.read(*first), b"hello")
+        self.assertEqual(self.reader.read(*second), b"world")
+
+    def test_wraps_to_the_start(self):
+        self.reader.read(*self.writer.write(b"a" * 10))
+
+        # 6 bytes are left before the end, so the payload starts over at offset 0
+        location = self.writer.write(b"b" * 10)
+
+        self.assertEqual(location, (16, 10))
+        self.assertEqual(self.reader.read(*location), b"b" * 10)
+
+        # positions keep growing across laps
+        location = self.writer.write(b"c" * 6)
+
+        self.assertEqual(location, (26, 6))
+        self.assertEqual(self.reader.read(*location), b"c" * 6)
+
+    def test_full_ring(self):
+        first = self.writer.write(b"a" * 10)
+
+        # the skip to the start would run into the unread payload
+        self.assertIsNone(self.writer.write(b"b" * 10))
+        self.assertIsNone(self.writer.write(b"b" * 7))
+
+        # a payload that fits behind it still goes in
+        second = self.writer.write(b"b" * 6)
+        self.assertEqual(second, (10, 6))
+
+        self.assertIsNone(self.writer.write(b"c"))
+
+        # reading frees the space again
+        self.assertEqual(self.reader.read(*first), b"a" * 10)
+        third = self.writer.write(b"c" * 10)
+
+        self.assertEqual(third, (16, 10))
+        self.assertEqual(self.reader.read(*second), b"b" * 6)
+        self.assertEqual(self.reader.read(*third), b"c" * 10)
+
+    def test_whole_ring(self):
+        location = self.writer.write(b"a" * 16)
+
+        self.assertEqual(location, (0, 16))
+        self.assertIsNone(self.writer.write(b"b"))
+        self.assertIsNone(self.writer.write(b"b" * 17))
+
+        self.reader.read(*location)
+        self.assertEqual(self.writer.write(b"b"), (16, 1))
+
+    def test_reset(self):
+        self.writer.write(b"a" * 16)
+
+        # a restarted worker attaches a new writer to the same memory
+        self.reader.reset()
+        writer = FrameRing(self.reader.name, self.reader.size)
+        self.addCleanup(writer.close)
+
+        location = writer.write(b"b" * 16)
+
+        self.assertEqual(location, (0, 16))
+        self.assertEqual(self.reader.read(*location), b"b" * 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
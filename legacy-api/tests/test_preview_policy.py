@@ -0,0 +1,88 @@
+import unittest
+
+from unittest import mock
+
+from utils import preview_policy
+from utils.preview_policy import PreviewPolicy
+
+# binary fractions, so the budgets add up exactly
+STEP_SECONDS = 0.125
+
+
+class PreviewPolicyTest(unittest.TestCase):
+    """Steps a policy on a fake clock, STEP_SECONDS apart."""
+
+    def setUp(self):
+        self.now = 0.0
+
+        patch = mock.patch.object(
+            preview_policy.time, "perf_counter", side_effect=lambda: self.now
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_steps(self, policy: PreviewPolicy, steps=10, cost=None) -> list:
+        """The indices of the steps that got a preview."""
+
+        previews = []
+
+        for index in range(steps):
+            if policy.should_preview():
+                previews.append(index)
+
+                if cost is not None:
+                    policy.record_cost(cost)
+
+            self.now += STEP_SECONDS
+
+        return previews
+
+    def test_every(self):
+        self.assertEqual(self.run_steps(PreviewPolicy("every")), list(range(10)))
+
+    def test_nth(self):
+        policy = PreviewPolicy("nth", every_n=3)
+
+        self.assertEqual(self.run_steps(policy), [0, 3, 6, 9])
+
+    def test_nth_of_zero_is_every(self):
+        policy = PreviewPolicy("nth", every_n=0)
+
+        self.assertEqual(self.run_steps(policy), list(range(10)))
+
+    def test_fps(self):
+        # 4 previews a second at 8 steps a second
+        policy = PreviewPolicy("fps", fps=4)
+
+        self.assertEqual(self.run_steps(policy), [0, 2, 4, 6, 8])
+
+    def test_adaptive_before_a_cost_is_known(self):
+        policy = PreviewPolicy("adaptive", max_cost=0.25)
+
+        self.assertEqual(self.run_steps(policy), list(range(10)))
+
+    def test_adaptive_budget(self):
+        # each step earns 1/32s of preview time, a preview costs 1/16s
+        policy = PreviewPolicy("adaptive", max_cost=0.25)
+
+        self.assertEqual(self.run_steps(policy, cost=1 / 16), [0, 2, 4, 6, 8])
+
+    def test_adaptive_slower_steps(self):
+        # twice the share of the step time earns a preview on every step
+        policy = PreviewPolicy("adaptive", max_cost=0.5)
+
+        self.assertEqual(self.run_steps(policy, cost=1 / 16), list(range(10)))
+
+    def test_adaptive_cheap_previews(self):
+        policy = PreviewPolicy("adaptive", max_cost=0.25)
+
+        self.assertEqual(self.run_steps(policy, cost=1 / 64), list(range(10)))
+
+    def test_first_step_always_previews(self):
+        for policy in ["nth", "fps", "adaptive"]:
+            with self.subTest(policy=policy):
+                self.assertTrue(PreviewPolicy(policy).should_preview())
+
+
+if __name__ == "__main__":
+    unittest.main()
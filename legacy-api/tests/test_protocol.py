@@ -0,0 +1,94 @@
+import struct
+import unittest
+
+from utils.protocol import (
+    DONE,
+    ENCODING_JPEG,
+    ENCODING_TEXT,
+    ENCODING_WEBP,
+    FRAME_PREVIEW,
+    FRAME_STATUS,
+    IMAGE_ENCODINGS,
+    MAX_JOB_ID,
+    PROTOCOL_V2,
+    READY,
+    V2_HEADER,
+    ImageFormat,
+    encode_v1,
+    encode_v2,
+    image_frame,
+    parse_image_format,
+    preview_frame,
+    progress_frame,
+    status_frame,
+)
+
+
+def decode_v2(message: bytes):
+    return V2_HEADER.unpack_from(message), message[V2_HEADER.size :]
+
+
+class EncodeV2Test(unittest.TestCase):
+    def test_header(self):
+        header, payload = decode_v2(encode_v2(preview_frame(3, 981.6, b"jpeg"), 7))
+
+        self.assertEqual(V2_HEADER.size, 12)
+        self.assertEqual(header, (PROTOCOL_V2, FRAME_PREVIEW, 7, 3, 981, ENCODING_JPEG))
+        self.assertEqual(payload, b"jpeg")
+
+    def test_little_endian(self):
+        message = encode_v2(progress_frame(0x0102, 0x0304), 0x05060708)
+
+        self.assertEqual(message, b"\x02\x02\x08\x07\x06\x05\x02\x01\x04\x03\x00\x00")
+
+    def test_status_text(self):
+        header, payload = decode_v2(encode_v2(status_frame("q:pos=1"), 0))
+
+        self.assertEqual(header[1], FRAME_STATUS)
+        self.assertEqual(header[5], ENCODING_TEXT)
+        self.assertEqual(payload, b"q:pos=1")
+
+    def test_job_ids(self):
+        header, _ = decode_v2(encode_v2(DONE, MAX_JOB_ID))
+        self.assertEqual(header[2], MAX_JOB_ID)
+
+        with self.assertRaises(struct.error):
+            encode_v2(DONE, MAX_JOB_ID + 1)
+
+
+class EncodeV1Test(unittest.TestCase):
+    def test_messages(self):
+        self.assertEqual(encode_v1(READY), ["ready"])
+        self.assertEqual(encode_v1(progress_frame(2, 960)), ["p:s=2:t=960"])
+        self.assertEqual(
+            encode_v1(preview_frame(2, 960, b"jpeg")), ["p:s=2:t=960", b"jpeg"]
+        )
+        self.assertEqual(encode_v1(image_frame(b"jpeg")), [b"jpeg"])
+        self.assertEqual(encode_v1(status_frame("pong")), ["pong"])
+        self.assertEqual(encode_v1(DONE), ["done"])
+
+
+class ParseImageFormatTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(
+            parse_image_format("webp,quality=60,size=512", IMAGE_ENCODINGS),
+            ImageFormat(ENCODING_WEBP, 60, 512),
+        )
+        self.assertEqual(parse_image_format("jpeg", IMAGE_ENCODINGS), ImageFormat())
+
+    def test_invalid(self):
+        for text in [
+            "gif",
+            "rgb",
+            "jpeg,quality=0",
+            "jpeg,quality=101",
+            "jpeg,size=0",
+            "jpeg,size=²",
+            "jpeg,speed=1",
+        ]:
+            with self.subTest(text=text):
+                self.assertIsNone(parse_image_format(text, IMAGE_ENCODINGS))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+import torch
+
+from utils.latents import latents_to_rgb_bytes, latents_to_rgb_tensor, quantize_latents
+from utils.protocol import LATENT_HEADER, RGB_HEADER, V2_HEADER
+
+
+def create_latents(width=12, height=8) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(0)
+
+    return torch.randn(2, 4, height, width, generator=generator)
+
+
+class RawPreviewTest(unittest.TestCase):
+    def test_rgb(self):
+        latents = create_latents()
+        payload = latents_to_rgb_bytes(latents)
+
+        width, height = RGB_HEADER.unpack_from(payload)
+        pixels = np.frombuffer(payload, np.uint8, offset=RGB_HEADER.size)
+
+        self.assertEqual((width, height), (12, 8))
+        np.testing.assert_array_equal(
+            pixels.reshape(height, width, 3), latents_to_rgb_tensor(latents)[0].numpy()
+        )
+
+    def test_latent(self):
+        latents = create_latents()
+        payload = quantize_latents(latents)
+
+        channels, width, height = LATENT_HEADER.unpack_from(payload)
+        self.assertEqual((channels, width, height), (4, 12, 8))
+
+        # the parameters can be viewed in place after either protocol's prefix
+        for prefix in (0, V2_HEADER.size):
+            self.assertEqual((prefix + LATENT_HEADER.size) % 4, 0)
+
+        parameters = np.frombuffer(
+            payload, "<f4", count=channels * 2, offset=LATENT_HEADER.size
+        ).reshape(channels, 2)
+        values = np.frombuffer(
+            payload, np.uint8, offset=LATENT_HEADER.size + parameters.nbytes
+        ).reshape(channels, height, width)
+
+        offsets, scales = parameters[:, 0], parameters[:, 1]
+        decoded = offsets[:, None, None] + values * scales[:, None, None]
+
+        # rounding to the nearest value is off by at most half a step
+        error = np.abs(decoded - latents[0].numpy())
+        self.assertTrue((error <= scales[:, None, None] / 2 + 1e-5).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from programs.registry import parse_command, parse_strength
+
+
+class ParseCommandTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(parse_command("P0: a cat "), ("P0", "a cat"))
+        self.assertEqual(parse_command("P0:a cat: sitting"), ("P0", "a cat: sitting"))
+        self.assertEqual(parse_command("P3"), ("P3", ""))
+
+    def test_missing_argument(self):
+        for command in ["P0", "P0:", "P0:   ", "P3B", "P2:"]:
+            with self.subTest(command=command), self.assertRaises(ValueError):
+                parse_command(command)
+
+    def test_argument_to_p3(self):
+        for command in ["P3:", "P3:a cat"]:
+            with self.subTest(command=command), self.assertRaises(ValueError):
+                parse_command(command)
+
+    def test_unknown_program(self):
+        # refused by the server as unknown, not as invalid
+        self.assertEqual(parse_command("P9"), ("P9", ""))
+
+
+class ParseStrengthTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(parse_strength("0"), 0)
+        self.assertEqual(parse_strength("0.35"), 0.35)
+        self.assertEqual(parse_strength("1"), 1)
+
+    def test_invalid(self):
+        for argument in ["nan", "inf", "-inf", "-0.1", "1.5", "strong"]:
+            with self.subTest(argument=argument), self.assertRaises(ValueError):
+                parse_strength(argument)
+
+
+if __name__ == "__main__":
+    unittest.main()
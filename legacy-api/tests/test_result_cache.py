@@ -0,0 +1,93 @@
+import asyncio
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from utils import result_cache
+from utils.protocol import image_frame, progress_frame
+from utils.result_cache import ResultCache, create_key, with_result_cache
+
+FRAMES = [progress_frame(0, 999), progress_frame(1, 500), image_frame(b"image")]
+
+
+async def generate(recording=None):
+    for frame in FRAMES:
+        if recording is not None:
+            recording.append(frame)
+
+        yield frame
+
+
+async def collect(key):
+    return [frame async for frame in with_result_cache(key, generate, "conn")]
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+        patches = [
+            mock.patch.object(result_cache, "RESULT_CACHE", True),
+            mock.patch.object(result_cache, "RESULT_CACHE_REPLAY_STEP_MS", 0),
+            mock.patch.object(result_cache, "get_is_connected", return_value=True),
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def use_cache(self, directory: Path, disk_bytes: int = 1 << 20):
+        cache = ResultCache(directory, memory_entries=4, disk_bytes=disk_bytes)
+        patch = mock.patch.object(result_cache, "result_cache", cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        return cache
+
+    def test_disk_replay(self):
+        self.use_cache(self.directory)
+        key = create_key("P0", "a cat")
+
+        self.assertEqual(asyncio.run(collect(key)), FRAMES)
+
+        # a new process only has the disk tier
+        cache = self.use_cache(self.directory)
+
+        self.assertEqual(asyncio.run(collect(key)), FRAMES)
+        self.assertEqual(cache.hits, 1)
+
+    def test_disk_errors_are_misses(self):
+        # a file where the directory should be fails every read and write
+        blocked = self.directory / "blocked"
+        blocked.write_bytes(b"")
+        cache = self.use_cache(blocked / "results")
+
+        key = create_key("P0", "a cat")
+
+        self.assertEqual(asyncio.run(collect(key)), FRAMES)
+        self.assertEqual(cache.misses, 1)
+
+        # the memory tier still has it
+        self.assertEqual(asyncio.run(collect(key)), FRAMES)
+        self.assertEqual(cache.hits, 1)
+
+    def test_eviction_skips_entries_removed_meanwhile(self):
+        cache = self.use_cache(self.directory, disk_bytes=0)
+        gone = self.directory / "gone.frames"
+        glob = Path.glob
+
+        def glob_with_gone(path, pattern):
+            return [*glob(path, pattern), gone]
+
+        with mock.patch.object(Path, "glob", glob_with_gone):
+            cache.write_disk(create_key("P0", "a cat"), FRAMES)
+
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
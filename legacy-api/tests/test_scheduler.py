@@ -0,0 +1,146 @@
+import threading
+import unittest
+
+from unittest import mock
+
+from utils import scheduler
+from utils.scheduler import PRIORITY_KIOSK, PRIORITY_PRESENTER, PipelineScheduler
+
+TIMEOUT = 5
+
+
+class SchedulerTest(unittest.TestCase):
+    """Runs stub jobs on a scheduler, while a first job holds its worker busy."""
+
+    def setUp(self):
+        self.scheduler = PipelineScheduler("test")
+        self.order = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+        def block():
+            self.started.set()
+            self.release.wait(TIMEOUT)
+
+        self.blocker = self.scheduler.submit(block, conn_id="blocker", group="on")
+        self.assertTrue(self.started.wait(TIMEOUT))
+
+    def tearDown(self):
+        self.release.set()
+
+    def submit(self, name: str, conn_id: str, **kwargs):
+        return self.scheduler.submit(
+            lambda: self.order.append(name), conn_id=conn_id, **kwargs
+        )
+
+    def run_all(self, futures):
+        self.release.set()
+
+        for future in futures:
+            if not future.cancelled():
+                future.result(TIMEOUT)
+
+    def test_connections_take_turns(self):
+        futures = [
+            self.submit("a1", "a", group="on"),
+            self.submit("a2", "a", group="on"),
+            self.submit("a3", "a", group="on"),
+            self.submit("b1", "b", group="on"),
+            self.submit("b2", "b", group="on"),
+        ]
+
+        self.run_all(futures)
+
+        self.assertEqual(self.order, ["a1", "b1", "a2", "b2", "a3"])
+
+    def test_presenters_go_first(self):
+        futures = [
+            self.submit("kiosk", "a", priority=PRIORITY_KIOSK, group="on"),
+            self.submit("presenter", "b", priority=PRIORITY_PRESENTER, group="on"),
+        ]
+
+        self.run_all(futures)
+
+        self.assertEqual(self.order, ["presenter", "kiosk"])
+
+    @mock.patch.object(scheduler, "MAX_GROUP_RUN", 2)
+    def test_group_runs_are_bounded(self):
+        futures = [
+            self.submit("a1", "a", group="on"),
+            self.submit("a2", "a", group="on"),
+            self.submit("a3", "a", group="on"),
+            self.submit("b1", "b", group="off"),
+            self.submit("b2", "b", group="off"),
+            self.submit("b3", "b", group="off"),
+        ]
+
+        self.run_all(futures)
+
+        # the blocker and a1 make a run of two, then b1 and b2 make the next one
+        self.assertEqual(self.order, ["a1", "b1", "b2", "a2", "a3", "b3"])
+
+    def test_group_skips_ahead_of_other_connections(self):
+        futures = [
+            self.submit("b1", "b", group="off"),
+            self.submit("a1", "a", group="on"),
+        ]
+
+        self.run_all(futures)
+
+        self.assertEqual(self.order, ["a1", "b1"])
+
+    def test_cancel_pending(self):
+        cancelled = self.submit("a1", "a")
+        kept = self.submit("a2", "a")
+
+        self.assertTrue(self.scheduler.cancel_pending(cancelled))
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(self.scheduler.pending_count, 1)
+
+        # the running job and the cancelled one are no longer pending
+        self.assertFalse(self.scheduler.cancel_pending(self.blocker))
+        self.assertFalse(self.scheduler.cancel_pending(cancelled))
+
+        self.run_all([cancelled, kept])
+
+        self.assertEqual(self.order, ["a2"])
+
+    def test_cancel_pending_moves_later_jobs_up(self):
+        positions = {"a1": [], "b1": []}
+
+        def submit(name, conn_id):
+            return self.scheduler.submit(
+                lambda: None,
+                conn_id=conn_id,
+                on_position=positions[name].append,
+            )
+
+        first = submit("a1", "a")
+        second = submit("b1", "b")
+
+        self.scheduler.cancel_pending(first)
+        self.run_all([second])
+
+        self.assertEqual(positions, {"a1": [1], "b1": [2, 1]})
+
+    def test_full_queue(self):
+        self.scheduler.max_pending = 1
+        self.submit("a1", "a")
+
+        with self.assertRaises(scheduler.QueueFullError):
+            self.submit("a2", "a")
+
+
+class PositionTest(unittest.TestCase):
+    def test_idle_scheduler_sends_no_position(self):
+        idle = PipelineScheduler("test")
+        positions = []
+
+        future = idle.submit(lambda: None, on_position=positions.append)
+        future.result(TIMEOUT)
+
+        self.assertEqual(positions, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
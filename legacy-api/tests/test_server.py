@@ -0,0 +1,282 @@
+import types
+import asyncio
+import unittest
+
+from unittest import mock
+
+from utils.connection_state import handle_socket_connect, handle_socket_disconnect
+from utils.protocol import (
+    FRAME_DONE,
+    FRAME_IMAGE,
+    FRAME_PROGRESS,
+    FRAME_READY,
+    FRAME_STATUS,
+    V2_HEADER,
+    image_frame,
+    progress_frame,
+)
+from utils.result_cache import replay
+from utils.ws import CommandQueue, create_send, run_writer
+
+# the pipelines are loaded by the tests that need them, not when the server is imported
+with mock.patch("programs.startup.start_pipelines", return_value=[]):
+    import server
+
+TIMEOUT = 5
+
+# a cached result, replayed RESULT_CACHE_REPLAY_STEP_MS apart
+CACHED_FRAMES = [progress_frame(step, 999 - step) for step in range(20)] + [
+    image_frame(b"image")
+]
+
+
+class FakeSocket:
+    """Records what the server sends, as text or as decoded protocol 2 frames."""
+
+    def __init__(self):
+        self.state = types.SimpleNamespace()
+        self.messages = []
+        self.sent = asyncio.Event()
+
+    async def send_text(self, text: str):
+        self.messages.append(text)
+        self.sent.set()
+
+    async def send_bytes(self, data: bytes):
+        self.messages.append(data)
+        self.sent.set()
+
+    def frames(self) -> list:
+        """(frame type, job id, payload) of the protocol 2 messages."""
+
+        frames = []
+
+        for message in self.messages:
+            if isinstance(message, bytes):
+                _, frame_type, job_id, *_ = V2_HEADER.unpack_from(message)
+                frames.append((frame_type, job_id, message[V2_HEADER.size :]))
+
+        return frames
+
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    """Sends commands through the server's reader, with stub generations."""
+
+    async def asyncSetUp(self):
+        self.sock = FakeSocket()
+        self.conn_id = handle_socket_connect(self.sock)
+        self.send = create_send(self.sock)
+        self.commands = CommandQueue(self.send, max_size=4)
+        self.writer = asyncio.create_task(run_writer(self.sock))
+
+        patch = mock.patch.object(
+            server, "create_generation", side_effect=self.create_generation
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch("utils.result_cache.RESULT_CACHE_REPLAY_STEP_MS", 20)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def asyncTearDown(self):
+        self.commands.close()
+        self.writer.cancel()
+        handle_socket_disconnect(self.sock)
+
+    def create_generation(self, command: str, conn_id: str):
+        return replay(CACHED_FRAMES)
+
+    def handle(self, command: str):
+        server.handle_command(
+            self.sock, self.send, self.conn_id, self.commands, command
+        )
+
+    async def wait_for(self, predicate):
+        async def wait():
+            while not predicate():
+                self.sock.sent.clear()
+                await self.sock.sent.wait()
+
+        await asyncio.wait_for(wait(), TIMEOUT)
+
+    async def test_protocol_negotiation(self):
+        self.handle("PROTOCOL:3")
+        self.handle("PROTOCOL:²")
+        await self.wait_for(lambda: len(self.sock.messages) == 2)
+
+        self.assertEqual(
+            self.sock.messages, ["unknown protocol: 3", "unknown protocol: ²"]
+        )
+
+        self.handle("PROTOCOL:2")
+        await self.wait_for(lambda: self.sock.frames())
+
+        self.assertEqual(self.sock.frames(), [(FRAME_STATUS, 0, b"protocol:2")])
+
+        # stream frames carry their job id from here on
+        self.handle("P0:a cat")
+        await self.wait_for(lambda: self.sock.frames()[-1][0] == FRAME_DONE)
+
+        frames = self.sock.frames()[1:]
+
+        self.assertEqual(frames[0][:2], (FRAME_READY, 1))
+        self.assertEqual(frames[-2], (FRAME_IMAGE, 1, b"image"))
+        self.assertTrue(all(job_id == 1 for _, job_id, _ in frames))
+
+    async def test_ping_during_a_generation(self):
+        self.handle("P0:a cat")
+        await self.wait_for(lambda: "p:s=1:t=998" in self.sock.messages)
+
+        self.handle("PING")
+        self.handle("ping")
+        await self.wait_for(lambda: self.sock.messages.count("pong") == 2)
+
+        # answered by the reader, without waiting for the generation
+        self.assertNotIn("done", self.sock.messages)
+
+    async def test_commands_run_in_order(self):
+        self.handle("P0:a cat")
+        await self.wait_for(lambda: "ready" in self.sock.messages)
+
+        # four wait behind the running one, the last is refused
+        for prompt in ["a dog", "a bird", "a fish", "a cow", "a hen"]:
+            self.handle(f"P0:{prompt}")
+
+        await self.wait_for(lambda: self.sock.messages.count("done") == 5)
+
+        streams = [message for message in self.sock.messages if message != "jobs:full"]
+
+        self.assertEqual(self.sock.messages.count("jobs:full"), 1)
+        self.assertEqual(streams.count("ready"), 5)
+
+        # each stream ends before the next begins
+        for i in range(5):
+            stream = streams[i * (len(CACHED_FRAMES) + 2) :][: len(CACHED_FRAMES) + 2]
+
+            self.assertEqual(stream[0], "ready")
+            self.assertEqual(stream[-2:], [b"image", "done"])
+
+    def job_frames(self, job_id: int) -> list:
+        return [frame for frame in self.sock.frames() if frame[1] == job_id]
+
+    def is_done(self, job_id: int) -> bool:
+        return (FRAME_DONE, job_id, b"") in self.sock.frames()
+
+    async def test_jobs_run_concurrently(self):
+        self.handle("PROTOCOL:2")
+        self.handle("J:7:P0:a cat")
+        self.handle("J:8:P0:a dog")
+
+        await self.wait_for(lambda: self.is_done(7) and self.is_done(8))
+
+        job_ids = [job_id for _, job_id, _ in self.sock.frames()]
+        last_of_7 = max(i for i, job_id in enumerate(job_ids) if job_id == 7)
+
+        # the second job streams before the first is done
+        self.assertLess(job_ids.index(8), last_of_7)
+
+        for job_id in (7, 8):
+            frames = self.job_frames(job_id)
+
+            self.assertEqual(frames[0], (FRAME_READY, job_id, b""))
+            self.assertEqual(
+                frames[-2:],
+                [(FRAME_IMAGE, job_id, b"image"), (FRAME_DONE, job_id, b"")],
+            )
+            self.assertEqual(len(frames), len(CACHED_FRAMES) + 2)
+
+    async def test_job_refusals(self):
+        self.handle("J:7:P0:a cat")
+        await self.wait_for(lambda: self.sock.messages)
+
+        self.assertEqual(self.sock.messages, ["jobs need protocol 2"])
+
+        self.handle("PROTOCOL:2")
+        self.handle("J:7:P0:a cat")
+
+        for command in ["J:0:P0:a cat", "J:²:P0:a cat", "J:4294967296:P0:a cat"]:
+            self.handle(command)
+
+        self.handle("J:7:P0:a dog")
+        self.handle("J:9:P0")
+        self.handle("CANCEL:10")
+
+        await self.wait_for(lambda: self.is_done(7))
+
+        statuses = [
+            (job_id, payload.decode())
+            for frame_type, job_id, payload in self.sock.frames()
+            if frame_type == FRAME_STATUS
+        ]
+
+        self.assertEqual(
+            statuses,
+            [
+                (0, "protocol:2"),
+                (0, "unknown job: 0"),
+                (0, "unknown job: ²"),
+                (0, "unknown job: 4294967296"),
+                (7, "job in use: 7"),
+                (9, "invalid command: P0"),
+                (0, "unknown job: 10"),
+            ],
+        )
+        self.assertIn((FRAME_IMAGE, 7, b"image"), self.sock.frames())
+
+    async def test_cancel_one_job(self):
+        self.handle("PROTOCOL:2")
+        self.handle("J:7:P0:a cat")
+        self.handle("J:8:P0:a dog")
+
+        # both have sent a frame after ready
+        await self.wait_for(
+            lambda: len(self.job_frames(7)) > 1 and len(self.job_frames(8)) > 1
+        )
+
+        self.handle("CANCEL:7")
+        await self.wait_for(lambda: self.is_done(7) and self.is_done(8))
+
+        self.assertEqual(self.job_frames(7)[-2][2], b"cancelled")
+        self.assertEqual(self.job_frames(8)[-2], (FRAME_IMAGE, 8, b"image"))
+
+    async def test_cancel_stops_a_cached_replay(self):
+        self.handle("P0:a cat")
+        await self.wait_for(lambda: "p:s=1:t=998" in self.sock.messages)
+
+        self.handle("CANCEL")
+        await self.wait_for(lambda: self.sock.messages[-1] == "done")
+
+        self.assertEqual(self.sock.messages[-2:], ["cancelled", "done"])
+        self.assertNotIn(b"image", self.sock.messages)
+        self.assertNotIn("p:s=19:t=980", self.sock.messages)
+
+    async def test_cancel_stops_jobs(self):
+        self.handle("PROTOCOL:2")
+        self.handle("J:7:P0:a cat")
+        self.handle("J:8:P0:a dog")
+
+        def has_stepped(job_id):
+            return any(
+                frame_type == FRAME_PROGRESS and job == job_id
+                for frame_type, job, _ in self.sock.frames()
+            )
+
+        await self.wait_for(lambda: has_stepped(7) and has_stepped(8))
+
+        self.handle("CANCEL")
+
+        await self.wait_for(lambda: self.is_done(7) and self.is_done(8))
+
+        for job_id in (7, 8):
+            frames = self.job_frames(job_id)
+
+            self.assertEqual(
+                frames[-2:],
+                [(FRAME_STATUS, job_id, b"cancelled"), (FRAME_DONE, job_id, b"")],
+            )
+            self.assertNotIn(FRAME_IMAGE, [frame[0] for frame in frames])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import json
+import tempfile
+import unittest
+
+from collections import OrderedDict
+from unittest import mock
+
+from benchmarks.stub_pipelines import StubPipeline
+from programs import startup, warmup
+from utils import lora, pipelines, prompt_cache
+from utils.pipelines import PipelineState, load_pipeline
+
+
+class Encoder:
+    """A text encoder that only records which device it is on."""
+
+    def __init__(self, device: str):
+        self.device = device
+
+    def to(self, device):
+        self.device = device
+        return self
+
+
+class PlacedPipeline(StubPipeline):
+    """A stub pipeline on a gpu, whose prompts are encoded where its text encoders are."""
+
+    def __init__(self):
+        super().__init__("text2img", step_ms=0)
+
+        self.unet.device = "gpu"
+        self.text_encoder = Encoder("gpu")
+        self.text_encoder_2 = Encoder("gpu")
+
+    def __call__(self, prompt=None, **kwargs):
+        if prompt is not None:
+            self.encode_prompt(prompt, device=self.unet.device)
+
+        return super().__call__(prompt=prompt, **kwargs)
+
+    def encode_prompt(self, prompt, device=None, **kwargs):
+        for encoder in (self.text_encoder, self.text_encoder_2):
+            if encoder.device != device:
+                raise RuntimeError(
+                    f"text encoder on {encoder.device}, input on {device}"
+                )
+
+        return super().encode_prompt(prompt, device=device, **kwargs)
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        cues = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump([{"action": "prompt", "program": "P4", "prompt": "a cat"}], cues)
+        cues.close()
+        self.addCleanup(os.remove, cues.name)
+
+        self.pipe = PlacedPipeline()
+        self.state = PipelineState("text2img")
+
+        patches = [
+            mock.patch.dict(pipelines.pipelines, {"text2img": self.state}, clear=True),
+            mock.patch.dict(pipelines.LOADERS, {"text2img": lambda: self.pipe}),
+            mock.patch.object(startup, "start_loading"),
+            mock.patch.object(startup, "LORA_PRELOAD", False),
+            mock.patch.object(startup, "PROMPT_CACHE_WARMUP_CUES", cues.name),
+            mock.patch.object(prompt_cache, "PROMPT_CACHE_OFFLOAD_ENCODERS", True),
+            mock.patch.object(lora, "lora_loaded", False),
+            mock.patch.object(lora, "lora_applied", False),
+            mock.patch.object(warmup, "WARMUP", "fast"),
+            mock.patch.object(warmup, "WARMUP_FAST_STEPS", 1),
+            mock.patch.dict(
+                warmup.WARMUP_BUCKETS,
+                {"text2img": warmup.WARMUP_BUCKETS["text2img"][:1]},
+            ),
+            mock.patch.object(prompt_cache.prompt_cache, "entries", OrderedDict()),
+            mock.patch.object(prompt_cache.prompt_cache, "encoders_offloaded", False),
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_encoders_are_offloaded_after_warmup(self):
+        startup.start_pipelines()
+        load_pipeline(self.state)
+
+        self.assertEqual(self.state.status, "ready", self.state.error)
+        self.assertEqual(self.pipe.text_encoder.device, "cpu")
+        self.assertEqual(self.pipe.text_encoder_2.device, "cpu")
+
+    def test_prompt_outside_the_cues_restores_encoders(self):
+        startup.start_pipelines()
+        load_pipeline(self.state)
+
+        prompt_cache.prompt_cache.get("a dog")
+
+        self.assertEqual(self.pipe.text_encoder.device, "gpu")
+        self.assertEqual(self.pipe.text_encoder_2.device, "gpu")
+
+
+if __name__ == "__main__":
+    unittest.main()
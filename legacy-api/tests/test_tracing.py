@@ -0,0 +1,47 @@
+import os
+import json
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from utils import tracing
+from utils.tracing import Trace, write_trace
+
+
+class TracingTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+        self.trace = Trace("P0")
+        self.trace.add_span("step", 1.0, 1.5, "unet")
+
+    def test_file_per_request(self):
+        with mock.patch.object(tracing, "TRACE_DIR", self.directory):
+            write_trace("P0", self.trace.pid, self.trace.trace_events())
+
+        (path,) = self.directory.iterdir()
+
+        # request ids restart in every inference worker
+        self.assertIn(f"-{os.getpid()}-{self.trace.pid}-P0", path.name)
+        self.assertIn("traceEvents", json.loads(path.read_text()))
+
+    def test_file_per_process(self):
+        trace_file = self.directory / "trace.json"
+
+        with mock.patch.object(tracing, "TRACE_FILE", str(trace_file)):
+            write_trace("P0", self.trace.pid, self.trace.trace_events())
+            write_trace("P0", self.trace.pid, self.trace.trace_events())
+
+        (path,) = self.directory.iterdir()
+        events = json.loads(path.read_text().rstrip(",\n") + "]")
+
+        self.assertEqual(path.name, f"trace.{os.getpid()}.json")
+        self.assertEqual(len(events), 2 * len(self.trace.trace_events()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import torch
+
+from utils.transfer import PinnedRing
+
+
+class PinnedRingTest(unittest.TestCase):
+    def test_copy_out(self):
+        ring = PinnedRing(depth=2)
+        tensor = torch.arange(24, dtype=torch.float16).reshape(1, 4, 2, 3)
+
+        copy = ring.copy(tensor)
+        expected = tensor.clone()
+
+        # the pipeline keeps working on its latents after the callback returns
+        tensor.add_(1)
+
+        host = copy.wait()
+        self.assertEqual(host.dtype, torch.float16)
+        self.assertTrue(torch.equal(host, expected))
+
+    def test_release_frees_the_slot(self):
+        ring = PinnedRing(depth=2)
+        tensor = torch.ones(2, 3)
+
+        first = ring.copy(tensor)
+        second = ring.copy(tensor)
+
+        self.assertNotEqual(first.slot, second.slot)
+
+        first.release()
+        third = ring.copy(torch.zeros(2))
+
+        # the slot's buffer is reused for a smaller tensor
+        self.assertEqual(third.slot, first.slot)
+        self.assertEqual(third.tensor.data_ptr(), first.tensor.data_ptr())
+        self.assertTrue(torch.equal(third.wait(), torch.zeros(2)))
+
+    def test_full_ring(self):
+        ring = PinnedRing(depth=2)
+        tensor = torch.ones(4)
+
+        copies = [ring.copy(tensor), ring.copy(tensor)]
+
+        # submit_preview then skips the preview instead of waiting for a slot
+        self.assertIsNone(ring.copy(tensor))
+
+        copies[0].release()
+        self.assertIsNotNone(ring.copy(tensor))
+
+    def test_reserve(self):
+        ring = PinnedRing(depth=3)
+        ring.reserve(torch.ones(2, 5))
+
+        self.assertTrue(all(buffer.numel() == 40 for buffer in ring.buffers))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from unittest import mock
+
+from programs import warmup
+from programs.warmup import get_warmup_buckets
+
+
+class WarmupBucketTest(unittest.TestCase):
+    def use(self, programs, lora_preload=True):
+        for patch in [
+            mock.patch.object(warmup, "ENABLED_PROGRAMS", programs),
+            mock.patch.object(warmup, "LORA_PRELOAD", lora_preload),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_only_enabled_programs(self):
+        self.use(["P4"])
+
+        buckets = get_warmup_buckets("text2img")
+
+        self.assertEqual([bucket.programs for bucket in buckets], [("P0", "P4")])
+        self.assertEqual(get_warmup_buckets("img2img"), [])
+
+    def test_lora_buckets_need_program_3(self):
+        self.use(["P3B"])
+
+        buckets = get_warmup_buckets("text2img")
+
+        self.assertTrue(buckets)
+        self.assertTrue(all(bucket.is_chuamiatee for bucket in buckets))
+
+    def test_lora_buckets_need_the_preload(self):
+        self.use(["P0", "P3"], lora_preload=False)
+
+        buckets = get_warmup_buckets("text2img")
+
+        self.assertEqual([bucket.is_chuamiatee for bucket in buckets], [False])
+
+
+if __name__ == "__main__":
+    unittest.main()
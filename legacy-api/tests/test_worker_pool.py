@@ -0,0 +1,101 @@
+import os
+import types
+import asyncio
+import unittest
+
+from unittest import mock
+
+from utils.connection_state import handle_socket_connect, handle_socket_disconnect
+from utils.pipeline_manager import cancel_denoise
+from utils.protocol import FRAME_IMAGE, FRAME_PREVIEW, FRAME_PROGRESS, status_frame
+from utils.worker_pool import WorkerPool
+from utils.worker_process import WorkerSpec
+
+# read by the worker processes, which are spawned with this environment
+WORKER_ENVIRONMENT = {
+    "PIPELINE_LOADERS": "text2img=benchmarks.stub_pipelines:load_text2img",
+    "STUB_STEP_MS": "20",
+    "WARMUP": "off",
+}
+
+# seconds for a worker to start, load the stub pipeline and run a job
+TIMEOUT = 120
+
+
+class WorkerPoolTest(unittest.IsolatedAsyncioTestCase):
+    """Runs P4 jobs in a spawned worker process on the cpu stub pipelines."""
+
+    async def asyncSetUp(self):
+        patch = mock.patch.dict(os.environ, WORKER_ENVIRONMENT)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.pool = WorkerPool([WorkerSpec(("text2img",), "cpu")], ["text2img"])
+        self.pool.start()
+        self.worker = self.pool.workers[0]
+
+        sock = types.SimpleNamespace(state=types.SimpleNamespace())
+        self.conn_id = handle_socket_connect(sock)
+        self.addCleanup(handle_socket_disconnect, sock)
+
+    async def asyncTearDown(self):
+        self.pool.stop()
+
+    async def run_job(self, on_first_step=None) -> list:
+        """The frames of a P4 job, and on_first_step is called at its first step."""
+
+        async def collect():
+            frames = []
+
+            async for frame in self.pool.run("P4:a cat", self.conn_id, "text2img"):
+                is_step = frame.type in (FRAME_PROGRESS, FRAME_PREVIEW)
+                is_first_step = is_step and not any(
+                    sent.type in (FRAME_PROGRESS, FRAME_PREVIEW) for sent in frames
+                )
+
+                frames.append(frame)
+
+                if on_first_step and is_first_step:
+                    on_first_step()
+
+            return frames
+
+        return await asyncio.wait_for(collect(), TIMEOUT)
+
+    async def test_round_trip(self):
+        frames = await self.run_job()
+        types_sent = [frame.type for frame in frames]
+
+        self.assertIn(FRAME_PREVIEW, types_sent)
+        self.assertEqual(types_sent.count(FRAME_IMAGE), 1)
+
+        # the payloads came back through the shared memory ring
+        image = next(frame for frame in frames if frame.type == FRAME_IMAGE)
+        self.assertTrue(image.payload.startswith(b"\xff\xd8"))
+        self.assertEqual(self.worker.jobs, {})
+
+    async def test_cancel(self):
+        frames = await self.run_job(on_first_step=lambda: cancel_denoise(self.conn_id))
+
+        self.assertIn(status_frame("cancelled"), frames)
+        self.assertNotIn(FRAME_IMAGE, [frame.type for frame in frames])
+
+        # the worker takes the next job as usual
+        frames = await self.run_job()
+        self.assertIn(FRAME_IMAGE, [frame.type for frame in frames])
+
+    async def test_crash(self):
+        frames = await self.run_job(on_first_step=lambda: self.worker.process.kill())
+
+        # the stream ends like a failed job, and the worker comes back
+        self.assertNotIn(FRAME_IMAGE, [frame.type for frame in frames])
+
+        await asyncio.wait_for(self.worker.is_running.wait(), TIMEOUT)
+        self.assertEqual(self.worker.restarts, 1)
+
+        frames = await self.run_job()
+        self.assertIn(FRAME_IMAGE, [frame.type for frame in frames])
+
+
+if __name__ == "__main__":
+    unittest.main()
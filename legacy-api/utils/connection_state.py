@@ -1,21 +1,234 @@
+import os
+import hmac
 import uuid
+import asyncio
 from fastapi import WebSocket
-from typing import Dict
+from typing import Dict, NamedTuple, Optional
+
+from utils.protocol import (
+    DEFAULT_IMAGE_FORMAT,
+    ENCODING_DELTA,
+    IMAGE_ENCODINGS,
+    PREVIEW_ENCODINGS,
+    PROTOCOL_V1,
+    PROTOCOLS,
+    ImageFormat,
+    parse_image_format,
+)
+from utils.scheduler import PRIORITIES, PRIORITY_KIOSK
+
+# jobs a single connection may have in flight at once
+MAX_JOBS_PER_CONNECTION = int(os.environ.get("MAX_JOBS_PER_CONNECTION", "4"))
+
+# delta previews are larger than jpeg ones at the default quantization, so the server opts in too
+DELTA_PREVIEWS = os.environ.get("DELTA_PREVIEWS", "0") == "1"
+
+# shared secret of ROLE:presenter:<token>, the presenter role is refused while it is unset
+PRESENTER_TOKEN = os.environ.get("PRESENTER_TOKEN", "")
+
+# values of SUPERSEDE:<mode>
+SUPERSEDE_MODES = {"on": True, "off": False}
 
 connections: Dict[str, WebSocket] = {}
 
 
+class ConnectionJob(NamedTuple):
+    command: str
+    task: asyncio.Task
+
+
 def get_is_connected(conn_id: str):
     global connections
 
     return conn_id in connections
 
 
+def get_client_id(conn_id: Optional[str]) -> Optional[str]:
+    """The client whose jobs the schedulers rotate fairly with other clients' jobs."""
+
+    global connections
+
+    sock = connections.get(conn_id)
+
+    if sock is None:
+        return conn_id
+
+    return sock.state.client_id
+
+
+def get_priority(conn_id: str) -> int:
+    global connections
+
+    sock = connections.get(conn_id)
+
+    if sock is None:
+        return PRIORITY_KIOSK
+
+    return getattr(sock.state, "priority", PRIORITY_KIOSK)
+
+
+def record_dropped_frame(conn_id: str):
+    global connections
+
+    sock = connections.get(conn_id)
+
+    if sock is not None:
+        sock.state.dropped_frames += 1
+
+
+def get_supersede(conn_id: str) -> bool:
+    global connections
+
+    sock = connections.get(conn_id)
+
+    return sock is not None and sock.state.supersede
+
+
+def set_supersede(conn_id: str, mode: str) -> bool:
+    global connections
+
+    if mode not in SUPERSEDE_MODES or conn_id not in connections:
+        return False
+
+    connections[conn_id].state.supersede = SUPERSEDE_MODES[mode]
+
+    return True
+
+
+def set_protocol(conn_id: str, protocol: int) -> bool:
+    global connections
+
+    if protocol not in PROTOCOLS or conn_id not in connections:
+        return False
+
+    connections[conn_id].state.protocol = protocol
+
+    return True
+
+
+def get_preview_format(conn_id: str) -> ImageFormat:
+    global connections
+
+    sock = connections.get(conn_id)
+
+    if sock is None:
+        return DEFAULT_IMAGE_FORMAT
+
+    return sock.state.preview_format
+
+
+def get_final_format(conn_id: str) -> ImageFormat:
+    global connections
+
+    sock = connections.get(conn_id)
+
+    if sock is None:
+        return DEFAULT_IMAGE_FORMAT
+
+    return sock.state.final_format
+
+
+def set_preview_format(conn_id: str, text: str) -> bool:
+    global connections
+
+    preview_format = parse_image_format(text, PREVIEW_ENCODINGS)
+
+    if preview_format is None or conn_id not in connections:
+        return False
+
+    if preview_format.encoding == ENCODING_DELTA and not DELTA_PREVIEWS:
+        return False
+
+    connections[conn_id].state.preview_format = preview_format
+
+    return True
+
+
+def set_final_format(conn_id: str, text: str) -> bool:
+    global connections
+
+    final_format = parse_image_format(text, IMAGE_ENCODINGS)
+
+    if final_format is None or conn_id not in connections:
+        return False
+
+    connections[conn_id].state.final_format = final_format
+
+    return True
+
+
+def is_role_allowed(role: str, token: str) -> bool:
+    if role != "presenter":
+        return True
+
+    return PRESENTER_TOKEN != "" and hmac.compare_digest(
+        token.encode(), PRESENTER_TOKEN.encode()
+    )
+
+
+def set_role(conn_id: str, role: str) -> bool:
+    global connections
+
+    if role not in PRIORITIES or conn_id not in connections:
+        return False
+
+    connections[conn_id].state.priority = PRIORITIES[role]
+
+    return True
+
+
+def get_jobs(conn_id: str) -> Dict[int, ConnectionJob]:
+    global connections
+
+    sock = connections.get(conn_id)
+
+    if sock is None:
+        return {}
+
+    return sock.state.jobs
+
+
+def add_job(conn_id: str, job_id: int, command: str, task: asyncio.Task):
+    jobs = get_jobs(conn_id)
+    jobs[job_id] = ConnectionJob(command, task)
+
+    def remove(_):
+        # the id may have been reused by a newer job in the meantime
+        job = jobs.get(job_id)
+
+        if job is not None and job.task is task:
+            del jobs[job_id]
+
+    task.add_done_callback(remove)
+
+
+def cancel_job(conn_id: str, job_id: int) -> Optional[ConnectionJob]:
+    job = get_jobs(conn_id).pop(job_id, None)
+
+    if job is not None:
+        job.task.cancel()
+
+    return job
+
+
 def handle_socket_connect(sock: WebSocket):
     global connections
 
     connection_id = str(uuid.uuid4())
     sock.state.connection_id = connection_id
+
+    # the connection itself, or the server's connection for the jobs of an inference worker
+    sock.state.client_id = connection_id
+    sock.state.priority = PRIORITY_KIOSK
+    sock.state.dropped_frames = 0
+    sock.state.supersede = False
+    sock.state.protocol = PROTOCOL_V1
+    sock.state.preview_format = DEFAULT_IMAGE_FORMAT
+    sock.state.final_format = DEFAULT_IMAGE_FORMAT
+    sock.state.jobs = {}
+
+    # (frame, job id, future resolved once sent) waiting for the connection's writer
+    sock.state.outbox = asyncio.Queue()
     connections[connection_id] = sock
 
     return connection_id
@@ -25,4 +238,12 @@ def handle_socket_disconnect(sock: WebSocket):
     global connections
 
     if sock:
+        dropped_frames = sock.state.dropped_frames
+
+        if dropped_frames > 0:
+            print(f"dropped {dropped_frames} preview frames for a slow client")
+
         del connections[sock.state.connection_id]
+
+        for job in sock.state.jobs.values():
+            job.task.cancel()
@@ -0,0 +1,181 @@
+import os
+import zlib
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+from utils.protocol import (
+    DELTA_HEADER,
+    DELTA_KEYFRAME,
+    DELTA_PREVIOUS,
+    DELTA_TREND,
+    RGB_HEADER,
+)
+
+# a keyframe every N previews, so a client that lost its place recovers within the job
+DELTA_KEYFRAME_INTERVAL = int(os.environ.get("DELTA_KEYFRAME_INTERVAL", "20"))
+
+# pixels are divided by this and rounded before the deltas are taken, 1 is lossless
+DELTA_QUANTIZATION = int(os.environ.get("DELTA_QUANTIZATION", "4"))
+
+DELTA_COMPRESSION_LEVEL = int(os.environ.get("DELTA_COMPRESSION_LEVEL", "6"))
+
+
+def quantize(frame: np.ndarray, quantization: int) -> np.ndarray:
+    # halves round up, like Math.round in the browser decoder (ui/src/utils/delta-preview.ts)
+    return np.floor(frame / quantization + 0.5).astype(np.int16)
+
+
+def get_top(quantization: int) -> int:
+    """The largest quantized value, which clamps trend predictions on both ends."""
+
+    return int(255 / quantization + 0.5)
+
+
+def predict(kind: int, previous: np.ndarray, before: Optional[np.ndarray], top: int):
+    """The frame a delta is taken against, from the last two quantized frames."""
+
+    if kind == DELTA_TREND:
+        # denoising moves most pixels the same way for many steps in a row
+        return np.clip(2 * previous - before, 0, top)
+
+    return previous
+
+
+def dequantize(values: np.ndarray, quantization: int) -> bytes:
+    return np.clip(values * quantization, 0, 255).astype(np.uint8).tobytes()
+
+
+class DeltaEncoder:
+    """
+    Turns the raw rgb previews of one job into a keyframe followed by compressed deltas.
+
+    Deltas are exact differences between quantized frames, so the client's frames never drift.
+    Must see every preview the client receives, in order.
+    """
+
+    def __init__(
+        self,
+        keyframe_interval: int = DELTA_KEYFRAME_INTERVAL,
+        quantization: int = DELTA_QUANTIZATION,
+        level: int = DELTA_COMPRESSION_LEVEL,
+    ):
+        self.keyframe_interval = keyframe_interval
+        self.quantization = quantization
+        self.level = level
+
+        self.top = get_top(quantization)
+
+        # the last two quantized frames, as int16
+        self.previous: Optional[np.ndarray] = None
+        self.before: Optional[np.ndarray] = None
+
+        self.since_keyframe = 0
+        self.keyframe_size = 0
+
+    def encode(self, rgb: bytes) -> bytes:
+        """Encodes a preview from latents_to_rgb_bytes."""
+
+        width, height = RGB_HEADER.unpack_from(rgb)
+        frame = np.frombuffer(rgb, np.uint8, offset=RGB_HEADER.size)
+        frame = frame.reshape(height, width, 3)
+
+        values = quantize(frame, self.quantization)
+
+        if (
+            self.previous is None
+            or self.previous.shape != values.shape
+            or self.since_keyframe >= self.keyframe_interval > 0
+        ):
+            return self.encode_keyframe(values)
+
+        kinds = (
+            [DELTA_PREVIOUS] if self.before is None else [DELTA_TREND, DELTA_PREVIOUS]
+        )
+        payload = min((self.encode_delta(kind, values) for kind in kinds), key=len)
+
+        # a big change, such as the first steps of img2img, can be cheaper as a full frame
+        if len(payload) > self.keyframe_size:
+            keyframe = self.pack(DELTA_KEYFRAME, values)
+
+            if len(keyframe) <= len(payload):
+                return self.encode_keyframe(values, keyframe)
+
+            # skip the comparison until the deltas outgrow this keyframe
+            self.keyframe_size = len(keyframe)
+
+        self.remember(values)
+        self.since_keyframe += 1
+
+        return payload
+
+    def encode_keyframe(self, values: np.ndarray, payload: Optional[bytes] = None):
+        payload = payload or self.pack(DELTA_KEYFRAME, values)
+
+        self.previous = self.before = None
+        self.remember(values)
+
+        self.since_keyframe = 1
+        self.keyframe_size = len(payload)
+
+        return payload
+
+    def encode_delta(self, kind: int, values: np.ndarray) -> bytes:
+        prediction = predict(kind, self.previous, self.before, self.top)
+
+        return self.pack(kind, values - prediction)
+
+    def pack(self, kind: int, values: np.ndarray) -> bytes:
+        height, width, _ = values.shape
+        header = DELTA_HEADER.pack(kind, self.quantization, width, height)
+
+        # residuals wrap around as uint8, which the decoder undoes with the same wrap
+        data = values.astype(np.uint8).tobytes()
+
+        return header + zlib.compress(data, self.level)
+
+    def remember(self, values: np.ndarray):
+        self.before = self.previous
+        self.previous = values
+
+
+class DeltaDecoder:
+    """
+    Reference decoder for the delta preview encoding, one per job.
+
+    Porting it to a client takes a zlib inflate and a few lines of integer arithmetic.
+    """
+
+    def __init__(self):
+        self.previous: Optional[np.ndarray] = None
+        self.before: Optional[np.ndarray] = None
+
+    def decode(self, payload: bytes) -> Tuple[int, int, bytes]:
+        """Returns the width, height and rgb bytes of a preview."""
+
+        kind, quantization, width, height = DELTA_HEADER.unpack_from(payload)
+        data = zlib.decompress(payload[DELTA_HEADER.size :])
+        values = np.frombuffer(data, np.uint8).reshape(height, width, 3)
+
+        if kind == DELTA_KEYFRAME:
+            self.previous = self.before = None
+        else:
+            if self.previous is None or self.previous.shape != values.shape:
+                raise ValueError("delta preview without a keyframe before it")
+
+            if kind == DELTA_TREND and self.before is None:
+                raise ValueError("trend preview without two frames before it")
+
+            prediction = predict(
+                kind, self.previous, self.before, get_top(quantization)
+            )
+
+            # a uint8 add that wraps around, like the encoder's subtraction
+            values = (prediction + values) & 0xFF
+
+        values = values.astype(np.int16)
+        self.before = self.previous
+        self.previous = values
+
+        return width, height, dequantize(values, quantization)
@@ -0,0 +1,175 @@
+import io
+import os
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from utils.delta import DeltaEncoder
+from utils.latents import latents_to_rgb, latents_to_rgb_bytes, quantize_latents
+from utils.metrics import encode_seconds, encoded_bytes
+from utils.protocol import (
+    DEFAULT_IMAGE_FORMAT,
+    ENCODING_DELTA,
+    ENCODING_JPEG,
+    ENCODING_LATENT,
+    ENCODING_NAMES,
+    ENCODING_PNG,
+    ENCODING_RGB,
+    ENCODING_WEBP,
+    ImageFormat,
+)
+from utils.tracing import NULL_TRACE, Trace
+from utils.transfer import HostCopy, PinnedRing
+
+ENCODER_WORKERS = int(os.environ.get("ENCODER_WORKERS", "2"))
+
+# keeps PIL and JPEG work off the diffusion threads
+encoder_pool = ThreadPoolExecutor(
+    max_workers=ENCODER_WORKERS, thread_name_prefix="encoder"
+)
+
+# host buffers the preview latents are copied into, shared by every pipeline thread
+preview_ring = PinnedRing()
+
+PIL_FORMATS = {ENCODING_JPEG: "JPEG", ENCODING_WEBP: "WEBP", ENCODING_PNG: "PNG"}
+
+
+def encode_image(image, image_format: ImageFormat = DEFAULT_IMAGE_FORMAT) -> bytes:
+    max_size = image_format.max_size
+
+    if max_size is not None and max(image.size) > max_size:
+        image = image.copy()
+        image.thumbnail((max_size, max_size))
+
+    # png is lossless, so it has no quality setting
+    options = {}
+
+    if image_format.quality is not None and image_format.encoding != ENCODING_PNG:
+        options["quality"] = image_format.quality
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=PIL_FORMATS[image_format.encoding], **options)
+
+    return buffer.getvalue()
+
+
+def render_preview(latents, trace: Trace, preview_format: ImageFormat):
+    if preview_format.encoding in (ENCODING_RGB, ENCODING_DELTA):
+        with trace.span("latents_to_rgb", "encode", kind="raw"):
+            return latents_to_rgb_bytes(latents)
+
+    if preview_format.encoding == ENCODING_LATENT:
+        with trace.span("quantize latents", "encode"):
+            return quantize_latents(latents)
+
+    with trace.span("latents_to_rgb", "encode"):
+        image = latents_to_rgb(latents)
+
+    name = ENCODING_NAMES[preview_format.encoding]
+
+    with trace.span(f"{name} encode", "encode", kind="preview"):
+        return encode_image(image, preview_format)
+
+
+def encode_preview(
+    latents,
+    trace: Trace = NULL_TRACE,
+    preview_format: ImageFormat = DEFAULT_IMAGE_FORMAT,
+) -> bytes:
+    # delta previews start out as raw rgb, and are sized once encode_delta has run
+    is_delta = preview_format.encoding == ENCODING_DELTA
+    name = "rgb" if is_delta else ENCODING_NAMES[preview_format.encoding]
+
+    with encode_seconds.labels("preview", name).time():
+        payload = render_preview(latents, trace, preview_format)
+
+    if not is_delta:
+        encoded_bytes.labels("preview", name).observe(len(payload))
+
+    return payload
+
+
+def encode_delta(encoder: DeltaEncoder, rgb: bytes, trace: Trace = NULL_TRACE):
+    with encode_seconds.labels("preview", "delta").time(), trace.span(
+        "delta encode", "encode"
+    ):
+        payload = encoder.encode(rgb)
+
+    encoded_bytes.labels("preview", "delta").observe(len(payload))
+
+    return payload
+
+
+def encode_final(
+    image, trace: Trace = NULL_TRACE, final_format: ImageFormat = DEFAULT_IMAGE_FORMAT
+) -> bytes:
+    name = ENCODING_NAMES[final_format.encoding]
+
+    with encode_seconds.labels("image", name).time(), trace.span(
+        f"{name} encode", "encode", kind="image"
+    ):
+        payload = encode_image(image, final_format)
+
+    encoded_bytes.labels("image", name).observe(len(payload))
+
+    return payload
+
+
+def submit_preview(
+    latents,
+    trace: Trace = NULL_TRACE,
+    preview_format: ImageFormat = DEFAULT_IMAGE_FORMAT,
+    on_cost: Optional[Callable[[float], None]] = None,
+) -> Optional[Future]:
+    """
+    Encodes a preview of the first latent on the encoder pool.
+
+    Returns None when the encoder is so far behind that every ring slot is taken,
+    in which case the preview is skipped rather than stalling the pipeline.
+    on_cost gets the seconds the encode itself took, without the wait for the pool or the transfer.
+    """
+
+    # copy the latents out, as the pipeline keeps working on them after the callback returns
+    with trace.span("copy to host", "encode"):
+        copy = preview_ring.copy(latents[:1].detach())
+
+    if copy is None:
+        return None
+
+    future = encoder_pool.submit(encode_host_copy, copy, trace, preview_format, on_cost)
+
+    # also frees the slot when the frame buffer cancels the encode of a dropped preview
+    future.add_done_callback(lambda _: copy.release())
+
+    return future
+
+
+def encode_host_copy(
+    copy: HostCopy,
+    trace: Trace,
+    preview_format: ImageFormat,
+    on_cost: Optional[Callable[[float], None]] = None,
+) -> bytes:
+    with trace.span("transfer wait", "encode"):
+        latents = copy.wait()
+
+    start = time.perf_counter()
+
+    # the projection is a few thousand multiply-adds per row, cheap enough on the cpu
+    payload = encode_preview(latents.float(), trace, preview_format)
+
+    if on_cost is not None:
+        on_cost(time.perf_counter() - start)
+
+    return payload
+
+
+def submit_delta(encoder: DeltaEncoder, rgb: bytes, trace: Trace = NULL_TRACE):
+    return encoder_pool.submit(encode_delta, encoder, rgb, trace)
+
+
+def submit_image(
+    image, trace: Trace = NULL_TRACE, final_format: ImageFormat = DEFAULT_IMAGE_FORMAT
+) -> Future:
+    return encoder_pool.submit(encode_final, image, trace, final_format)
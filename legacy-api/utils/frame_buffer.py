@@ -0,0 +1,82 @@
+import os
+import asyncio
+import concurrent.futures
+
+from collections import deque
+from typing import Callable, Optional
+
+from utils.protocol import FRAME_PREVIEW, Frame, progress_frame
+
+# previews waiting to be sent per request, older ones are dropped beyond this
+MAX_BUFFERED_PREVIEWS = int(os.environ.get("MAX_BUFFERED_PREVIEWS", "1"))
+
+
+def is_preview(frame) -> bool:
+    return isinstance(frame, Frame) and frame.type == FRAME_PREVIEW
+
+
+class FrameBuffer:
+    """
+    Outbound frames of one request, waiting to be sent to a connection.
+
+    When the client falls behind, superseded previews are dropped so the newest one goes out next.
+    A dropped preview still leaves its progress marker behind.
+    Progress markers, the final image and the end of stream are never dropped.
+    Must only be used from the event loop thread.
+    """
+
+    def __init__(
+        self,
+        max_previews: int = MAX_BUFFERED_PREVIEWS,
+        on_drop: Optional[Callable[[], None]] = None,
+        cancel_dropped: bool = True,
+    ):
+        self.max_previews = max_previews
+        self.on_drop = on_drop
+        self.cancel_dropped = cancel_dropped
+
+        self.frames: deque = deque()
+        self.preview_count = 0
+        self.event = asyncio.Event()
+
+    def put(self, frame):
+        if is_preview(frame) and self.preview_count >= self.max_previews:
+            self._drop_oldest_preview()
+
+        self.frames.append(frame)
+
+        if is_preview(frame):
+            self.preview_count += 1
+
+        self.event.set()
+
+    async def get(self):
+        while not self.frames:
+            self.event.clear()
+            await self.event.wait()
+
+        frame = self.frames.popleft()
+
+        if is_preview(frame):
+            self.preview_count -= 1
+
+        return frame
+
+    def _drop_oldest_preview(self):
+        for index, frame in enumerate(self.frames):
+            if not is_preview(frame):
+                continue
+
+            self.frames[index] = progress_frame(frame.step, frame.timestep)
+            self.preview_count -= 1
+
+            # skip the encode if it has not started yet, unless someone else still needs it
+            if self.cancel_dropped and isinstance(
+                frame.payload, concurrent.futures.Future
+            ):
+                frame.payload.cancel()
+
+            if self.on_drop:
+                self.on_drop()
+
+            return
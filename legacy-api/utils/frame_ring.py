@@ -0,0 +1,76 @@
+import os
+import struct
+
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+# shared memory per inference worker for the payloads of its frames
+WORKER_RING_MB = int(os.environ.get("WORKER_RING_MB", "64"))
+
+# how far the consumer has read, at the start of the shared memory
+READ_POSITION = struct.Struct("<Q")
+
+
+class FrameRing:
+    """
+    A byte ring in shared memory, for one worker process to hand frame payloads to the server.
+
+    The worker writes a payload and sends only its (position, size) through the pipe.
+    The server copies it out and moves the read position past it, which frees the space.
+    Positions only grow, and a payload never wraps around the end, the writer skips to the start instead.
+    There must be exactly one writer and one reader, each reading payloads in the order they were written.
+    """
+
+    def __init__(self, name: Optional[str] = None, size: int = WORKER_RING_MB << 20):
+        self.is_owner = name is None
+        self.memory = shared_memory.SharedMemory(
+            name=name, create=self.is_owner, size=READ_POSITION.size + size
+        )
+        self.name = self.memory.name
+        self.size = size
+        self.data = self.memory.buf[READ_POSITION.size : READ_POSITION.size + size]
+
+        # only used by the writer
+        self.write_position = 0
+
+    def write(self, payload: bytes) -> Optional[Tuple[int, int]]:
+        """Copies a payload into the ring. Returns None if it does not fit right now."""
+
+        size = len(payload)
+        position = self.write_position
+        offset = position % self.size
+
+        if offset + size > self.size:
+            position += self.size - offset
+            offset = 0
+
+        (read_position,) = READ_POSITION.unpack_from(self.memory.buf)
+
+        if position + size - read_position > self.size:
+            return None
+
+        self.data[offset : offset + size] = payload
+        self.write_position = position + size
+
+        return position, size
+
+    def read(self, position: int, size: int) -> bytes:
+        offset = position % self.size
+        payload = bytes(self.data[offset : offset + size])
+
+        READ_POSITION.pack_into(self.memory.buf, 0, position + size)
+
+        return payload
+
+    def reset(self):
+        """Empties the ring for a new writer, once the last one has exited."""
+
+        READ_POSITION.pack_into(self.memory.buf, 0, 0)
+        self.write_position = 0
+
+    def close(self):
+        self.data.release()
+        self.memory.close()
+
+        if self.is_owner:
+            self.memory.unlink()
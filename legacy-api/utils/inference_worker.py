@@ -0,0 +1,172 @@
+import types
+import asyncio
+import threading
+
+from multiprocessing.connection import Connection
+from typing import Dict
+
+from prometheus_client import generate_latest
+
+from programs.registry import parse_command, start_program
+from programs.startup import start_pipelines
+from programs.warmup import warmup_timings
+from utils.connection_state import handle_socket_connect, handle_socket_disconnect
+from utils.frame_ring import FrameRing
+from utils.pipeline_manager import cancel_denoise
+from utils.pipelines import pipelines
+from utils.protocol import Frame
+from utils.worker_process import WorkerSpec
+
+
+class WorkerConnection:
+    """Stands in for the websocket a job came from, so the programs run unchanged in a worker."""
+
+    def __init__(self):
+        self.state = types.SimpleNamespace()
+
+
+class InferenceWorker:
+    """
+    Runs the jobs the server sends to this process, and sends their frames back.
+
+    Every job gets a connection of its own, with the options of the server's connection.
+    Its client id is the server's connection, so the schedulers rotate between clients, not jobs.
+    The next frame of a job is only taken once the server has sent the last one,
+    so the frame buffers drop stale previews here just as they would in the server.
+    """
+
+    def __init__(self, spec: WorkerSpec, connection: Connection, ring: FrameRing):
+        self.spec = spec
+        self.connection = connection
+        self.ring = ring
+        self.loop = asyncio.get_running_loop()
+
+        # the event loop and the pipeline watchers both send
+        self.lock = threading.Lock()
+
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.socks: Dict[int, WorkerConnection] = {}
+        self.acks: Dict[int, asyncio.Event] = {}
+
+        self.closed = asyncio.Event()
+
+    def send(self, message: tuple):
+        with self.lock:
+            self.connection.send(message)
+
+    def send_frame(self, job: int, frame: Frame):
+        location = None
+
+        # images go through shared memory, status texts and full rings through the pipe
+        if isinstance(frame.payload, bytes):
+            location = self.ring.write(frame.payload)
+
+        if location is not None:
+            frame = frame._replace(payload=b"")
+
+        self.send(("frame", job, frame, location))
+
+    def report_pipeline(self, name: str):
+        state = pipelines[name]
+        self.send(("pipeline", name, state.describe()))
+
+        state.loaded.wait()
+
+        described = {**state.describe(), "warmup": warmup_timings.get(name, [])}
+        self.send(("pipeline", name, described))
+
+    def start(self, job: int, command: str, options: dict):
+        sock = WorkerConnection()
+        handle_socket_connect(sock)
+
+        for key, value in options.items():
+            setattr(sock.state, key, value)
+
+        self.socks[job] = sock
+        self.acks[job] = asyncio.Event()
+        self.tasks[job] = asyncio.create_task(self.run(job, command))
+
+    async def run(self, job: int, command: str):
+        sock = self.socks[job]
+        ack = self.acks[job]
+
+        name, argument = parse_command(command)
+        generator = start_program(name, argument, sock.state.connection_id)
+
+        try:
+            async for frame in generator:
+                self.send_frame(job, frame)
+
+                await ack.wait()
+                ack.clear()
+        except Exception as error:
+            print(f"job failed: {error}")
+        finally:
+            await generator.aclose()
+
+            handle_socket_disconnect(sock)
+
+            del self.tasks[job], self.socks[job], self.acks[job]
+            self.send(("end", job))
+
+    def receive(self, message: tuple):
+        kind, job, *arguments = message
+
+        if kind == "stop":
+            self.closed.set()
+            return
+
+        if kind == "start":
+            self.start(job, *arguments)
+            return
+
+        if kind == "metrics":
+            self.send(("metrics", job, generate_latest().decode()))
+            return
+
+        # the job has ended already, which the server finds out from its end message
+        if job not in self.tasks:
+            return
+
+        if kind == "ack":
+            self.acks[job].set()
+        elif kind == "cancel":
+            cancel_denoise(self.socks[job].state.connection_id)
+        elif kind == "close":
+            self.tasks[job].cancel()
+
+    def read(self):
+        """Receives the server's messages on its own thread, until the server closes the pipe."""
+
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            self.loop.call_soon_threadsafe(self.receive, message)
+
+        self.loop.call_soon_threadsafe(self.closed.set)
+
+    async def serve(self):
+        start_pipelines()
+
+        for name in self.spec.pipelines:
+            threading.Thread(
+                target=self.report_pipeline, args=(name,), daemon=True
+            ).start()
+
+        threading.Thread(target=self.read, name="worker-read", daemon=True).start()
+
+        await self.closed.wait()
+
+
+async def serve(
+    spec: WorkerSpec, connection: Connection, ring_name: str, ring_size: int
+):
+    ring = FrameRing(ring_name, ring_size)
+
+    try:
+        await InferenceWorker(spec, connection, ring).serve()
+    finally:
+        ring.close()
@@ -1,22 +1,80 @@
+import functools
+
 import torch
 import PIL.Image as PILImage
 
+from utils.protocol import LATENT_HEADER, RGB_HEADER
+
 # https://huggingface.co/docs/diffusers/en/using-diffusers/callback#display-image-after-each-generation-step
 # https://huggingface.co/blog/TimothyAlexisVass/explaining-the-sdxl-latent-space
 WEIGHTS = ((60, -60, 25, -70), (60, -5, 15, -50), (60, 10, -5, -35))
+BIASES = (150, 140, 130)
+
+
+@functools.lru_cache(maxsize=None)
+def get_projection(dtype: torch.dtype, device: torch.device):
+    """
+    Projection tensors, built once per dtype and device.
+
+    Program 2 (sd 1.5) previews have always used this sdxl projection too.
+    """
+
+    # (4, 3), so that channels-last latents can be multiplied directly
+    weights_tensor = torch.tensor(WEIGHTS, dtype=dtype, device=device).t().contiguous()
+    biases_tensor = torch.tensor(BIASES, dtype=dtype, device=device)
+
+    return weights_tensor, biases_tensor
+
+
+def latents_to_rgb_tensor(latents):
+    """Projects a (batch, 4, height, width) latent batch to (batch, height, width, 3) uint8 rgb."""
+
+    weights, biases = get_projection(latents.dtype, latents.device)
+    batch, channels, height, width = latents.shape
+
+    pixels = latents.permute(0, 2, 3, 1).reshape(-1, channels)
+
+    # bias + matmul in one kernel, then clamp in place before narrowing to uint8
+    rgb = torch.addmm(biases, pixels, weights).clamp_(0, 255).to(torch.uint8)
+
+    return rgb.view(batch, height, width, 3)
 
 
 def latents_to_rgb(latents):
-    weights_tensor = torch.t(
-        torch.tensor(WEIGHTS, dtype=latents.dtype).to(latents.device)
-    )
-    biases_tensor = torch.tensor((150, 140, 130), dtype=latents.dtype).to(
-        latents.device
-    )
-    weights_s = torch.einsum("...lxy,lr -> ...rxy", latents, weights_tensor)
-    biases_s = biases_tensor.unsqueeze(-1).unsqueeze(-1)
-    rgb_tensor = weights_s + biases_s
-    image_array = rgb_tensor.clamp(0, 255)[0].byte().cpu().numpy()
-    image_array = image_array.transpose(1, 2, 0)
+    image_array = latents_to_rgb_tensor(latents[:1])[0].cpu().numpy()
 
     return PILImage.fromarray(image_array)
+
+
+def latents_to_rgb_bytes(latents) -> bytes:
+    """The rgb projection of the first latent as raw bytes, for clients that render it themselves."""
+
+    rgb = latents_to_rgb_tensor(latents[:1])[0]
+    height, width, _ = rgb.shape
+
+    return RGB_HEADER.pack(width, height) + rgb.cpu().numpy().tobytes()
+
+
+def quantize_latents(latents) -> bytes:
+    """The first latent, quantized to uint8 per channel, in channel-major order."""
+
+    latent = latents[0].float()
+    channels, height, width = latent.shape
+    values = latent.reshape(channels, -1)
+
+    offsets = values.amin(dim=1)
+    scales = (values.amax(dim=1) - offsets).clamp_(min=1e-6) / 255
+
+    # quantize on the latents' device, so only a quarter of the bytes are copied back
+    quantized = (
+        (values - offsets[:, None]).div_(scales[:, None]).round_().clamp_(0, 255)
+    )
+    quantized = quantized.to(torch.uint8)
+
+    parameters = torch.stack([offsets, scales], dim=1).cpu().numpy().astype("<f4")
+
+    return (
+        LATENT_HEADER.pack(channels, width, height)
+        + parameters.tobytes()
+        + quantized.cpu().numpy().tobytes()
+    )
@@ -1,38 +1,59 @@
-from utils.pipelines import text2img
+import os
+import time
 
+from utils.metrics import lora_switch_seconds, lora_switches_total
+from utils.pipelines import get_pipeline
 
+LORA_ADAPTER_NAME = "chuamiatee"
+
+# load the adapter at startup, so the first program 3 request does not pay for it
+LORA_PRELOAD = os.environ.get("LORA_PRELOAD", "1") == "1"
+
+# the adapter stays loaded once it is, and is only switched on and off afterwards
+lora_loaded = False
 lora_applied = False
 
 
 def load_chuamiatee_lora():
-    global lora_applied
+    global lora_loaded
 
-    if lora_applied:
+    if lora_loaded:
         return
 
     print("loading LoRA weight")
 
+    text2img = get_pipeline("text2img")
     text2img.load_lora_weights(
-        "heypoom/chuamiatee-1", weight_name="pytorch_lora_weights.safetensors"
+        "heypoom/chuamiatee-1",
+        weight_name="pytorch_lora_weights.safetensors",
+        adapter_name=LORA_ADAPTER_NAME,
     )
 
-    lora_applied = True
+    text2img.disable_lora()
+    lora_loaded = True
 
 
-def unload_chuamiatee_lora():
+def init_chuamiatee(is_chuamiatee: bool):
     global lora_applied
 
-    if not lora_applied:
+    if lora_applied == is_chuamiatee:
         return
 
-    print("unloading LoRA weight")
-
-    text2img.unload_lora_weights()
-    lora_applied = False
-
+    start_time = time.perf_counter()
+    text2img = get_pipeline("text2img")
 
-def init_chuamiatee(is_chuamiatee: bool):
     if is_chuamiatee:
         load_chuamiatee_lora()
+        text2img.enable_lora()
     else:
-        unload_chuamiatee_lora()
+        text2img.disable_lora()
+
+    lora_applied = is_chuamiatee
+
+    elapsed = time.perf_counter() - start_time
+    state = "enabled" if is_chuamiatee else "disabled"
+
+    lora_switches_total.labels(state).inc()
+    lora_switch_seconds.observe(elapsed)
+
+    print(f"{state} LoRA in {elapsed * 1000:.1f}ms")
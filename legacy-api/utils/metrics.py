@@ -0,0 +1,153 @@
+import time
+
+import torch
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from utils.connection_state import connections
+
+# seconds, from a warm single step up to a request waiting behind a full queue
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+STEP_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.35, 0.5, 1, 2, 5)
+ENCODE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5)
+
+# bytes, from a small raw preview up to a 1360x768 png
+SIZE_BUCKETS = (1e3, 4e3, 16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6)
+
+requests_total = Counter(
+    "legacy_api_requests_total", "Generations started, per program.", ["program"]
+)
+
+queue_wait_seconds = Histogram(
+    "legacy_api_queue_wait_seconds",
+    "Time from a request to its job starting on the pipeline.",
+    ["program"],
+    buckets=REQUEST_BUCKETS,
+)
+
+first_preview_seconds = Histogram(
+    "legacy_api_first_preview_seconds",
+    "Time from a request to its first progress or preview frame.",
+    ["program"],
+    buckets=REQUEST_BUCKETS,
+)
+
+request_seconds = Histogram(
+    "legacy_api_request_seconds",
+    "Time from a request to its last frame.",
+    ["program"],
+    buckets=REQUEST_BUCKETS,
+)
+
+step_seconds = Histogram(
+    "legacy_api_step_seconds",
+    "Duration of one diffusion step, per pipeline call.",
+    ["pipeline"],
+    buckets=STEP_BUCKETS,
+)
+
+encode_seconds = Histogram(
+    "legacy_api_encode_seconds",
+    "Time to turn a preview or final image into bytes, per format.",
+    ["kind", "format"],
+    buckets=ENCODE_BUCKETS,
+)
+
+encoded_bytes = Histogram(
+    "legacy_api_encoded_bytes",
+    "Size of encoded previews and final images, per format.",
+    ["kind", "format"],
+    buckets=SIZE_BUCKETS,
+)
+
+previews_skipped_total = Counter(
+    "legacy_api_previews_skipped_total",
+    "Steps that only sent a progress marker because of the preview policy.",
+    ["policy"],
+)
+
+cache_lookups_total = Counter(
+    "legacy_api_cache_lookups_total",
+    "Lookups in the prompt and result caches.",
+    ["cache", "result"],
+)
+
+previews_dropped_total = Counter(
+    "legacy_api_previews_dropped_total",
+    "Previews replaced by their progress marker, because the client or the encoder fell behind.",
+    ["reason"],
+)
+
+frames_sent_total = Counter(
+    "legacy_api_frames_sent_total", "Frames sent to clients.", ["type"]
+)
+
+bytes_sent_total = Counter(
+    "legacy_api_bytes_sent_total", "Websocket payload bytes sent to clients."
+)
+
+lora_switches_total = Counter(
+    "legacy_api_lora_switches_total", "LoRA adapter switches.", ["state"]
+)
+
+lora_switch_seconds = Histogram(
+    "legacy_api_lora_switch_seconds",
+    "Time to enable or disable the LoRA adapter.",
+    buckets=ENCODE_BUCKETS,
+)
+
+active_connections = Gauge(
+    "legacy_api_active_connections", "Open websocket connections."
+)
+active_connections.set_function(lambda: len(connections))
+
+gpu_memory_allocated_bytes = Gauge(
+    "legacy_api_gpu_memory_allocated_bytes", "GPU memory held by tensors."
+)
+gpu_memory_reserved_bytes = Gauge(
+    "legacy_api_gpu_memory_reserved_bytes", "GPU memory held by the caching allocator."
+)
+
+# the gauges stay at 0 on machines without cuda, e.g. when running the benchmarks
+if torch.cuda.is_available():
+    gpu_memory_allocated_bytes.set_function(torch.cuda.memory_allocated)
+    gpu_memory_reserved_bytes.set_function(torch.cuda.memory_reserved)
+
+# recorded where the pipelines run, which is an inference worker when there are any
+INFERENCE_METRICS = (
+    requests_total,
+    queue_wait_seconds,
+    first_preview_seconds,
+    request_seconds,
+    step_seconds,
+    encode_seconds,
+    encoded_bytes,
+    previews_skipped_total,
+    previews_dropped_total,
+    cache_lookups_total,
+    lora_switches_total,
+    lora_switch_seconds,
+    gpu_memory_allocated_bytes,
+    gpu_memory_reserved_bytes,
+)
+
+
+def create_step_timer(pipeline_name: str):
+    """
+    Returns a function to call at the end of every step, which observes the time since the last one.
+
+    It returns the (start, end) perf_counter() timestamps of the step.
+    """
+
+    last_step = time.perf_counter()
+
+    def on_step():
+        nonlocal last_step
+
+        start, now = last_step, time.perf_counter()
+        step_seconds.labels(pipeline_name).observe(now - start)
+        last_step = now
+
+        return start, now
+
+    return on_step
@@ -1,52 +1,414 @@
-import io
+import time
 import asyncio
+import concurrent.futures
 
-from utils.connection_state import get_is_connected
-from utils.latents import latents_to_rgb
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
+
+from utils.connection_state import (
+    get_client_id,
+    get_final_format,
+    get_is_connected,
+    get_preview_format,
+    get_priority,
+    record_dropped_frame,
+)
+from utils.delta import DeltaEncoder
+from utils.encoder import submit_delta, submit_image, submit_preview
+from utils.frame_buffer import FrameBuffer
 from utils.lora import init_chuamiatee
+from utils.metrics import (
+    create_step_timer,
+    first_preview_seconds,
+    previews_dropped_total,
+    previews_skipped_total,
+    queue_wait_seconds,
+    request_seconds,
+    requests_total,
+)
+from utils.pipelines import is_ready, start_loading, wait_for_pipeline
+from utils.preview_policy import PreviewPolicy
+from utils.protocol import (
+    ENCODING_DELTA,
+    FRAME_IMAGE,
+    FRAME_NAMES,
+    FRAME_PREVIEW,
+    FRAME_PROGRESS,
+    Frame,
+    image_frame,
+    is_status,
+    preview_frame,
+    progress_frame,
+    status_frame,
+)
+from utils.scheduler import BATCH_WINDOW_MS, QueueFullError, get_scheduler
+from utils.tracing import create_trace
 
+# conn_id -> cancel functions of that connection's in-flight requests
+cancellers: Dict[Optional[str], Set[Callable[[], None]]] = {}
 
-async def denoise(run, final_only=False, is_chuamiatee=False, conn_id=None):
-    queue = asyncio.Queue()
-    loop = asyncio.get_event_loop()
 
-    init_chuamiatee(is_chuamiatee)
+class Batchable(NamedTuple):
+    # requests with the same key can share one pipeline call, e.g. (program, width, height, steps)
+    key: tuple
 
-    def on_step_end(pipe, step, timestep, callback_kwargs):
-        is_connected = get_is_connected(conn_id)
-        should_interrupt = not is_connected
+    # this request's share of the batch, e.g. its prompt
+    input: Any
+
+    # run(inputs, on_step_end) runs the pipeline once for all inputs of the batch
+    run: Callable
+
+
+class DenoiseStream:
+    """
+    Delivers the progress markers, previews and final image of one request to its connection.
+
+    Images are encoded on the encoder pool and queued as frames holding a future,
+    so they still arrive in step order.
+    """
+
+    def __init__(
+        self,
+        loop,
+        conn_id=None,
+        final_only=False,
+        program="unknown",
+        recording: Optional[List[Frame]] = None,
+    ):
+        self.loop = loop
+        self.conn_id = conn_id
+        self.final_only = final_only
+        self.program = program
+        self.preview_format = get_preview_format(conn_id)
+        self.final_format = get_final_format(conn_id)
+        self.preview_policy = PreviewPolicy()
+
+        # delta previews chain from the previous one the client got, so they are encoded in send order
+        self.delta_encoder = (
+            DeltaEncoder() if self.preview_format.encoding == ENCODING_DELTA else None
+        )
+
+        self.closed = False
+        self.cancelled = False
+
+        self.request_time = time.perf_counter()
+        self.trace = create_trace(program)
+
+        # every frame, before the frame buffer drops the previews a slow client cannot keep up with
+        self.recording = recording
+
+        # per request, not per connection, so a connection's jobs never drop each other's previews
+        self.buffer = FrameBuffer(
+            on_drop=lambda: self.record_drop("slow_client"),
+            cancel_dropped=recording is None,
+        )
+
+    def start(self):
+        """Called on the worker thread when the pipeline picks up the request."""
+
+        now = time.perf_counter()
+
+        queue_wait_seconds.labels(self.program).observe(now - self.request_time)
+        self.trace.add_span("scheduler wait", self.request_time, now, "scheduler")
+
+    def put(self, frame: Optional[Frame]):
+        self.loop.call_soon_threadsafe(self.receive, frame, time.perf_counter())
+
+    def receive(self, frame: Optional[Frame], put_time: float):
+        # how long the event loop took to pick up a frame from the worker thread
+        self.trace.add_span("handoff", put_time, time.perf_counter(), "queue")
+
+        if self.recording is not None and frame is not None and not is_status(frame):
+            self.recording.append(frame)
+
+        self.buffer.put(frame)
+
+    def step_end(self, step, timestep, latents) -> bool:
+        """Emits the progress of one step. Returns true when the request should be interrupted."""
+
+        if self.closed:
+            return True
+
+        if self.cancelled:
+            self.put(status_frame("cancelled"))
+            self.close()
+
+            return True
+
+        should_interrupt = not get_is_connected(self.conn_id)
+        wants_preview = not self.final_only and self.preview_policy.should_preview()
+
+        if not self.final_only and not wants_preview:
+            previews_skipped_total.labels(self.preview_policy.policy).inc()
+
+        if wants_preview or should_interrupt:
+            preview = submit_preview(
+                latents,
+                self.trace,
+                self.preview_format,
+                on_cost=self.preview_policy.record_cost,
+            )
+            encoding = self.preview_format.encoding
+
+            if preview is not None:
+                self.put(preview_frame(step, timestep, preview, encoding))
+            else:
+                self.record_drop("encoder_busy")
+                self.put(progress_frame(step, timestep))
+        else:
+            self.put(progress_frame(step, timestep))
 
         if should_interrupt:
+            self.close()
+
+        return should_interrupt
+
+    def record_drop(self, reason: str):
+        record_dropped_frame(self.conn_id)
+        previews_dropped_total.labels(reason).inc()
+
+    def finish(self, image):
+        if self.closed:
+            return
+
+        image = submit_image(image, self.trace, self.final_format)
+
+        self.put(image_frame(image, self.final_format.encoding))
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.put(None)
+
+
+def run_single(run, stream: DenoiseStream, pipeline_name: str):
+    on_step = create_step_timer(pipeline_name)
+    last_step_end = None
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        nonlocal last_step_end
+
+        start, last_step_end = on_step()
+        stream.trace.add_span(f"step {step}", start, last_step_end, "unet")
+
+        if stream.step_end(step, timestep, callback_kwargs["latents"]):
             pipe._interrupt = True
 
-        loop.call_soon_threadsafe(queue.put_nowait, f"p:s={step}:t={timestep}")
+        return callback_kwargs
 
-        if not final_only or should_interrupt:
-            buffer = io.BytesIO()
-            latents = callback_kwargs["latents"]
-            latents_to_rgb(latents).convert("RGB").save(buffer, format="JPEG")
-            loop.call_soon_threadsafe(queue.put_nowait, buffer.getvalue())
+    result = run(on_step_end)
 
-        if should_interrupt:
-            loop.call_soon_threadsafe(queue.put_nowait, None)
+    # the pipeline decodes the latents with the vae after the last step
+    if last_step_end is not None:
+        stream.trace.add_span("vae decode", last_step_end, time.perf_counter(), "vae")
+    stream.finish(result.images[0])
+
+
+def run_batch(run, items: List[tuple[DenoiseStream, Any]], pipeline_name: str):
+    streams = [stream for stream, _ in items]
+    on_step = create_step_timer(pipeline_name)
+    last_step_end = None
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        nonlocal last_step_end
+
+        start, last_step_end = on_step()
+        latents = callback_kwargs["latents"]
+
+        for stream in streams:
+            stream.trace.add_span(
+                f"step {step}", start, last_step_end, "unet", batch=len(streams)
+            )
+
+        interrupted = [
+            stream.step_end(step, timestep, latents[i : i + 1])
+            for i, stream in enumerate(streams)
+        ]
+
+        # other clients are still waiting on the shared call
+        if all(interrupted):
+            pipe._interrupt = True
 
         return callback_kwargs
 
+    result = run([input for _, input in items], on_step_end)
+
+    if last_step_end is not None:
+        for stream in streams:
+            stream.trace.add_span(
+                "vae decode", last_step_end, time.perf_counter(), "vae"
+            )
+
+    for stream, image in zip(streams, result.images):
+        stream.finish(image)
+
+
+async def denoise(
+    run,
+    pipeline_name="text2img",
+    final_only=False,
+    is_chuamiatee=False,
+    conn_id=None,
+    batchable: Optional[Batchable] = None,
+    program="unknown",
+    recording: Optional[List[Frame]] = None,
+):
+    loop = asyncio.get_event_loop()
+    stream = DenoiseStream(
+        loop,
+        conn_id=conn_id,
+        final_only=final_only,
+        program=program,
+        recording=recording,
+    )
+
+    requests_total.labels(program).inc()
+
+    def on_position(position: int):
+        stream.put(status_frame(f"q:pos={position}"))
+
+    # runs on the scheduler's worker thread, which owns the pipeline
+    def prepare():
+        with stream.trace.span("prepare", "scheduler"):
+            # jobs queued while the server starts up wait here for their pipeline
+            wait_for_pipeline(pipeline_name)
+
+            # the LoRA only applies to text2img, so leave it alone for other pipelines
+            if pipeline_name == "text2img":
+                init_chuamiatee(is_chuamiatee)
+
     def start_denoise():
-        result = run(on_step_end)
-        image = result.images[0]
-        buffer = io.BytesIO()
-        image.save(buffer, format="JPEG")
-        loop.call_soon_threadsafe(queue.put_nowait, buffer.getvalue())
-        loop.call_soon_threadsafe(queue.put_nowait, None)
-
-    task = loop.run_in_executor(None, start_denoise)
-
-    while not task.done():
-        out = await queue.get()
-        yield out
-        queue.task_done()
-        if out is None:
-            break
-
-    return
+        try:
+            stream.start()
+            prepare()
+            run_single(run, stream, pipeline_name)
+        except Exception as error:
+            print(f"{pipeline_name} job failed: {error}")
+            raise
+        finally:
+            stream.close()
+
+    def start_denoise_batch(items):
+        try:
+            for item_stream, _ in items:
+                item_stream.start()
+
+            prepare()
+            print(f"running a batch of {len(items)} on {pipeline_name}")
+            run_batch(batchable.run, items, pipeline_name)
+        except Exception as error:
+            print(f"{pipeline_name} batch failed: {error}")
+            raise
+        finally:
+            for item_stream, _ in items:
+                item_stream.close()
+
+    # a pipeline outside the startup preload list loads on its first request
+    start_loading([pipeline_name])
+
+    if not is_ready(pipeline_name):
+        yield status_frame("q:loading")
+
+    scheduler = get_scheduler(pipeline_name)
+    should_batch = batchable is not None and BATCH_WINDOW_MS > 0
+
+    try:
+        job = scheduler.submit(
+            start_denoise,
+            conn_id=get_client_id(conn_id),
+            priority=get_priority(conn_id),
+            on_position=on_position,
+            batch_key=batchable.key if should_batch else None,
+            batch_item=(stream, batchable.input) if should_batch else None,
+            run_batch=start_denoise_batch if should_batch else None,
+            group=is_chuamiatee,
+        )
+    except QueueFullError:
+        yield status_frame("q:full")
+        return
+
+    # a running job stops at its next step, a pending one is dropped from the queue
+    def cancel():
+        stream.cancelled = True
+
+        if scheduler.cancel_pending(job):
+            stream.put(status_frame("cancelled"))
+            stream.close()
+
+    cancellers.setdefault(conn_id, set()).add(cancel)
+
+    has_stepped = False
+    is_complete = False
+
+    try:
+        while True:
+            out = await stream.buffer.get()
+
+            if out is None:
+                break
+
+            if isinstance(out.payload, concurrent.futures.Future):
+                try:
+                    with stream.trace.span("encode wait", "queue"):
+                        payload = await asyncio.wrap_future(out.payload)
+
+                    # only previews that survived the frame buffer become deltas
+                    if out.type == FRAME_PREVIEW and out.encoding == ENCODING_DELTA:
+                        delta = submit_delta(
+                            stream.delta_encoder, payload, stream.trace
+                        )
+                        payload = await asyncio.wrap_future(delta)
+
+                    out = out._replace(payload=payload)
+                except Exception as error:
+                    print(f"failed to encode frame: {error}")
+
+                    if out.type != FRAME_PREVIEW:
+                        continue
+
+                    # the step still happened, even if its preview is lost
+                    out = progress_frame(out.step, out.timestep)
+
+            if out.type in (FRAME_PROGRESS, FRAME_PREVIEW) and not has_stepped:
+                has_stepped = True
+                first_preview_seconds.labels(program).observe(
+                    time.perf_counter() - stream.request_time
+                )
+
+            is_complete = out.type == FRAME_IMAGE
+
+            # resumes once the connection's writer has sent the frame
+            with stream.trace.span("send", "websocket", frame=FRAME_NAMES[out.type]):
+                yield out
+    finally:
+        # nobody is reading anymore, so stop the job or give up its slot
+        stream.cancelled = True
+        scheduler.cancel_pending(job)
+
+        cancellers[conn_id].discard(cancel)
+
+        if not cancellers[conn_id]:
+            del cancellers[conn_id]
+
+        # cancelled and failed requests would skew the latencies
+        end_time = time.perf_counter()
+
+        if is_complete:
+            request_seconds.labels(program).observe(end_time - stream.request_time)
+
+        stream.trace.add_span(
+            "request", stream.request_time, end_time, "request", complete=is_complete
+        )
+        stream.trace.save()
+
+
+def cancel_denoise(conn_id: str) -> int:
+    """Cancels every in-flight request of a connection. Returns how many there were."""
+
+    cancels = list(cancellers.get(conn_id, ()))
+
+    for cancel in cancels:
+        cancel()
+
+    return len(cancels)
@@ -1,24 +1,177 @@
+import os
 import time
+import importlib
+import threading
 import torch
 
+from typing import Callable, Dict, Iterable, List, Optional
+
 from diffusers import StableDiffusionImg2ImgPipeline, AutoPipelineForText2Image
 
-DEVICE = "cuda"
+DEVICE = os.environ.get("TORCH_DEVICE", "cuda")
+
+# alternative implementations, e.g. "text2img=benchmarks.stub_pipelines:load_text2img"
+PIPELINE_LOADERS = os.environ.get("PIPELINE_LOADERS", "")
+
+# comma separated pipelines to load at startup, the others load on first use.
+# unset means every pipeline that an enabled program needs.
+PRELOAD_PIPELINES = os.environ.get("PRELOAD_PIPELINES")
+
 
-start_time = time.time()
+def load_text2img():
+    text2img = AutoPipelineForText2Image.from_pretrained(
+        "stabilityai/stable-diffusion-xl-base-1.0",
+        torch_dtype=torch.float16,
+    ).to(DEVICE)
 
-text2img = AutoPipelineForText2Image.from_pretrained(
-    "stabilityai/stable-diffusion-xl-base-1.0",
-    torch_dtype=torch.float16,
-).to(DEVICE)
+    text2img.enable_xformers_memory_efficient_attention()
+
+    return text2img
 
-text2img.enable_xformers_memory_efficient_attention()
 
 # Program 2 pipeline: Epic Poem of Malaya, Image to Image
-img2img = StableDiffusionImg2ImgPipeline.from_pretrained(
-    "runwayml/stable-diffusion-v1-5",
-).to(DEVICE)
+def load_img2img():
+    img2img = StableDiffusionImg2ImgPipeline.from_pretrained(
+        "runwayml/stable-diffusion-v1-5",
+    ).to(DEVICE)
+
+    img2img.enable_xformers_memory_efficient_attention()
+
+    return img2img
+
+
+def import_loader(path: str) -> Callable:
+    """A loader given as "module:function", imported when the pipeline is first loaded."""
+
+    module_name, _, function_name = path.partition(":")
+
+    def load():
+        return getattr(importlib.import_module(module_name), function_name)()
+
+    return load
+
+
+LOADERS: Dict[str, Callable] = {
+    "text2img": load_text2img,
+    "img2img": load_img2img,
+}
+
+for entry in filter(None, PIPELINE_LOADERS.split(",")):
+    name, _, path = entry.partition("=")
+    LOADERS[name.strip()] = import_loader(path.strip())
+
+
+class PipelineState:
+    def __init__(self, name: str):
+        self.name = name
+        self.status = "pending"
+        self.pipe = None
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+
+        # set once the pipeline is usable, or has failed to load
+        self.loaded = threading.Event()
+
+        # run on the loading thread before the pipeline is marked as ready
+        self.on_ready: List[Callable] = []
+
+    def describe(self) -> dict:
+        return {
+            "status": self.status,
+            "loadSeconds": self.load_seconds,
+            "error": self.error,
+        }
+
+
+pipelines: Dict[str, PipelineState] = {name: PipelineState(name) for name in LOADERS}
+
+# loading can be started from the event loop and from scheduler threads alike
+loading_lock = threading.Lock()
+
+
+def register_pipeline(name: str, loader: Callable):
+    """Adds a pipeline, or replaces the loader of one that has not started loading yet."""
+
+    LOADERS[name] = loader
+
+    if name not in pipelines:
+        pipelines[name] = PipelineState(name)
+
+
+def on_ready(name: str, hook: Callable):
+    """Runs hook(pipe) once the pipeline is loaded, before any job can use it."""
+
+    pipelines[name].on_ready.append(hook)
+
+
+def load_pipeline(state: PipelineState):
+    state.status = "loading"
+    start_time = time.time()
+
+    try:
+        state.pipe = LOADERS[state.name]()
+
+        for hook in state.on_ready:
+            hook(state.pipe)
+
+        state.status = "ready"
+    except Exception as error:
+        state.status = "failed"
+        state.error = str(error)
+    finally:
+        state.load_seconds = time.time() - start_time
+        state.loaded.set()
+
+    print(f"{state.name} pipeline {state.status} in {state.load_seconds:.1f}s")
+
+
+def start_loading(names: Optional[Iterable[str]] = None):
+    """Loads the given pipelines, or every registered one, concurrently in the background."""
+
+    for name in pipelines if names is None else names:
+        state = pipelines[name]
+
+        with loading_lock:
+            if state.status != "pending":
+                continue
+
+            # mark before the thread starts, so a second call cannot load it twice
+            state.status = "loading"
+
+        threading.Thread(
+            target=load_pipeline, args=(state,), name=f"load-{state.name}", daemon=True
+        ).start()
+
+
+def is_ready(name: str) -> bool:
+    return pipelines[name].status == "ready"
+
+
+def wait_for_pipeline(name: str):
+    """Waits for a pipeline to load, and starts loading it if nothing has asked for it yet."""
+
+    start_loading([name])
+
+    state = pipelines[name]
+    state.loaded.wait()
+
+    if state.status != "ready":
+        raise RuntimeError(f"{name} pipeline is unavailable: {state.error}")
+
+
+def get_preload_pipelines(required: Iterable[str]) -> List[str]:
+    if PRELOAD_PIPELINES is None:
+        return list(required)
+
+    return [name.strip() for name in PRELOAD_PIPELINES.split(",") if name.strip()]
+
+
+def get_pipeline(name: str):
+    """The loaded pipeline. Use wait_for_pipeline first if it may still be loading."""
+
+    pipe = pipelines[name].pipe
 
-img2img.enable_xformers_memory_efficient_attention()
+    if pipe is None:
+        raise RuntimeError(f"{name} pipeline is not loaded")
 
-print(f"two diffusion pipelines ready in {time.time() - start_time}s")
+    return pipe
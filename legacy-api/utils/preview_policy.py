@@ -0,0 +1,104 @@
+import os
+import time
+
+from typing import Optional
+
+# which steps get a preview: "every" step, every "nth" step, a target "fps",
+# or "adaptive", which keeps previews within a share of the step time
+PREVIEW_POLICY = os.environ.get("PREVIEW_POLICY", "every")
+PREVIEW_EVERY_N = int(os.environ.get("PREVIEW_EVERY_N", "2"))
+PREVIEW_TARGET_FPS = float(os.environ.get("PREVIEW_TARGET_FPS", "10"))
+PREVIEW_MAX_COST = float(os.environ.get("PREVIEW_MAX_COST", "0.25"))
+
+POLICIES = ("every", "nth", "fps", "adaptive")
+
+if PREVIEW_POLICY not in POLICIES:
+    raise ValueError(f"unknown PREVIEW_POLICY: {PREVIEW_POLICY}")
+
+# weight of the newest sample in the moving averages of step and preview times
+SMOOTHING = 0.3
+
+
+def moving_average(average: Optional[float], sample: float) -> float:
+    if average is None:
+        return sample
+
+    return average + SMOOTHING * (sample - average)
+
+
+class PreviewPolicy:
+    """
+    Decides on every step of one request whether it gets a preview, or only a progress marker.
+
+    The first step always gets one, so the time to first preview does not change.
+    Safe to call from the diffusion thread while the encoder reports preview costs.
+    """
+
+    def __init__(
+        self,
+        policy: str = PREVIEW_POLICY,
+        every_n: int = PREVIEW_EVERY_N,
+        fps: float = PREVIEW_TARGET_FPS,
+        max_cost: float = PREVIEW_MAX_COST,
+    ):
+        self.policy = policy
+        self.every_n = max(1, every_n)
+        self.fps = fps
+        self.max_cost = max_cost
+
+        self.steps = 0
+        self.last_step: Optional[float] = None
+        self.last_preview: Optional[float] = None
+
+        self.step_seconds: Optional[float] = None
+        self.cost_seconds: Optional[float] = None
+
+        # adaptive mode: seconds of preview work the steps so far have earned
+        self.credit = 0.0
+
+    def should_preview(self) -> bool:
+        """Called once per step, in step order."""
+
+        now = time.perf_counter()
+        index = self.steps
+        self.steps += 1
+
+        if self.last_step is not None:
+            self.step_seconds = moving_average(self.step_seconds, now - self.last_step)
+
+        self.last_step = now
+
+        if index == 0 or self.policy == "every":
+            is_preview = True
+        elif self.policy == "nth":
+            is_preview = index % self.every_n == 0
+        elif self.policy == "fps":
+            is_preview = now - self.last_preview >= 1 / self.fps
+        else:
+            is_preview = self.spend_credit()
+
+        if is_preview:
+            self.last_preview = now
+
+        return is_preview
+
+    def spend_credit(self) -> bool:
+        # until the first preview is encoded there is nothing to budget for
+        if self.cost_seconds is None or self.step_seconds is None:
+            return True
+
+        # each step earns its share of time for previews, saved up for at most one preview
+        earned = self.max_cost * self.step_seconds
+        self.credit = min(self.credit + earned, self.cost_seconds)
+
+        if self.credit < self.cost_seconds:
+            return False
+
+        self.credit -= self.cost_seconds
+
+        return True
+
+    def record_cost(self, seconds: float):
+        """Called from the encoder with the time one preview took to render and encode."""
+
+        self.cost_seconds = moving_average(self.cost_seconds, seconds)
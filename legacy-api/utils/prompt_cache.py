@@ -0,0 +1,144 @@
+import os
+import time
+
+from collections import OrderedDict
+from typing import Iterable, List, NamedTuple
+
+import torch
+
+from utils import lora
+from utils.metrics import cache_lookups_total
+from utils.pipelines import get_pipeline
+
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", "128"))
+
+# cue sheet to encode at startup, e.g. ../requester/data/cues.json
+PROMPT_CACHE_WARMUP_CUES = os.environ.get("PROMPT_CACHE_WARMUP_CUES")
+
+# keep the sdxl text encoders on the cpu after warmup, until the first prompt outside the cues
+PROMPT_CACHE_OFFLOAD_ENCODERS = (
+    os.environ.get("PROMPT_CACHE_OFFLOAD_ENCODERS", "0") == "1"
+)
+
+
+class PromptEmbeddings(NamedTuple):
+    prompt_embeds: torch.Tensor
+    negative_prompt_embeds: torch.Tensor
+    pooled_prompt_embeds: torch.Tensor
+    negative_pooled_prompt_embeds: torch.Tensor
+
+    def as_kwargs(self) -> dict:
+        return self._asdict()
+
+
+def concat_embeddings(embeddings: List[PromptEmbeddings]) -> PromptEmbeddings:
+    """Stacks per-prompt embeddings into one batch."""
+
+    return PromptEmbeddings(*(torch.cat(tensors) for tensors in zip(*embeddings)))
+
+
+class PromptCache:
+    """
+    LRU of sdxl encode_prompt outputs, keyed by prompt text.
+
+    Only used from the text2img worker thread, which owns the text encoders.
+    """
+
+    def __init__(self, pipeline_name: str, max_size: int = PROMPT_CACHE_SIZE):
+        self.pipeline_name = pipeline_name
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple[str, bool], PromptEmbeddings] = OrderedDict()
+        self.encoders_offloaded = False
+
+    @property
+    def pipe(self):
+        return get_pipeline(self.pipeline_name)
+
+    def get(self, prompt: str) -> PromptEmbeddings:
+        # a lora can patch the text encoders too, so its embeddings are kept apart
+        key = (prompt, lora.lora_applied)
+        embeddings = self.entries.get(key)
+
+        if embeddings is not None:
+            cache_lookups_total.labels("prompt", "hit").inc()
+            self.entries.move_to_end(key)
+
+            return embeddings
+
+        cache_lookups_total.labels("prompt", "miss").inc()
+        embeddings = self.encode(prompt)
+
+        self.entries[key] = embeddings
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return embeddings
+
+    def get_batch(self, prompts: Iterable[str]) -> PromptEmbeddings:
+        return concat_embeddings([self.get(prompt) for prompt in prompts])
+
+    def encode(self, prompt: str) -> PromptEmbeddings:
+        self.restore_encoders()
+
+        with torch.inference_mode():
+            return PromptEmbeddings(
+                *self.pipe.encode_prompt(
+                    prompt,
+                    device=self.pipe.unet.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=True,
+                )
+            )
+
+    def warm(self, prompts: Iterable[str]) -> int:
+        prompts = list(dict.fromkeys(prompts))
+
+        for prompt in prompts:
+            self.get(prompt)
+
+        return len(prompts)
+
+    def offload_if_covered(self, working_set_size: int):
+        """Moves the text encoders off the gpu if the cache can hold every known prompt."""
+
+        if not PROMPT_CACHE_OFFLOAD_ENCODERS:
+            return
+
+        if working_set_size > self.max_size:
+            print("prompt cache is smaller than the working set, keeping encoders")
+            return
+
+        self.offload_encoders()
+
+    def offload_encoders(self):
+        self.pipe.text_encoder.to("cpu")
+        self.pipe.text_encoder_2.to("cpu")
+        self.encoders_offloaded = True
+
+        print("moved text encoders off the gpu")
+
+    def restore_encoders(self):
+        """
+        Moves offloaded text encoders back to the gpu, for good.
+
+        A miss means the cues do not cover the live prompts, and moving the encoders for every miss
+        would put two transfers of text_encoder_2 on the request path each time.
+        """
+
+        if not self.encoders_offloaded:
+            return
+
+        start = time.perf_counter()
+        device = self.pipe.unet.device
+        self.pipe.text_encoder.to(device)
+        self.pipe.text_encoder_2.to(device)
+        self.encoders_offloaded = False
+
+        print(
+            f"prompt outside the cues, moved text encoders back to the gpu "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+
+prompt_cache = PromptCache("text2img")
@@ -0,0 +1,203 @@
+import struct
+
+from typing import Any, Dict, List, NamedTuple, Optional, Union
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOLS = (PROTOCOL_V1, PROTOCOL_V2)
+
+FRAME_READY = 1
+FRAME_PROGRESS = 2
+FRAME_PREVIEW = 3
+FRAME_IMAGE = 4
+FRAME_DONE = 5
+FRAME_STATUS = 6
+
+FRAME_NAMES = {
+    FRAME_READY: "ready",
+    FRAME_PROGRESS: "progress",
+    FRAME_PREVIEW: "preview",
+    FRAME_IMAGE: "image",
+    FRAME_DONE: "done",
+    FRAME_STATUS: "status",
+}
+
+ENCODING_NONE = 0
+ENCODING_JPEG = 1
+ENCODING_TEXT = 2
+
+# raw previews, rendered by the client: RGB_HEADER or LATENT_HEADER, then the pixels
+ENCODING_RGB = 3
+ENCODING_LATENT = 4
+
+ENCODING_WEBP = 5
+ENCODING_PNG = 6
+
+# raw rgb previews as a keyframe, then deltas against the previous previews of the job.
+# DELTA_HEADER, then zlib compressed data, see utils.delta.DeltaDecoder.
+ENCODING_DELTA = 7
+
+# formats a connection can ask for with FINAL:<format>
+IMAGE_ENCODINGS: Dict[str, int] = {
+    "jpeg": ENCODING_JPEG,
+    "webp": ENCODING_WEBP,
+    "png": ENCODING_PNG,
+}
+
+# formats a connection can ask for with PREVIEW:<format>
+PREVIEW_ENCODINGS: Dict[str, int] = {
+    **IMAGE_ENCODINGS,
+    "rgb": ENCODING_RGB,
+    "latent": ENCODING_LATENT,
+    "delta": ENCODING_DELTA,
+}
+
+ENCODING_NAMES = {encoding: name for name, encoding in PREVIEW_ENCODINGS.items()}
+
+# job ids are u32, and 0 marks frames that belong to the connection rather than a job
+MAX_JOB_ID = 0xFFFFFFFF
+
+# version, frame type, job id, step, timestep, payload encoding, reserved
+V2_HEADER = struct.Struct("<BBIHHBx")
+
+# width, height, then height * width * 3 bytes of uint8 rgb
+RGB_HEADER = struct.Struct("<HH")
+
+# channels, padding, width, height, padding, then a float32 (offset, scale) pair
+# per channel, then channels * height * width uint8 values, where latent = offset + value * scale.
+# 8 bytes, so the float32 pairs are 4-byte aligned after either protocol's prefix,
+# and a browser can view them as a Float32Array without copying.
+LATENT_HEADER = struct.Struct("<BxHHxx")
+
+# kind, quantization, width, height
+DELTA_HEADER = struct.Struct("<BBHH")
+
+# uint8 pixels, divided by the quantization and rounded
+DELTA_KEYFRAME = 0
+
+# int8 residuals against the previous frame, or its extrapolation from the last two frames
+DELTA_PREVIOUS = 1
+DELTA_TREND = 2
+
+
+class ImageFormat(NamedTuple):
+    encoding: int = ENCODING_JPEG
+
+    # jpeg and webp only, none keeps the encoder's default
+    quality: Optional[int] = None
+
+    # longest side in pixels, larger images are scaled down. ignored by the raw preview formats.
+    max_size: Optional[int] = None
+
+
+DEFAULT_IMAGE_FORMAT = ImageFormat()
+
+
+def parse_image_format(text: str, encodings: Dict[str, int]) -> Optional[ImageFormat]:
+    """Parses "webp,quality=70,size=512", or returns None if it is not valid."""
+
+    name, *options = [part.strip() for part in text.split(",")]
+
+    if name not in encodings:
+        return None
+
+    values = {}
+
+    for option in options:
+        key, _, value = option.partition("=")
+
+        # isdigit() alone also accepts digits such as "²", which int() refuses
+        if key not in ("quality", "size") or not (value.isascii() and value.isdigit()):
+            return None
+
+        values[key] = int(value)
+
+    if not 1 <= values.get("quality", 100) <= 100 or values.get("size") == 0:
+        return None
+
+    return ImageFormat(encodings[name], values.get("quality"), values.get("size"))
+
+
+class Frame(NamedTuple):
+    """One outbound message of a generation, serialized per connection by encode_v1 or encode_v2."""
+
+    type: int
+    step: int = 0
+    timestep: int = 0
+    encoding: int = ENCODING_NONE
+
+    # bytes, the text of a status frame, or a future of bytes while it is still being encoded
+    payload: Any = b""
+
+
+def progress_frame(step: int, timestep) -> Frame:
+    return Frame(FRAME_PROGRESS, step=step, timestep=int(timestep))
+
+
+def preview_frame(step: int, timestep, payload, encoding=ENCODING_JPEG) -> Frame:
+    return Frame(
+        FRAME_PREVIEW,
+        step=step,
+        timestep=int(timestep),
+        encoding=encoding,
+        payload=payload,
+    )
+
+
+def image_frame(payload, encoding=ENCODING_JPEG) -> Frame:
+    return Frame(FRAME_IMAGE, encoding=encoding, payload=payload)
+
+
+def status_frame(text: str) -> Frame:
+    return Frame(FRAME_STATUS, encoding=ENCODING_TEXT, payload=text)
+
+
+READY = Frame(FRAME_READY)
+DONE = Frame(FRAME_DONE)
+
+
+def is_status(frame: Frame) -> bool:
+    return frame.type == FRAME_STATUS
+
+
+def encode_v1(frame: Frame) -> List[Union[str, bytes]]:
+    """The original text and binary messages, where a preview is a progress marker followed by its image."""
+
+    if frame.type == FRAME_READY:
+        return ["ready"]
+
+    if frame.type == FRAME_DONE:
+        return ["done"]
+
+    if frame.type == FRAME_STATUS:
+        return [frame.payload]
+
+    if frame.type == FRAME_IMAGE:
+        return [frame.payload]
+
+    progress = f"p:s={frame.step}:t={frame.timestep}"
+
+    if frame.type == FRAME_PREVIEW:
+        return [progress, frame.payload]
+
+    return [progress]
+
+
+def encode_v2(frame: Frame, job_id: int) -> bytes:
+    """A single binary message: a 12 byte little-endian header, then the payload."""
+
+    payload = frame.payload
+
+    if isinstance(payload, str):
+        payload = payload.encode()
+
+    header = V2_HEADER.pack(
+        PROTOCOL_V2,
+        frame.type,
+        job_id,
+        frame.step,
+        frame.timestep,
+        frame.encoding,
+    )
+
+    return header + payload
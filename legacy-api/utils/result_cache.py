@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import struct
+import asyncio
+import hashlib
+import threading
+import concurrent.futures
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Callable, List, NamedTuple, Optional
+
+from utils.connection_state import (
+    get_final_format,
+    get_is_connected,
+    get_preview_format,
+)
+from utils.delta import DeltaEncoder
+from utils.encoder import submit_delta
+from utils.metrics import cache_lookups_total
+from utils.protocol import (
+    DEFAULT_IMAGE_FORMAT,
+    ENCODING_DELTA,
+    FRAME_IMAGE,
+    FRAME_PREVIEW,
+    FRAME_PROGRESS,
+    Frame,
+    ImageFormat,
+    progress_frame,
+)
+
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "0") == "1"
+RESULT_CACHE_DIR = Path(os.environ.get("RESULT_CACHE_DIR", "./cache/results"))
+RESULT_CACHE_MEMORY_ENTRIES = int(os.environ.get("RESULT_CACHE_MEMORY_ENTRIES", "32"))
+RESULT_CACHE_DISK_MB = float(os.environ.get("RESULT_CACHE_DISK_MB", "2048"))
+
+# delay between replayed steps, so cached previews still animate like a live generation
+RESULT_CACHE_REPLAY_STEP_MS = float(os.environ.get("RESULT_CACHE_REPLAY_STEP_MS", "50"))
+
+# bump when the stored frames change shape, so older entries are no longer found
+RESULT_CACHE_FORMAT = 1
+
+# a cache file is the length of its key, the key as json, then each frame and its payload
+KEY_LENGTH = struct.Struct("<I")
+
+# type, step, timestep, encoding, payload length
+FRAME_RECORD = struct.Struct("<BHHBI")
+
+
+class ResultKey(NamedTuple):
+    program: str
+    prompt: str = ""
+    strength: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+    # recorded frames are replayed as is, so each format, quality and size is cached on its own
+    preview_format: ImageFormat = DEFAULT_IMAGE_FORMAT
+    final_format: ImageFormat = DEFAULT_IMAGE_FORMAT
+
+
+def normalize_prompt(prompt: str) -> str:
+    # the clip tokenizers lowercase and split on whitespace anyway
+    return " ".join(prompt.lower().split())
+
+
+def create_key(program: str, prompt: str = "", **kwargs) -> ResultKey:
+    return ResultKey(program, normalize_prompt(prompt), **kwargs)
+
+
+class ResultCache:
+    """
+    In-memory LRU of recorded generations, backed by a size-capped directory on disk.
+
+    The memory tier is only used from the event loop, the disk tier is meant to run on an executor.
+    """
+
+    def __init__(self, directory: Path, memory_entries: int, disk_bytes: int):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.memory: OrderedDict[ResultKey, List[Frame]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def path_of(self, key: ResultKey) -> Path:
+        digest = hashlib.sha256(
+            repr((RESULT_CACHE_FORMAT, tuple(key))).encode()
+        ).hexdigest()
+
+        return self.directory / f"{digest}.frames"
+
+    def recall(self, key: ResultKey) -> Optional[List[Frame]]:
+        frames = self.memory.get(key)
+
+        if frames is not None:
+            self.memory.move_to_end(key)
+
+        return frames
+
+    def remember(self, key: ResultKey, frames: List[Frame]):
+        self.memory[key] = frames
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def read_disk(self, key: ResultKey) -> Optional[List[Frame]]:
+        path = self.path_of(key)
+
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            stored_key, frames = unpack_frames(data)
+        except Exception as error:
+            print(f"discarding unreadable cache entry {path.name}: {error}")
+            path.unlink(missing_ok=True)
+            return None
+
+        # guard against digest collisions
+        if stored_key != pack_key(key):
+            return None
+
+        # mark as recently used for eviction, unless another thread or worker just evicted it
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return frames
+
+    def write_disk(self, key: ResultKey, frames: List[Frame]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        path = self.path_of(key)
+        temp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(pack_frames(key, frames))
+
+            os.replace(temp_path, path)
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+
+        for path in self.directory.glob("*.frames"):
+            # other threads, and other workers sharing the directory, evict entries too
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+
+        total = sum(stat.st_size for _, stat in entries)
+
+        # least recently used first
+        for path, stat in sorted(entries, key=lambda entry: entry[1].st_mtime):
+            if total <= self.disk_bytes:
+                break
+
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+
+def pack_key(key: ResultKey) -> bytes:
+    return json.dumps(key).encode()
+
+
+def pack_frames(key: ResultKey, frames: List[Frame]) -> bytes:
+    """Stores the raw frames, so reading an entry back never runs code from the cache directory."""
+
+    packed_key = pack_key(key)
+    parts = [KEY_LENGTH.pack(len(packed_key)), packed_key]
+
+    for frame in frames:
+        header = FRAME_RECORD.pack(
+            frame.type, frame.step, frame.timestep, frame.encoding, len(frame.payload)
+        )
+        parts += [header, frame.payload]
+
+    return b"".join(parts)
+
+
+def unpack_frames(data: bytes) -> tuple[bytes, List[Frame]]:
+    (key_length,) = KEY_LENGTH.unpack_from(data)
+    offset = KEY_LENGTH.size + key_length
+    packed_key = data[KEY_LENGTH.size : offset]
+    frames = []
+
+    while offset < len(data):
+        frame_type, step, timestep, encoding, size = FRAME_RECORD.unpack_from(
+            data, offset
+        )
+        offset += FRAME_RECORD.size
+
+        if offset + size > len(data):
+            raise ValueError("truncated frame")
+
+        payload = data[offset : offset + size]
+        offset += size
+
+        frames.append(Frame(frame_type, step, timestep, encoding, payload))
+
+    return packed_key, frames
+
+
+result_cache = ResultCache(
+    RESULT_CACHE_DIR,
+    memory_entries=RESULT_CACHE_MEMORY_ENTRIES,
+    disk_bytes=int(RESULT_CACHE_DISK_MB * 1024 * 1024),
+)
+
+
+async def replay(frames: List[Frame]) -> AsyncIterator[Frame]:
+    delay = RESULT_CACHE_REPLAY_STEP_MS / 1000
+
+    # delta previews are stored as raw rgb, as each replay chains them anew
+    delta_encoder = DeltaEncoder()
+
+    for frame in frames:
+        if frame.type in (FRAME_PROGRESS, FRAME_PREVIEW) and delay > 0:
+            await asyncio.sleep(delay)
+
+        if frame.type == FRAME_PREVIEW and frame.encoding == ENCODING_DELTA:
+            delta = submit_delta(delta_encoder, frame.payload)
+            frame = frame._replace(payload=await asyncio.wrap_future(delta))
+
+        yield frame
+
+
+async def resolve_recording(recording: List[Frame]) -> Optional[List[Frame]]:
+    """Waits for the encodes of recorded frames. Returns None if the final image failed."""
+
+    frames = []
+
+    for frame in recording:
+        if isinstance(frame.payload, concurrent.futures.Future):
+            try:
+                frame = frame._replace(payload=await asyncio.wrap_future(frame.payload))
+            except Exception:
+                if frame.type != FRAME_PREVIEW:
+                    return None
+
+                frame = progress_frame(frame.step, frame.timestep)
+
+        frames.append(frame)
+
+    return frames
+
+
+async def with_result_cache(
+    key: ResultKey, generate: Callable[..., AsyncIterator[Frame]], conn_id=None
+) -> AsyncIterator[Frame]:
+    """
+    Replays a cached generation for the key, or runs generate() and records its frames for next time.
+
+    generate takes a recording list, which denoise fills before its frame buffer,
+    so a slow client does not leave gaps in the previews of later replays.
+    """
+
+    if not RESULT_CACHE:
+        async for out in generate():
+            yield out
+
+        return
+
+    loop = asyncio.get_event_loop()
+    key = key._replace(
+        preview_format=get_preview_format(conn_id),
+        final_format=get_final_format(conn_id),
+    )
+    frames = result_cache.recall(key)
+
+    if frames is None:
+        try:
+            frames = await loop.run_in_executor(None, result_cache.read_disk, key)
+        except OSError as error:
+            # the disk tier only ever degrades to a miss
+            print(f"result cache read failed: {error}")
+            frames = None
+
+        if frames is not None:
+            result_cache.remember(key, frames)
+
+    if frames is not None:
+        result_cache.hits += 1
+        cache_lookups_total.labels("result", "hit").inc()
+        print(f"replaying cached {key.program} result")
+
+        async for out in replay(frames):
+            yield out
+
+        return
+
+    result_cache.misses += 1
+    cache_lookups_total.labels("result", "miss").inc()
+    recording: List[Frame] = []
+    start_time = time.time()
+
+    async for out in generate(recording=recording):
+        yield out
+
+    # an interrupted generation ends early, so it must not be replayed
+    is_complete = get_is_connected(conn_id) and bool(recording)
+    is_complete = is_complete and recording[-1].type == FRAME_IMAGE
+    recorded = await resolve_recording(recording) if is_complete else None
+
+    if recorded is not None:
+        result_cache.remember(key, recorded)
+
+        try:
+            await loop.run_in_executor(None, result_cache.write_disk, key, recorded)
+        except OSError as error:
+            print(f"result cache write failed: {error}")
+            return
+
+        print(f"cached {key.program} result in {time.time() - start_time:.2f}s")
@@ -0,0 +1,318 @@
+import os
+import time
+import threading
+import concurrent.futures
+
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional
+
+# lower value is served first
+PRIORITY_PRESENTER = 0
+PRIORITY_KIOSK = 1
+
+PRIORITIES: Dict[str, int] = {
+    "presenter": PRIORITY_PRESENTER,
+    "kiosk": PRIORITY_KIOSK,
+}
+
+# maximum number of jobs waiting per pipeline, excluding the running one
+MAX_PENDING_JOBS = int(os.environ.get("SCHEDULER_MAX_PENDING_JOBS", "16"))
+
+# how long to hold a batchable job while waiting for compatible ones, 0 disables batching
+BATCH_WINDOW_MS = float(os.environ.get("SCHEDULER_BATCH_WINDOW_MS", "0"))
+MAX_BATCH_SIZE = int(os.environ.get("SCHEDULER_MAX_BATCH_SIZE", "4"))
+
+# consecutive jobs of the same group (e.g. LoRA on or off) that may skip ahead of other connections
+MAX_GROUP_RUN = int(os.environ.get("SCHEDULER_MAX_GROUP_RUN", "4"))
+
+Lanes = Dict[int, "OrderedDict[Optional[str], deque[Job]]"]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(
+        self,
+        run: Callable,
+        conn_id: Optional[str] = None,
+        priority: int = PRIORITY_KIOSK,
+        on_position: Optional[Callable[[int], None]] = None,
+        batch_key: Optional[tuple] = None,
+        batch_item: Any = None,
+        run_batch: Optional[Callable[[List[Any]], Any]] = None,
+        group: Any = None,
+    ):
+        self.run = run
+        self.conn_id = conn_id
+        self.priority = priority
+        self.on_position = on_position
+
+        # jobs with the same batch key can be merged into one run_batch(items) call
+        self.batch_key = batch_key
+        self.batch_item = batch_item
+        self.run_batch = run_batch
+
+        # switching between groups has a cost, so the scheduler keeps them together when it is fair
+        self.group = group
+
+        self.position: Optional[int] = None
+        self.future = concurrent.futures.Future()
+
+
+def select_job(lanes: Lanes, last_group: Any, group_run: int) -> Optional[Job]:
+    """The job that would run next, without taking it out of the lanes."""
+
+    for priority in sorted(lanes):
+        heads = [jobs[0] for jobs in lanes[priority].values()]
+
+        if not heads:
+            continue
+
+        if group_run < MAX_GROUP_RUN:
+            for job in heads:
+                if job.group == last_group:
+                    return job
+
+        return heads[0]
+
+    return None
+
+
+def pop_job(lanes: Lanes, job: Job):
+    """Takes the job from the head of its connection, then rotates the connection to the back."""
+
+    lane = lanes[job.priority]
+    jobs = lane.pop(job.conn_id)
+    jobs.popleft()
+
+    if jobs:
+        lane[job.conn_id] = jobs
+
+
+def advance_group(job: Job, last_group: Any, group_run: int) -> tuple[Any, int]:
+    if job.group == last_group:
+        return last_group, group_run + 1
+
+    return job.group, 1
+
+
+class PipelineScheduler:
+    """
+    Owns a single pipeline and runs its jobs one at a time on a dedicated worker thread.
+
+    Pending jobs are grouped by priority lane, then by connection.
+    Within a lane, connections are served round-robin so that one client cannot starve the others,
+    except that a connection whose next job matches the group of the last one may go first,
+    up to MAX_GROUP_RUN times in a row.
+    """
+
+    def __init__(self, name: str, max_pending: int = MAX_PENDING_JOBS):
+        self.name = name
+        self.max_pending = max_pending
+
+        # priority -> conn_id -> pending jobs of that connection
+        self.lanes: Lanes = {}
+        self.pending_count = 0
+
+        self.last_group: Any = None
+        self.group_run = 0
+
+        # set while the worker has jobs out of the lanes, so pending jobs wait behind them
+        self.is_busy = False
+
+        self.condition = threading.Condition()
+        self.worker: Optional[threading.Thread] = None
+
+    def submit(
+        self,
+        run: Callable,
+        conn_id: Optional[str] = None,
+        priority: int = PRIORITY_KIOSK,
+        on_position: Optional[Callable[[int], None]] = None,
+        batch_key: Optional[tuple] = None,
+        batch_item: Any = None,
+        run_batch: Optional[Callable[[List[Any]], Any]] = None,
+        group: Any = None,
+    ) -> concurrent.futures.Future:
+        job = Job(
+            run,
+            conn_id=conn_id,
+            priority=priority,
+            on_position=on_position,
+            batch_key=batch_key,
+            batch_item=batch_item,
+            run_batch=run_batch,
+            group=group,
+        )
+
+        with self.condition:
+            if self.pending_count >= self.max_pending:
+                raise QueueFullError(f"{self.name} queue is full")
+
+            lane = self.lanes.setdefault(priority, OrderedDict())
+            lane.setdefault(conn_id, deque()).append(job)
+            self.pending_count += 1
+
+            self._ensure_worker()
+            self._notify_positions()
+            self.condition.notify()
+
+        return job.future
+
+    def cancel_pending(self, future: concurrent.futures.Future) -> bool:
+        """Removes a job that has not started yet. Returns false if it is already running or finished."""
+
+        with self.condition:
+            for job in self.ordered_pending():
+                if job.future is not future:
+                    continue
+
+                self._remove(job)
+                job.future.cancel()
+                self._notify_positions()
+
+                return True
+
+        return False
+
+    def ordered_pending(self) -> List[Job]:
+        """Pending jobs in the order they would be served if nothing else arrives."""
+
+        lanes: Lanes = {
+            priority: OrderedDict(
+                (conn_id, deque(jobs)) for conn_id, jobs in lane.items()
+            )
+            for priority, lane in self.lanes.items()
+        }
+
+        last_group, group_run = self.last_group, self.group_run
+        order: List[Job] = []
+
+        while (job := select_job(lanes, last_group, group_run)) is not None:
+            pop_job(lanes, job)
+            order.append(job)
+            last_group, group_run = advance_group(job, last_group, group_run)
+
+        return order
+
+    def _next_job(self) -> Optional[Job]:
+        job = select_job(self.lanes, self.last_group, self.group_run)
+
+        if job is None:
+            return None
+
+        pop_job(self.lanes, job)
+        self.pending_count -= 1
+        self.last_group, self.group_run = advance_group(
+            job, self.last_group, self.group_run
+        )
+
+        return job
+
+    def _remove(self, job: Job):
+        lane = self.lanes[job.priority]
+        jobs = lane[job.conn_id]
+
+        jobs.remove(job)
+        self.pending_count -= 1
+
+        if not jobs:
+            del lane[job.conn_id]
+
+    def _collect_batch(self, job: Job) -> List[Job]:
+        """Holds the job for up to the batch window, merging in compatible pending jobs."""
+
+        batch = [job]
+        deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+
+        while len(batch) < MAX_BATCH_SIZE:
+            for other in self.ordered_pending():
+                if len(batch) >= MAX_BATCH_SIZE:
+                    break
+
+                if other.batch_key == job.batch_key:
+                    self._remove(other)
+                    batch.append(other)
+
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0 or len(batch) >= MAX_BATCH_SIZE:
+                break
+
+            self.condition.wait(remaining)
+
+        return batch
+
+    def _notify_positions(self):
+        for index, job in enumerate(self.ordered_pending()):
+            position = index + 1
+
+            # an idle worker takes the first job right away, so it never waited in line
+            if position == 1 and not self.is_busy:
+                continue
+
+            if job.position == position or job.on_position is None:
+                continue
+
+            job.position = position
+            job.on_position(position)
+
+    def _ensure_worker(self):
+        if self.worker is not None:
+            return
+
+        self.worker = threading.Thread(
+            target=self._work, name=f"scheduler-{self.name}", daemon=True
+        )
+
+        self.worker.start()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+
+                self.is_busy = True
+                batch = [job]
+
+                if job.batch_key is not None and BATCH_WINDOW_MS > 0:
+                    batch = self._collect_batch(job)
+
+                self._notify_positions()
+
+            batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+
+            if batch:
+                self._run_batch(batch)
+
+            with self.condition:
+                self.is_busy = False
+
+    def _run_batch(self, batch: List[Job]):
+        try:
+            if len(batch) == 1:
+                result = batch[0].run()
+            else:
+                result = batch[0].run_batch([job.batch_item for job in batch])
+
+            for job in batch:
+                job.future.set_result(result)
+        except BaseException as error:
+            for job in batch:
+                job.future.set_exception(error)
+
+
+schedulers: Dict[str, PipelineScheduler] = {}
+
+
+def get_scheduler(pipeline: str) -> PipelineScheduler:
+    if pipeline not in schedulers:
+        schedulers[pipeline] = PipelineScheduler(pipeline)
+
+    return schedulers[pipeline]
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import itertools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+# record a chrome trace of every generation, viewable in chrome://tracing or ui.perfetto.dev
+TRACE = os.environ.get("TRACE", "0") == "1"
+TRACE_DIR = Path(os.environ.get("TRACE_DIR", "./cache/traces"))
+
+# append every request to this one file instead of writing a file per request.
+# each process gets its own, trace.json becomes trace.<pid>.json, as inference workers trace too.
+TRACE_FILE = os.environ.get("TRACE_FILE")
+
+# once TRACE_FILE grows past this, it moves to <name>.1.json, replacing the one before. 0 never rotates
+TRACE_FILE_MB = float(os.environ.get("TRACE_FILE_MB", "256"))
+
+request_ids = itertools.count(1)
+
+# keeps file writes off the event loop, and appends to the rolling file in order
+trace_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace")
+
+
+class Trace:
+    """
+    Spans of one request, in the chrome trace event format.
+
+    Each request becomes its own process in the viewer, with a track per thread that worked on it.
+    Safe to record from any thread.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.pid = next(request_ids)
+        self.events: List[dict] = []
+        self.lock = threading.Lock()
+        self.threads: Dict[int, str] = {}
+
+    def add_span(self, name: str, start: float, end: float, category="", **args):
+        """Records a span from perf_counter() timestamps in seconds."""
+
+        thread = threading.current_thread()
+
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1_000_000,
+            "dur": (end - start) * 1_000_000,
+            "pid": self.pid,
+            "tid": thread.ident,
+            "args": args,
+        }
+
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, category="", **args):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter(), category, **args)
+
+    def trace_events(self) -> List[dict]:
+        with self.lock:
+            threads = dict(self.threads)
+            events = list(self.events)
+
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": f"{self.name} #{self.pid}"},
+            }
+        ]
+
+        for tid, thread_name in threads.items():
+            metadata.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+            )
+
+        return metadata + events
+
+    def save(self):
+        trace_writer.submit(write_trace, self.name, self.pid, self.trace_events())
+
+
+class NullTrace(Trace):
+    """Stands in for a trace when tracing is off, so callers never have to check."""
+
+    def __init__(self):
+        pass
+
+    def add_span(self, name: str, start: float, end: float, category="", **args):
+        pass
+
+    @contextmanager
+    def span(self, name: str, category="", **args):
+        yield
+
+    def save(self):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def create_trace(name: str) -> Trace:
+    return Trace(name) if TRACE else NULL_TRACE
+
+
+def get_trace_file() -> Path:
+    path = Path(TRACE_FILE)
+
+    return path.with_name(f"{path.stem}.{os.getpid()}{path.suffix}")
+
+
+def write_trace(name: str, pid: int, events: List[dict]):
+    try:
+        if TRACE_FILE:
+            append_events(get_trace_file(), events)
+            return
+
+        # request ids count per process, and inference workers write to the same directory
+        TRACE_DIR.mkdir(parents=True, exist_ok=True)
+        path = TRACE_DIR / f"{int(time.time())}-{os.getpid()}-{pid}-{name}.json"
+
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events}, file)
+    except Exception as error:
+        print(f"failed to write trace: {error}")
+
+
+def rotate_trace_file(path: Path):
+    if TRACE_FILE_MB <= 0 or not path.exists():
+        return
+
+    if path.stat().st_size >= TRACE_FILE_MB * 2**20:
+        path.replace(path.with_suffix(".1" + path.suffix))
+
+
+def append_events(path: Path, events: List[dict]):
+    rotate_trace_file(path)
+
+    # the json array format allows a missing closing bracket, so requests are only ever appended
+    is_new = not path.exists()
+
+    with open(path, "a") as file:
+        if is_new:
+            file.write("[\n")
+
+        for event in events:
+            file.write(json.dumps(event) + ",\n")
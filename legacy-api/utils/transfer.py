@@ -0,0 +1,100 @@
+import os
+import threading
+
+from typing import List, Optional
+
+import torch
+
+# previews that can be on their way from the gpu to the encoder at once
+PREVIEW_RING_DEPTH = int(os.environ.get("PREVIEW_RING_DEPTH", "8"))
+
+
+class HostCopy:
+    """A tensor being copied into one slot of a PinnedRing."""
+
+    def __init__(self, ring, slot: int, tensor: torch.Tensor, event):
+        self.ring = ring
+        self.slot = slot
+        self.tensor = tensor
+        self.event = event
+
+    def wait(self) -> torch.Tensor:
+        """Blocks the calling thread, not the device, until the copy has landed."""
+
+        if self.event is not None:
+            self.event.synchronize()
+
+        return self.tensor
+
+    def release(self):
+        self.ring.release(self.slot)
+
+
+class PinnedRing:
+    """
+    Reusable host buffers for copying tensors off the device without a synchronization.
+
+    The copy is queued on the tensor's stream right behind the work that produced it,
+    so the diffusion thread returns at once and the next step is queued straight after.
+    Buffers are pinned when cuda is available, and grow to the largest tensor they have held.
+    Works with cpu tensors too, where the copy is immediate.
+    """
+
+    def __init__(self, depth: int = PREVIEW_RING_DEPTH):
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.free = list(range(depth))
+
+        self.buffers: List[Optional[torch.Tensor]] = [None] * depth
+        self.events: List[Optional[torch.cuda.Event]] = [None] * depth
+
+    def get_buffer(self, slot: int, size: int) -> torch.Tensor:
+        buffer = self.buffers[slot]
+
+        if buffer is None or buffer.numel() < size:
+            buffer = torch.empty(
+                size, dtype=torch.uint8, pin_memory=torch.cuda.is_available()
+            )
+            self.buffers[slot] = buffer
+
+        return buffer
+
+    def reserve(self, tensor: torch.Tensor):
+        """Allocates every slot for tensors of this size up front, as pinning memory is slow."""
+
+        size = tensor.numel() * tensor.element_size()
+
+        with self.lock:
+            for slot in self.free:
+                self.get_buffer(slot, size)
+
+    def copy(self, tensor: torch.Tensor) -> Optional[HostCopy]:
+        """Starts copying a tensor to the host. Returns None when every slot is taken."""
+
+        with self.lock:
+            if not self.free:
+                return None
+
+            slot = self.free.pop()
+
+        size = tensor.numel() * tensor.element_size()
+        buffer = self.get_buffer(slot, size)
+        host = buffer[:size].view(tensor.dtype).view(tensor.shape)
+
+        if not tensor.is_cuda:
+            host.copy_(tensor)
+
+            return HostCopy(self, slot, host, None)
+
+        if self.events[slot] is None:
+            self.events[slot] = torch.cuda.Event()
+
+        event = self.events[slot]
+        host.copy_(tensor, non_blocking=True)
+        event.record(torch.cuda.current_stream(tensor.device))
+
+        return HostCopy(self, slot, host, event)
+
+    def release(self, slot: int):
+        with self.lock:
+            self.free.append(slot)
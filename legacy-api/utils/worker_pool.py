@@ -0,0 +1,419 @@
+import os
+import asyncio
+import itertools
+import threading
+import multiprocessing
+
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from prometheus_client import REGISTRY
+from prometheus_client.metrics_core import Metric
+from prometheus_client.parser import text_string_to_metric_families
+
+from utils.connection_state import (
+    get_final_format,
+    get_is_connected,
+    get_preview_format,
+    get_priority,
+)
+from utils.frame_ring import FrameRing
+from utils.metrics import INFERENCE_METRICS
+from utils.pipeline_manager import cancellers
+from utils.pipelines import pipelines
+from utils.protocol import Frame, status_frame
+from utils.worker_process import WorkerSpec, parse_workers, run_worker
+
+# run the pipelines in worker processes, e.g. "text2img@cuda:0,img2img@cuda:1".
+# unset runs them in the server process.
+INFERENCE_WORKERS = os.environ.get("INFERENCE_WORKERS", "")
+
+# delay before a worker that exited is started again
+WORKER_RESTART_SECONDS = float(os.environ.get("WORKER_RESTART_SECONDS", "1"))
+
+# seconds a worker gets to exit on shutdown before it is killed
+WORKER_STOP_SECONDS = 5
+
+# seconds a worker gets to report its metrics, before /metrics shows what it reported last
+WORKER_METRICS_SECONDS = 1
+
+# cuda cannot be used in a forked process
+context = multiprocessing.get_context("spawn")
+
+
+class Worker:
+    """One inference worker process, started again whenever it exits."""
+
+    def __init__(self, index: int, spec: WorkerSpec, preload: Iterable[str]):
+        self.name = f"worker-{index}"
+        self.spec = spec
+        self.preload = [name for name in preload if name in spec.pipelines]
+        self.ring = FrameRing()
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.process = None
+        self.connection = None
+        self.restarts = 0
+        self.is_stopping = False
+        self.restart_handle: Optional[asyncio.TimerHandle] = None
+
+        # set while a process is there to take jobs
+        self.is_running = asyncio.Event()
+
+        # job -> its frames, where None ends the stream
+        self.jobs: Dict[int, asyncio.Queue] = {}
+
+        # pipeline -> its state, as last reported by the process
+        self.pipelines: Dict[str, dict] = {}
+
+        # the process's metrics in the text format, as last reported
+        self.metrics = ""
+        self.metrics_reply: Optional[asyncio.Future] = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.ring.reset()
+
+        connection, child_connection = context.Pipe()
+        process = context.Process(
+            target=run_worker,
+            args=(
+                self.spec,
+                self.preload,
+                child_connection,
+                self.ring.name,
+                self.ring.size,
+            ),
+            name=self.name,
+            daemon=True,
+        )
+        process.start()
+
+        # so the pipe reports the end of the process
+        child_connection.close()
+
+        self.process = process
+        self.connection = connection
+        self.is_running.set()
+
+        threading.Thread(
+            target=self.read,
+            args=(connection, process),
+            name=f"{self.name}-read",
+            daemon=True,
+        ).start()
+
+    def send(self, message: tuple) -> bool:
+        try:
+            self.connection.send(message)
+        except (OSError, ValueError):
+            # the process is gone, its jobs end once the reader finds out
+            return False
+
+        return True
+
+    def read(self, connection, process):
+        """Receives the messages of one process on its own thread, until the process exits."""
+
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == "frame":
+                _, job, frame, location = message
+
+                # copied out right away, which frees the space even if the job is gone
+                if location is not None:
+                    frame = frame._replace(payload=self.ring.read(*location))
+
+                message = ("frame", job, frame)
+
+            self.loop.call_soon_threadsafe(self.receive, message)
+
+        process.join()
+
+        if not self.is_stopping:
+            self.loop.call_soon_threadsafe(self.on_exit, process)
+
+    def receive(self, message: tuple):
+        kind, key, *arguments = message
+
+        if kind == "pipeline":
+            self.pipelines[key] = arguments[0]
+            return
+
+        if kind == "metrics":
+            if self.metrics_reply is not None and not self.metrics_reply.done():
+                self.metrics_reply.set_result(arguments[0])
+            return
+
+        frames = self.jobs.get(key)
+
+        if frames is not None:
+            frames.put_nowait(arguments[0] if kind == "frame" else None)
+
+    def on_exit(self, process):
+        self.connection.close()
+        self.is_running.clear()
+        self.pipelines = {}
+        self.metrics = ""
+
+        # the jobs of the process are lost, their streams end like failed jobs
+        for frames in self.jobs.values():
+            frames.put_nowait(None)
+
+        self.jobs.clear()
+
+        print(
+            f"{self.name} exited with code {process.exitcode}, "
+            f"restarting in {WORKER_RESTART_SECONDS}s"
+        )
+
+        self.restarts += 1
+        self.restart_handle = self.loop.call_later(WORKER_RESTART_SECONDS, self.start)
+
+    async def update_metrics(self):
+        if not self.is_running.is_set():
+            return
+
+        # concurrent scrapes share one request
+        if self.metrics_reply is None or self.metrics_reply.done():
+            self.metrics_reply = self.loop.create_future()
+
+            if not self.send(("metrics", 0)):
+                return
+
+        try:
+            self.metrics = await asyncio.wait_for(
+                asyncio.shield(self.metrics_reply), WORKER_METRICS_SECONDS
+            )
+        except asyncio.TimeoutError:
+            print(f"{self.name} did not report its metrics in time")
+
+    def describe(self) -> dict:
+        return {
+            "pipelines": list(self.spec.pipelines),
+            "device": self.spec.device,
+            "pid": None if self.process is None else self.process.pid,
+            "alive": self.process is not None and self.process.is_alive(),
+            "restarts": self.restarts,
+            "jobs": len(self.jobs),
+        }
+
+    def stop(self):
+        self.is_stopping = True
+
+        if self.restart_handle is not None:
+            self.restart_handle.cancel()
+
+        self.send(("stop", 0))
+
+    def join(self):
+        if self.process is not None:
+            self.process.join(WORKER_STOP_SECONDS)
+
+            if self.process.is_alive():
+                self.process.kill()
+
+        self.ring.close()
+
+
+class WorkerPool:
+    """
+    Runs program commands in inference worker processes, one per device or group of pipelines.
+
+    The server keeps the websockets, the command queues and the frame writers.
+    A job goes to the least busy worker that hosts its pipeline, and its frames come back through
+    the worker's shared memory ring, so the event loop never shares a GIL with diffusion or encoding.
+    """
+
+    def __init__(self, specs: List[WorkerSpec], preload: Iterable[str]):
+        preload = list(preload)
+
+        self.workers = [Worker(i, spec, preload) for i, spec in enumerate(specs)]
+        self.job_ids = itertools.count(1)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+        for worker in self.workers:
+            worker.join()
+
+    def hosts(self, pipeline: str) -> bool:
+        return any(pipeline in worker.spec.pipelines for worker in self.workers)
+
+    def pick(self, pipeline: str) -> Worker:
+        workers = [
+            worker for worker in self.workers if pipeline in worker.spec.pipelines
+        ]
+
+        # workers that are restarting come last
+        return min(
+            workers,
+            key=lambda worker: (not worker.is_running.is_set(), len(worker.jobs)),
+        )
+
+    async def run(
+        self, command: str, conn_id: str, pipeline: str
+    ) -> AsyncIterator[Frame]:
+        """The output stream of a program command, generated by a worker."""
+
+        worker = self.pick(pipeline)
+        job = next(self.job_ids)
+        frames: asyncio.Queue = asyncio.Queue()
+
+        # the worker schedules the job by the client's connection and role, as the server would
+        options = {
+            "client_id": conn_id,
+            "priority": get_priority(conn_id),
+            "preview_format": get_preview_format(conn_id),
+            "final_format": get_final_format(conn_id),
+        }
+
+        is_cancelled = False
+
+        # CANCEL stops the job in the worker, which still ends its stream
+        def cancel():
+            nonlocal is_cancelled
+            is_cancelled = True
+
+            worker.send(("cancel", job))
+
+        cancellers.setdefault(conn_id, set()).add(cancel)
+
+        is_done = False
+
+        try:
+            # a worker that crashed takes a while to load its pipelines again
+            if not worker.is_running.is_set():
+                yield status_frame("q:loading")
+                await worker.is_running.wait()
+
+            if is_cancelled:
+                yield status_frame("cancelled")
+                return
+
+            worker.jobs[job] = frames
+
+            if not worker.send(("start", job, command, options)):
+                return
+
+            while True:
+                frame = await frames.get()
+
+                if frame is None:
+                    is_done = True
+                    break
+
+                # resumes once the connection's writer has sent the frame
+                yield frame
+
+                if not get_is_connected(conn_id):
+                    break
+
+                worker.send(("ack", job))
+        finally:
+            cancellers[conn_id].discard(cancel)
+
+            if not cancellers[conn_id]:
+                del cancellers[conn_id]
+
+            worker.jobs.pop(job, None)
+
+            # nobody is reading anymore, so stop the job or give up its slot
+            if not is_done:
+                worker.send(("close", job))
+
+    async def update_metrics(self):
+        await asyncio.gather(*(worker.update_metrics() for worker in self.workers))
+
+    def is_ready(self, pipeline: str) -> bool:
+        return any(
+            worker.pipelines.get(pipeline, {}).get("status") == "ready"
+            for worker in self.workers
+        )
+
+    def describe_pipelines(self) -> Dict[str, dict]:
+        """The state of each hosted pipeline, from the worker where it is furthest along."""
+
+        order = ["failed", "pending", "loading", "ready"]
+        described: Dict[str, dict] = {}
+
+        for worker in self.workers:
+            for name in worker.spec.pipelines:
+                state = worker.pipelines.get(name, {"status": "pending"})
+                best = described.get(name)
+
+                if best is None or order.index(state["status"]) > order.index(
+                    best["status"]
+                ):
+                    described[name] = state
+
+        return described
+
+
+class WorkerMetrics:
+    """
+    Exports the metrics the workers recorded, with a worker label, as of their last update.
+
+    Only the inference metrics are taken, the server records the connection metrics itself.
+    """
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+        self.names = {
+            family.name for metric in INFERENCE_METRICS for family in metric.describe()
+        }
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        families: Dict[str, Metric] = {}
+
+        for worker in self.pool.workers:
+            for family in text_string_to_metric_families(worker.metrics):
+                if family.name not in self.names:
+                    continue
+
+                merged = families.setdefault(
+                    family.name,
+                    Metric(family.name, family.documentation, family.type, family.unit),
+                )
+
+                for sample in family.samples:
+                    labels = {**sample.labels, "worker": worker.name}
+                    merged.samples.append(sample._replace(labels=labels))
+
+        return families.values()
+
+
+def create_worker_pool(required: Iterable[str], preload: Iterable[str]) -> WorkerPool:
+    """The pool for INFERENCE_WORKERS, which must host every pipeline an enabled program needs."""
+
+    specs = parse_workers(INFERENCE_WORKERS)
+
+    for spec in specs:
+        for name in spec.pipelines:
+            if name not in pipelines:
+                raise ValueError(f"unknown pipeline in INFERENCE_WORKERS: {name}")
+
+    pool = WorkerPool(specs, preload)
+
+    for name in required:
+        if not pool.hosts(name):
+            raise ValueError(f"no worker in INFERENCE_WORKERS runs the {name} pipeline")
+
+    # the server's own inference metrics would only ever report zeros
+    for metric in INFERENCE_METRICS:
+        REGISTRY.unregister(metric)
+
+    REGISTRY.register(WorkerMetrics(pool))
+
+    return pool
@@ -0,0 +1,64 @@
+"""
+Entry point of the inference worker processes.
+
+This module only imports the standard library, so a new process can pick its device and pipelines
+before torch, diffusers and the pipeline registry are imported.
+"""
+
+import os
+import asyncio
+
+from multiprocessing.connection import Connection
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class WorkerSpec(NamedTuple):
+    # the pipelines this worker loads and runs jobs for
+    pipelines: Tuple[str, ...]
+
+    # TORCH_DEVICE of the worker, or None for the server's
+    device: Optional[str] = None
+
+    def describe(self) -> str:
+        pipelines = "+".join(self.pipelines)
+
+        return pipelines if self.device is None else f"{pipelines}@{self.device}"
+
+
+def parse_workers(text: str) -> List[WorkerSpec]:
+    """Parses "text2img@cuda:0,img2img@cuda:1" or "text2img+img2img@cpu" into one spec per worker."""
+
+    specs = []
+
+    for entry in filter(None, (entry.strip() for entry in text.split(","))):
+        pipelines, _, device = entry.partition("@")
+        names = tuple(name.strip() for name in pipelines.split("+") if name.strip())
+
+        if not names:
+            raise ValueError(f"inference worker without pipelines: {entry}")
+
+        specs.append(WorkerSpec(names, device.strip() or None))
+
+    return specs
+
+
+def run_worker(
+    spec: WorkerSpec,
+    preload: List[str],
+    connection: Connection,
+    ring_name: str,
+    ring_size: int,
+):
+    """Runs in the new process until the server closes its end of the pipe."""
+
+    if spec.device is not None:
+        os.environ["TORCH_DEVICE"] = spec.device
+
+    os.environ["PRELOAD_PIPELINES"] = ",".join(preload)
+
+    # imported only now, as importing the pipelines reads the variables above
+    from utils.inference_worker import serve
+
+    print(f"inference worker {spec.describe()} starting")
+
+    asyncio.run(serve(spec, connection, ring_name, ring_size))
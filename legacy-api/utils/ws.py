@@ -1,27 +1,197 @@
+import asyncio
+import itertools
+
+from collections import deque
 from fastapi import WebSocket
+from typing import AsyncIterator, Callable, Deque, Optional, Tuple
 
 from utils.connection_state import get_is_connected
+from utils.metrics import bytes_sent_total, frames_sent_total
+from utils.protocol import (
+    DONE,
+    FRAME_NAMES,
+    PROTOCOL_V2,
+    READY,
+    Frame,
+    encode_v1,
+    encode_v2,
+    status_frame,
+)
+
+
+async def send_frame(sock: WebSocket, frame: Frame, job_id: int = 0):
+    frames_sent_total.labels(FRAME_NAMES[frame.type]).inc()
+
+    if sock.state.protocol == PROTOCOL_V2:
+        message = encode_v2(frame, job_id)
+        bytes_sent_total.inc(len(message))
+
+        await sock.send_bytes(message)
+        return
+
+    for message in encode_v1(frame):
+        if isinstance(message, str):
+            bytes_sent_total.inc(len(message.encode()))
+            await sock.send_text(message)
+        else:
+            bytes_sent_total.inc(len(message))
+            await sock.send_bytes(message)
+
+
+def post_frame(sock: WebSocket, frame: Frame, job_id: int = 0):
+    """Queues a frame for the connection's writer without waiting for it to be sent."""
+
+    sock.state.outbox.put_nowait((frame, job_id, None))
+
+
+async def write_frame(sock: WebSocket, frame: Frame, job_id: int = 0):
+    """Queues a frame for the connection's writer, then waits until it has been sent."""
+
+    sent = asyncio.get_event_loop().create_future()
+    sock.state.outbox.put_nowait((frame, job_id, sent))
+
+    await sent
+
+
+def send_status(sock: WebSocket, text: str, job_id: int = 0):
+    post_frame(sock, status_frame(text), job_id)
+
+
+async def run_writer(sock: WebSocket):
+    """
+    Sends the connection's queued frames in order, one at a time.
+
+    Jobs and the reader never write to the socket themselves,
+    so the messages of one frame are never interleaved with another's.
+    """
+
+    outbox: asyncio.Queue = sock.state.outbox
+
+    while True:
+        frame, job_id, sent = await outbox.get()
+
+        try:
+            await send_frame(sock, frame, job_id)
+        except Exception as error:
+            if sent is not None and not sent.done():
+                sent.set_exception(error)
+
+            continue
+
+        if sent is not None and not sent.done():
+            sent.set_result(None)
 
 
 def create_send(sock: WebSocket):
     conn_id = sock.state.connection_id
+    job_ids = itertools.count(1)
+
+    async def send(generator, job_id: Optional[int] = None):
+        if job_id is None:
+            job_id = next(job_ids)
 
-    async def send(generator):
-        await sock.send_text("ready")
+        await write_frame(sock, READY, job_id)
 
-        async for out in generator:
-            if not get_is_connected(conn_id):
-                break
+        try:
+            async for frame in generator:
+                if not get_is_connected(conn_id):
+                    break
 
-            if isinstance(out, str):
-                await sock.send_text(out)
-            else:
-                await sock.send_bytes(out)
+                # waiting for the writer keeps slow clients from queueing up frames,
+                # the frame buffer drops their stale previews instead
+                await write_frame(sock, frame, job_id)
+        except asyncio.CancelledError:
+            # a job cancelled on its own still ends like any other stream
+            if get_is_connected(conn_id):
+                post_frame(sock, status_frame("cancelled"), job_id)
+                post_frame(sock, DONE, job_id)
 
-        await sock.send_text("done")
+            raise
+        finally:
+            # cleans up the generation now, e.g. its scheduler job, rather than whenever it is collected
+            await generator.aclose()
+
+        await write_frame(sock, DONE, job_id)
 
     return send
 
 
+async def cancelled_stream() -> AsyncIterator[Frame]:
+    yield status_frame("cancelled")
+
+
+class CommandQueue:
+    """
+    Plain program commands of a connection, run one at a time in the order they arrived.
+
+    The queue runs on its own task, so the reader never waits for a generation to finish.
+    """
+
+    def __init__(self, send: Callable, max_size: int):
+        self.send = send
+        self.max_size = max_size
+        self.pending: Deque[Tuple[str, AsyncIterator[Frame]]] = deque()
+        self.added = asyncio.Event()
+
+        # the command being generated, if any, and the task sending its stream
+        self.running: Optional[str] = None
+        self.current: Optional[asyncio.Task] = None
+
+        self.task = asyncio.create_task(self.run())
+
+    @property
+    def is_busy(self) -> bool:
+        return self.running is not None or bool(self.pending)
+
+    def put(self, command: str, generator: AsyncIterator[Frame]) -> bool:
+        if len(self.pending) >= self.max_size:
+            return False
+
+        self.pending.append((command, generator))
+        self.added.set()
+
+        return True
+
+    def cancel_pending(self, should_cancel: Callable[[str], bool] = lambda _: True):
+        """Cancels waiting commands. They still get their ready, cancelled and done frames, in order."""
+
+        for i, (command, _) in enumerate(self.pending):
+            if should_cancel(command):
+                self.pending[i] = (command, cancelled_stream())
+
+    async def run(self):
+        while True:
+            while not self.pending:
+                self.added.clear()
+                await self.added.wait()
+
+            command, generator = self.pending.popleft()
+            self.running = command
+
+            # on a task of its own, so cancel_running can stop it without stopping the queue
+            self.current = asyncio.create_task(self.send(generator))
+
+            try:
+                await asyncio.wait([self.current])
+
+                if not self.current.cancelled() and self.current.exception():
+                    print(f"generation failed: {self.current.exception()}")
+            finally:
+                self.running = None
+                self.current = None
+
+    def cancel_running(self, should_cancel: Callable[[str], bool] = lambda _: True):
+        """Cancels the command being generated. Its stream still ends with cancelled and done."""
+
+        if self.current is not None and should_cancel(self.running):
+            self.current.cancel()
+
+    def close(self):
+        self.task.cancel()
+
+        if self.current is not None:
+            self.current.cancel()
+
+
 def strip(command: str, key: str):
     return command.replace(key + ":", "").strip()
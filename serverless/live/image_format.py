@@ -0,0 +1,65 @@
+import io
+import time
+
+# PIL format and file extension of each format a client can ask for
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+    "png": ("PNG", "png"),
+}
+
+DEFAULT_PREVIEW_FORMAT = {"format": "jpeg", "quality": 75, "size": None}
+DEFAULT_FINAL_FORMAT = {"format": "png", "quality": None, "size": None}
+
+
+def parse_image_format(text: str):
+    """Parses "webp,quality=70,size=512", or returns None if it is not valid."""
+    name, *options = [part.strip() for part in text.split(",")]
+
+    if name not in IMAGE_FORMATS:
+        return None
+
+    image_format = {"format": name, "quality": None, "size": None}
+
+    for option in options:
+        key, _, value = option.partition("=")
+
+        if key not in ("quality", "size") or not (value.isascii() and value.isdigit()):
+            return None
+
+        if int(value) == 0:
+            return None
+
+        image_format[key] = int(value)
+
+    if (image_format["quality"] or 0) > 100:
+        return None
+
+    return image_format
+
+
+def encode_image(image, image_format, kind: str) -> bytes:
+    """Encodes a "preview" or "final" image, and logs how long it took and its size."""
+    encode_start = time.perf_counter()
+
+    # scales the longest side down to the requested size
+    if image_format["size"] and max(image.size) > image_format["size"]:
+        image = image.copy()
+        image.thumbnail((image_format["size"], image_format["size"]))
+
+    # png is lossless, so it has no quality setting
+    options = {}
+    if image_format["quality"] and image_format["format"] != "png":
+        options["quality"] = image_format["quality"]
+
+    with io.BytesIO() as buf:
+        image.save(buf, format=IMAGE_FORMATS[image_format["format"]][0], **options)
+        image_bytes = buf.getvalue()
+
+    encode_ms = (time.perf_counter() - encode_start) * 1000
+    print(
+        f"encoded {image_format['format']} {kind} image in {encode_ms:.1f}ms, "
+        f"{len(image_bytes)} bytes"
+    )
+
+    return image_bytes
@@ -1,12 +1,20 @@
-import io
 import os
 import random
 import time
 from pathlib import Path
+from typing import Optional
 import asyncio
 
 import modal
 
+from image_format import (
+    DEFAULT_FINAL_FORMAT,
+    DEFAULT_PREVIEW_FORMAT,
+    IMAGE_FORMATS,
+    encode_image,
+    parse_image_format,
+)
+
 APP_NAME = "exhibition-text-to-image"
 MODEL_NAME = "stabilityai/stable-diffusion-3.5-large-turbo"
 app = modal.App(APP_NAME)
@@ -28,6 +36,7 @@ image = (
         "Pillow",
     )
     .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+    .add_local_python_source("image_format")
 )
 
 with image.imports():
@@ -45,7 +54,6 @@ generated_vol = modal.Volume.from_name("generated", create_if_missing=True)
 LORA_WEIGHTS = "heypoom/chuamiatee-1"
 LORA_WEIGHT_NAME = "pytorch_lora_weights.safetensors"
 
-
 @app.cls(
     image=image,
     gpu="H100",
@@ -99,6 +107,8 @@ class Inference:
         num_inference_steps: int = 10,
         use_lora: bool = False,
         final_only: bool = False,
+        preview_format: Optional[dict] = None,
+        final_format: Optional[dict] = None,
     ) -> tuple[list[bytes], list[bytes]]:
         if not self.pipe:
             raise RuntimeError("Pipeline not initialized or moved to GPU.")
@@ -108,6 +118,9 @@ class Inference:
         # Ensure LORA is in the correct state
         self._ensure_lora_state(use_lora)
 
+        preview_format = preview_format or DEFAULT_PREVIEW_FORMAT
+        final_format = final_format or DEFAULT_FINAL_FORMAT
+
         seed = seed if seed is not None else random.randint(0, 2**32 - 1)
         print(f"running inference for: '{prompt}' with seed {seed}")
         generator = torch.Generator("cuda").manual_seed(seed)
@@ -144,13 +157,13 @@ class Inference:
                     preview_image = Image.fromarray(image[0])
 
                     # Save preview image to bytes
-                    with io.BytesIO() as buf:
-                        preview_image.save(buf, format="JPEG", quality=75)
-                        preview_bytes = buf.getvalue()
-                        try:
-                            generation_queue.put(preview_bytes)
-                        except Exception as e:
-                            print(f"Warning: Failed to put preview image on queue: {e}")
+                    preview_bytes = encode_image(
+                        preview_image, preview_format, "preview"
+                    )
+                    try:
+                        generation_queue.put(preview_bytes)
+                    except Exception as e:
+                        print(f"Warning: Failed to put preview image on queue: {e}")
 
             except Exception as e:
                 print(f"Error during preview generation step {step_index}: {e}")
@@ -183,9 +196,7 @@ class Inference:
         # Convert final images to bytes
         image_output = []
         for image in images:
-            with io.BytesIO() as buf:
-                image.save(buf, format="PNG")
-                image_output.append(buf.getvalue())
+            image_output.append(encode_image(image, final_format, "final"))
 
         print(f"Inference complete. Generated {len(image_output)} final images.")
         return image_output
@@ -222,6 +233,10 @@ def endpoint():
         await websocket.accept()
         await websocket.send_text("pong")
 
+        # set with PREVIEW:<format> and FINAL:<format>, e.g. PREVIEW:webp,quality=60,size=512
+        preview_format = DEFAULT_PREVIEW_FORMAT
+        final_format = DEFAULT_FINAL_FORMAT
+
         try:
             while True:
                 data = await websocket.receive_text()
@@ -230,6 +245,22 @@ def endpoint():
                     await websocket.send_text("pong")
                     continue
 
+                if data.startswith(("PREVIEW:", "FINAL:")):
+                    kind, _, text = data.partition(":")
+                    parsed = parse_image_format(text)
+
+                    if parsed is None:
+                        await websocket.send_text(
+                            f"unknown {kind.lower()} format: {text}"
+                        )
+                    elif kind == "PREVIEW":
+                        preview_format = parsed
+                        await websocket.send_text(f"preview:{text}")
+                    else:
+                        final_format = parsed
+                        await websocket.send_text(f"final:{text}")
+                    continue
+
                 run_id = int(time.time())
                 # await websocket.send_text(
                 #     f"Received prompt: '{data}'. Starting generation (Run ID: {run_id})..."
@@ -268,6 +299,8 @@ def endpoint():
                     prompt=prompt,
                     use_lora=use_lora,
                     final_only=final_only,
+                    preview_format=preview_format,
+                    final_format=final_format,
                 )
 
                 print(f"submitted inference job for run {run_id}")
@@ -303,8 +336,10 @@ def endpoint():
                     run_output_path = Path(output_dir / f"run_{run_id}/")
                     run_output_path.mkdir(exist_ok=True)
 
+                    extension = IMAGE_FORMATS[final_format["format"]][1]
+
                     for i, image_bytes in enumerate(images):
-                        output_path = run_output_path / f"output_{i:02d}.png"
+                        output_path = run_output_path / f"output_{i:02d}.{extension}"
                         output_path.write_bytes(image_bytes)
                         await websocket.send_bytes(image_bytes)
 
@@ -61,19 +61,29 @@ R2_BUCKET_NAME = "poom-images"
 # https://huggingface.co/docs/diffusers/en/using-diffusers/callback#display-image-after-each-generation-step
 # https://huggingface.co/blog/TimothyAlexisVass/explaining-the-sdxl-latent-space
 WEIGHTS = ((60, -60, 25, -70), (60, -5, 15, -50), (60, 10, -5, -35))
+BIASES = (150, 140, 130)
+
+# projection tensors per (dtype, device), so they are not rebuilt on every step
+_projection_cache = {}
+
+def get_projection(dtype, device):
+    key = (dtype, device)
+
+    if key not in _projection_cache:
+        weights_tensor = torch.tensor(WEIGHTS, dtype=dtype, device=device).t().contiguous()
+        biases_tensor = torch.tensor(BIASES, dtype=dtype, device=device)
+        _projection_cache[key] = (weights_tensor, biases_tensor)
+
+    return _projection_cache[key]
 
 def latents_to_rgb(latents):
-    weights_tensor = torch.t(
-        torch.tensor(WEIGHTS, dtype=latents.dtype).to(latents.device)
-    )
-    biases_tensor = torch.tensor((150, 140, 130), dtype=latents.dtype).to(
-        latents.device
-    )
-    weights_s = torch.einsum("...lxy,lr -> ...rxy", latents, weights_tensor)
-    biases_s = biases_tensor.unsqueeze(-1).unsqueeze(-1)
-    rgb_tensor = weights_s + biases_s
-    image_array = rgb_tensor.clamp(0, 255)[0].byte().cpu().numpy()
-    image_array = image_array.transpose(1, 2, 0)
+    weights_tensor, biases_tensor = get_projection(latents.dtype, latents.device)
+    _, channels, height, width = latents.shape
+
+    # channels-last matmul + bias in one kernel, already in (height, width, rgb) order
+    pixels = latents[:1].permute(0, 2, 3, 1).reshape(-1, channels)
+    rgb_tensor = torch.addmm(biases_tensor, pixels, weights_tensor).clamp_(0, 255)
+    image_array = rgb_tensor.to(torch.uint8).view(height, width, 3).cpu().numpy()
 
     return PILImage.fromarray(image_array)
 
@@ -0,0 +1,82 @@
+/**
+ * Decoder for the `delta` preview format of the legacy api, see `DeltaDecoder` in
+ * legacy-api/utils/delta.py. Use one decoder per job, and feed it every preview in order.
+ */
+
+const HEADER_SIZE = 6
+
+const KEYFRAME = 0
+const TREND = 2
+
+export interface DeltaPreview {
+  width: number
+  height: number
+
+  /** RGBA pixels, ready for `new ImageData(pixels, width, height)` */
+  pixels: Uint8ClampedArray
+}
+
+async function inflate(data: Uint8Array): Promise<Uint8Array> {
+  const stream = new Blob([data])
+    .stream()
+    .pipeThrough(new DecompressionStream('deflate'))
+
+  return new Uint8Array(await new Response(stream).arrayBuffer())
+}
+
+export class DeltaPreviewDecoder {
+  private previous?: Uint8Array
+  private before?: Uint8Array
+
+  async decode(payload: ArrayBuffer): Promise<DeltaPreview> {
+    const view = new DataView(payload)
+    const kind = view.getUint8(0)
+    const quantization = view.getUint8(1)
+    const width = view.getUint16(2, true)
+    const height = view.getUint16(4, true)
+
+    const data = await inflate(new Uint8Array(payload, HEADER_SIZE))
+    const values = new Uint8Array(data.length)
+
+    if (kind === KEYFRAME) {
+      values.set(data)
+      this.previous = this.before = undefined
+    } else {
+      const {previous, before} = this
+
+      if (!previous || previous.length !== data.length) {
+        throw new Error('delta preview without a keyframe before it')
+      }
+
+      if (kind === TREND && !before) {
+        throw new Error('trend preview without two frames before it')
+      }
+
+      // rounds halves up, as get_top in legacy-api/utils/delta.py does
+      const top = Math.round(255 / quantization)
+
+      for (let i = 0; i < data.length; i++) {
+        const prediction =
+          kind === TREND && before
+            ? Math.min(Math.max(2 * previous[i] - before[i], 0), top)
+            : previous[i]
+
+        values[i] = (prediction + data[i]) & 0xff
+      }
+    }
+
+    this.before = this.previous
+    this.previous = values
+
+    const pixels = new Uint8ClampedArray(width * height * 4)
+
+    for (let i = 0, j = 0; i < values.length; i += 3, j += 4) {
+      pixels[j] = values[i] * quantization
+      pixels[j + 1] = values[i + 1] * quantization
+      pixels[j + 2] = values[i + 2] * quantization
+      pixels[j + 3] = 255
+    }
+
+    return {width, height, pixels}
+  }
+}